@@ -5,6 +5,7 @@ from typing import List, Optional, Tuple
 import click
 
 from . import errors
+from .conversion.common import parse_pages
 from .document import Document
 
 
@@ -68,6 +69,18 @@ def validate_output_filename(
     return _validate_output_filename(ctx, param, value)
 
 
+def validate_pages(
+    ctx: click.Context, param: str, value: Optional[str]
+) -> Optional[str]:
+    if value is None:
+        return None
+    try:
+        parse_pages(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
+
+
 def check_suspicious_options(args: List[str]) -> None:
     options = set([arg for arg in args if arg.startswith("-")])
     try:
@@ -0,0 +1,279 @@
+import errno
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+from .util import get_resource_path, get_version
+
+log = logging.getLogger(__name__)
+
+# The default size (in bytes) of the entries that the caches keep, before they evict
+# the least recently used ones.
+DEFAULT_CACHE_SIZE = 1024**3
+DEFAULT_PIXEL_CACHE_SIZE = 4 * 1024**3
+
+# The size of the chunks in which documents are hashed.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+STATS_FILENAME = "stats.json"
+TMP_SUFFIX = ".tmp"
+
+# The files that the doc-to-pixels stage creates for each page.
+PAGE_FILE_RE = re.compile(r"page-([1-9][0-9]*)\.(rgb|width|height|depth)")
+PAGE_FILE_EXTENSIONS = ("rgb", "width", "height", "depth")
+
+
+@functools.lru_cache(maxsize=64)
+def _hash_file(filename: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_file(filename: str) -> str:
+    """Get the SHA-256 digest of a file, in hex.
+
+    The digest is kept for as long as the file does not change, since a document is
+    looked up in more than one cache.
+    """
+    stat = os.stat(filename)
+    return _hash_file(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+def get_image_id() -> str:
+    """Get the ID of the container image that converts the documents, if any."""
+    try:
+        with open(get_resource_path("image-id.txt")) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        # Conversions on Qubes do not use a container image. The version of Dangerzone
+        # that is part of the cache key covers them.
+        return ""
+
+
+def copy_regular_file(src: str, dst: str) -> None:
+    """Copy a regular file to a new file.
+
+    The pages that the doc-to-pixels stage writes come from an untrusted container,
+    which may replace them with symlinks to files of the host, or with FIFOs that block
+    whoever opens them. So symlinks are not followed, and anything other than a regular
+    file raises an OSError.
+    """
+    fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    with os.fdopen(fd, "rb") as fsrc:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            raise OSError(errno.EINVAL, "Not a regular file", src)
+        with open(dst, "xb") as fdst:
+            shutil.copyfileobj(fsrc, fdst)
+
+
+def get_entry_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(get_entry_size(entry.path) for entry in os.scandir(path))
+
+
+class Cache:
+    """A cache of conversion results, which are files or directories.
+
+    The entries of the cache are stored under a key that covers the contents of a
+    document and everything that affects its conversion, including the container image
+    and the version of Dangerzone. The cache keeps up to `max_size` bytes of entries,
+    and evicts the least recently used ones once it grows larger than that. How often
+    the cache is hit is kept in `stats`.
+    """
+
+    suffix = ""
+
+    def __init__(self, path: str, max_size: int) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.stats_filename = os.path.join(self.path, STATS_FILENAME)
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+        try:
+            with open(self.stats_filename) as f:
+                self.stats.update({key: int(val) for key, val in json.load(f).items()})
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError):
+            log.error(f"Error loading the statistics of {self.path}, resetting")
+
+    def get_key(self, input_filename: str, **settings: Any) -> str:
+        """Get the key of the entry of a document, converted with some settings."""
+        settings.update(image_id=get_image_id(), version=get_version())
+        digest = hashlib.sha256(hash_file(input_filename).encode())
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get_filename(self, key: str) -> str:
+        return os.path.join(self.path, key + self.suffix)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Get the path of the entry with the given key, if it is cached."""
+        filename = self.get_filename(key)
+        try:
+            # Keep track of the last use of the entry, for the eviction.
+            os.utime(filename)
+            found = True
+        except FileNotFoundError:
+            found = False
+        with self.lock:
+            self.stats["hits" if found else "misses"] += 1
+        return filename if found else None
+
+    def make_tmp_entry(self) -> str:
+        """Create a temporary file, where a new entry can be prepared."""
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, suffix=TMP_SUFFIX)
+        os.close(fd)
+        return tmp_filename
+
+    def store(self, key: str, tmp_filename: str) -> None:
+        """Store a prepared entry under the given key, and make room for it."""
+        try:
+            if get_entry_size(tmp_filename) > self.max_size:
+                return
+            filename = self.get_filename(key)
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            os.replace(tmp_filename, filename)
+        finally:
+            if os.path.isdir(tmp_filename):
+                shutil.rmtree(tmp_filename)
+            elif os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries, until the cache fits its size."""
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name == STATS_FILENAME or entry.name.endswith(TMP_SUFFIX):
+                    continue
+                size = get_entry_size(entry.path)
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, filename in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                log.debug(f"Evicting {filename} from {self.path}")
+                if os.path.isdir(filename):
+                    shutil.rmtree(filename)
+                else:
+                    os.remove(filename)
+                total_size -= size
+                self.stats["evictions"] += 1
+
+    def save_stats(self) -> None:
+        with self.lock:
+            with open(self.stats_filename, "w") as f:
+                json.dump(self.stats, f, indent=4)
+
+
+class SafePDFCache(Cache):
+    """A cache of the safe PDFs of the documents that have been converted."""
+
+    suffix = ".pdf"
+
+    def __init__(self, path: str, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        super().__init__(path, max_size)
+
+    def get(self, key: str, output_filename: str) -> bool:
+        """Copy the safe PDF with the given key to a file, if it is cached."""
+        filename = self.lookup(key)
+        if filename is None:
+            return False
+        try:
+            shutil.copyfile(filename, output_filename)
+        except FileNotFoundError:
+            # The safe PDF has been evicted in the meantime.
+            return False
+        except OSError as e:
+            # Convert the document instead, e.g., if the output cannot be written.
+            log.warning(f"Could not copy the cached safe PDF to {output_filename}: {e}")
+            return False
+        return True
+
+    def put(self, key: str, safe_pdf_filename: str) -> None:
+        """Store a safe PDF under the given key."""
+        # Copy the safe PDF under a temporary name first, so that it is never picked up
+        # half-written.
+        tmp_filename = self.make_tmp_entry()
+        shutil.copyfile(safe_pdf_filename, tmp_filename)
+        self.store(key, tmp_filename)
+
+
+class PixelCache(Cache):
+    """A cache of the pages that the doc-to-pixels stage has rendered.
+
+    The pages of a document do not depend on the OCR settings, so a document that is
+    converted again with other OCR settings can skip the doc-to-pixels stage. Only the
+    pages of documents that have been converted successfully are stored, since the
+    pixels-to-PDF stage has validated them by then.
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_PIXEL_CACHE_SIZE) -> None:
+        super().__init__(path, max_size)
+
+    def get(self, key: str, pixel_dir: str) -> Optional[int]:
+        """Copy the cached pages with the given key to a directory, if they are cached.
+
+        Return the number of pages.
+        """
+        dirname = self.lookup(key)
+        if dirname is None:
+            return None
+        try:
+            filenames = os.listdir(dirname)
+            for filename in filenames:
+                copy_regular_file(
+                    os.path.join(dirname, filename), os.path.join(pixel_dir, filename)
+                )
+        except FileNotFoundError:
+            # The pages have been evicted in the meantime.
+            return None
+        return len(filenames) // len(PAGE_FILE_EXTENSIONS)
+
+    def put(self, key: str, pixel_dir: str) -> None:
+        """Store the pages that the doc-to-pixels stage has written to a directory."""
+        page_files = {}
+        for filename in os.listdir(pixel_dir):
+            match = PAGE_FILE_RE.fullmatch(filename)
+            if match:
+                page_files[(int(match.group(1)), match.group(2))] = filename
+        num_pages = len(page_files) // len(PAGE_FILE_EXTENSIONS)
+        expected = {
+            (page, extension)
+            for page in range(1, num_pages + 1)
+            for extension in PAGE_FILE_EXTENSIONS
+        }
+        if num_pages == 0 or set(page_files) != expected:
+            log.warning(f"Not caching the incomplete pages in {pixel_dir}")
+            return
+
+        tmp_dirname = self.make_tmp_entry()
+        os.remove(tmp_dirname)
+        os.mkdir(tmp_dirname)
+        try:
+            for filename in page_files.values():
+                copy_regular_file(
+                    os.path.join(pixel_dir, filename),
+                    os.path.join(tmp_dirname, filename),
+                )
+        except OSError as e:
+            log.warning(f"Not caching the pages in {pixel_dir}: {e}")
+            shutil.rmtree(tmp_dirname)
+            return
+        self.store(key, tmp_dirname)
@@ -6,6 +6,7 @@ import click
 from colorama import Back, Fore, Style
 
 from . import args, errors
+from .conversion.common import MAX_DPI, MIN_DPI, QUALITY_PRESETS
 from .document import ARCHIVE_SUBDIR, SAFE_EXTENSION
 from .isolation_provider.container import Container
 from .isolation_provider.dummy import Dummy
@@ -28,12 +29,38 @@ def print_header(s: str) -> None:
     help=f"Default is filename ending with {SAFE_EXTENSION}",
 )
 @click.option("--ocr-lang", help="Language to OCR, defaults to none")
+@click.option(
+    "--quality",
+    type=click.Choice(list(QUALITY_PRESETS)),
+    default="standard",
+    show_default=True,
+    help="Quality of the safe PDF, trading conversion speed for resolution"
+    f" ({', '.join(f'{name}: {dpi} DPI' for name, dpi in QUALITY_PRESETS.items())})",
+)
+@click.option(
+    "--dpi",
+    type=click.IntRange(MIN_DPI, MAX_DPI),
+    help="Resolution of the safe PDF in DPI, overrides --quality",
+)
+@click.option(
+    "--pages",
+    callback=args.validate_pages,
+    help="Convert only the selected pages of each document, e.g., '1-3,7,10-'",
+)
 @click.option(
     "--archive",
     "archive",
     flag_value=True,
     help=f"Archives the unsafe version in a subdirectory named '{ARCHIVE_SUBDIR}'",
 )
+@click.option(
+    "--cache",
+    "cache",
+    flag_value=True,
+    help="Reuse the safe PDFs and the pages of documents that have been converted"
+    " before, so that documents are not converted twice with the same settings, and"
+    " their pages are not rendered twice with the same resolution",
+)
 @click.option(
     "--unsafe-dummy-conversion", "dummy_conversion", flag_value=True, hidden=True
 )
@@ -55,9 +82,13 @@ def print_header(s: str) -> None:
 def cli_main(
     output_filename: Optional[str],
     ocr_lang: Optional[str],
+    quality: str,
+    dpi: Optional[int],
+    pages: Optional[str],
     enable_timeouts: bool,
     filenames: List[str],
     archive: bool,
+    cache: bool,
     dummy_conversion: bool,
 ) -> None:
     setup_logging()
@@ -69,15 +100,23 @@ def cli_main(
     else:
         dangerzone = DangerzoneCore(Container(enable_timeouts=enable_timeouts))
 
+    if cache:
+        dangerzone.enable_safe_pdf_cache()
+        dangerzone.enable_pixel_cache()
+
     display_banner()
     if len(filenames) == 1 and output_filename:
-        dangerzone.add_document_from_filename(filenames[0], output_filename, archive)
+        dangerzone.add_document_from_filename(
+            filenames[0], output_filename, archive, pages
+        )
     elif len(filenames) > 1 and output_filename:
         click.echo("--output-filename can only be used with one input file.")
         exit(1)
     else:
         for filename in filenames:
-            dangerzone.add_document_from_filename(filename, archive=archive)
+            dangerzone.add_document_from_filename(
+                filename, archive=archive, pages=pages
+            )
 
     # Validate OCR language
     if ocr_lang:
@@ -98,7 +137,9 @@ def cli_main(
     # Convert the document
     print_header("Converting document to safe PDF")
 
-    dangerzone.convert_documents(ocr_lang)
+    if dpi is None:
+        dpi = QUALITY_PRESETS[quality]
+    dangerzone.convert_documents(ocr_lang, dpi=dpi)
     documents_safe = dangerzone.get_safe_documents()
     documents_failed = dangerzone.get_failed_documents()
 
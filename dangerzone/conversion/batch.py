@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+"""
+Convert a batch of documents in a single sandbox.
+
+Starting a container for each stage of each document is expensive, especially for
+batches of many small documents. Instead, this script runs once per batch and stage,
+and converts the documents of the batch one after the other. In order to keep the
+documents isolated from each other, each document is converted by a fresh worker
+process (the usual `doc_to_pixels` / `pixels_to_pdf` scripts), and the following steps
+are taken between documents:
+
+- Any process that the previous worker left behind (e.g., LibreOffice) is killed.
+- The scratch directories of the sandbox (/tmp, the home directory, etc.) are wiped.
+- The documents and the pages of each document are received one by one through the
+  standard input, so the documents that have not been converted yet are never visible
+  to a worker.
+- The results of each document are read by this script, once the worker and the
+  processes that it left behind are gone, and are sent to the host through the
+  standard output. The workers have no access to the standard streams of this script
+  (see `make_undumpable()`), or to any directory that the host reads.
+
+Each worker is started before its document is in place, so that it can load its
+modules in the meantime. For the same reason, the host may start a sandbox for a single
+document ahead of time, and keep it waiting for its input.
+
+Note that this script must run only inside the sandbox, since it kills processes and
+wipes directories.
+
+The standard output is split in frames, the same way as the output of the containers
+that convert a single document (see `stream.py`). The progress of each worker is
+wrapped in a JSON envelope that carries the index of the document (starting from 1),
+and the exit code of each worker is reported in a final envelope for each document:
+
+    {"document": 1, "status": "{\"error\": false, \"text\": ..., \"percentage\": 5}"}
+    {"document": 1, "error_code": 0}
+
+The data frames carry the index of each document that has been converted, followed by
+its pages (first stage) or by the size and the contents of its safe PDF (second stage).
+The first stage sends the pages in the same way as the disposable qubes do (see
+`doc_to_pixels_qubes_wrapper.py`), and the host relays them to the second stage, after
+checking them.
+"""
+
+import ctypes
+import json
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+from . import errors
+from .common import (
+    MAX_CAPTURED_OUTPUT,
+    STREAM_FRAME_DATA,
+    STREAM_FRAME_LOG,
+    STREAM_FRAME_PROGRESS,
+    get_oom_kill_count,
+    get_pixels_size,
+    killed_by_oom,
+    max_deflated_size,
+)
+from .pixels_to_pdf import check_page_dimensions
+from .stream import write_frames
+
+# Directories where a worker process can leave files behind. Their contents are wiped
+# before each document.
+SCRATCH_DIRS = [
+    "/tmp",
+    "/var/tmp",
+    "/dev/shm",
+    "/safezone",
+    os.path.expanduser("~"),
+]
+
+# The size (in bytes) of the header that precedes each document in the standard input
+# of the first stage.
+DOCUMENT_SIZE_LEN = 8
+
+# The size (in bytes) of the size of a safe PDF, in the standard output of the second
+# stage.
+SAFE_PDF_SIZE_LEN = 8
+
+# The size of the chunks in which files are copied from and to the standard streams.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# See prctl(2).
+PR_SET_DUMPABLE = 4
+
+
+def emit(document: int, **fields: object) -> None:
+    """Report something about a document to the host."""
+    payload = json.dumps({"document": document, **fields}).encode()
+    write_frames(STREAM_FRAME_PROGRESS, payload)
+
+
+def write_data(data: bytes) -> None:
+    write_frames(STREAM_FRAME_DATA, data)
+
+
+def write_int(num: int, size: int = 2) -> None:
+    write_data(num.to_bytes(size, signed=False))
+
+
+def make_undumpable() -> None:
+    """Keep the workers away from the file descriptors and the memory of this process.
+
+    The workers run as the same user as this process, so they could otherwise read the
+    documents that have not been handed out yet from its standard input, or write fake
+    reports to its standard output, through /proc. A process that is not dumpable can
+    only be inspected with CAP_SYS_PTRACE, which the sandbox does not have. The workers
+    themselves are dumpable, since they execute a new program.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_SET_DUMPABLE, 0, 0, 0, 0) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def wipe_scratch_dirs() -> None:
+    """Remove everything that a previous worker may have left behind."""
+    for scratch_dir in SCRATCH_DIRS:
+        if not os.path.isdir(scratch_dir):
+            continue
+        for entry in os.scandir(scratch_dir):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+def read_proc_stat(pid: int) -> List[str]:
+    """Get the fields of /proc/<pid>/stat that follow the command name.
+
+    The command name may contain spaces, but it is enclosed in parentheses.
+    """
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().rsplit(")", 1)[1].split()
+
+
+def get_ancestor_pids() -> Set[int]:
+    """Get the PIDs of this process and of its ancestors."""
+    pids = set()
+    pid = os.getpid()
+    while pid > 0 and pid not in pids:
+        pids.add(pid)
+        try:
+            # The parent PID is the 4th field.
+            pid = int(read_proc_stat(pid)[1])
+        except (OSError, IndexError, ValueError):
+            break
+    return pids
+
+
+def kill_stray_processes() -> None:
+    """Kill every process in the sandbox, except for this one and its ancestors.
+
+    A worker may leave processes behind (e.g., a LibreOffice daemon), either by design
+    or because the document exploited it. None of them should see the next document.
+    Processes may fork while they are killed, so this is repeated until there are none
+    left.
+    """
+    ancestors = get_ancestor_pids()
+    while True:
+        killed = False
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit() or int(entry) in ancestors:
+                continue
+            try:
+                if read_proc_stat(int(entry))[0] == "Z":
+                    # The process has exited, and waits to be reaped.
+                    continue
+                os.kill(int(entry), signal.SIGKILL)
+                killed = True
+            except (OSError, IndexError):
+                pass
+
+        # Reap the killed processes, in case they were reparented to this process.
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+
+        if not killed:
+            break
+
+
+def start_worker(module: str) -> subprocess.Popen:
+    """Start a conversion script, which waits until its input is in place.
+
+    The worker loads its modules while the runner waits for the input of the stage,
+    so that the conversion can start as soon as the input shows up.
+    """
+    env: Dict[str, str] = dict(os.environ)
+    # The worker receives the whole input of the stage at once.
+    env["PIPELINE"] = "0"
+    env["WAIT_FOR_INPUT"] = "1"
+    return subprocess.Popen(
+        [sys.executable, "-m", module],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+        start_new_session=True,
+    )
+
+
+def run_worker(document: int, proc: subprocess.Popen) -> int:
+    """Let a worker convert a document, and relay its progress.
+
+    Once the worker has exited, every process that it may have left behind is killed,
+    so that its output can no longer change.
+    """
+    assert proc.stdin is not None
+    assert proc.stdout is not None
+    oom_kill_count = get_oom_kill_count()
+    try:
+        proc.stdin.write(b"\n")
+        proc.stdin.close()
+    except BrokenPipeError:
+        # The worker has exited early, and its exit code will tell why.
+        pass
+    for line in proc.stdout:
+        emit(document, status=line.decode("ascii", errors="replace"))
+    ret = proc.wait()
+    kill_stray_processes()
+    if ret == -signal.SIGKILL and killed_by_oom(oom_kill_count):
+        # The kernel has killed the worker, because the sandbox ran out of memory.
+        ret = errors.OutOfMemoryException.error_code
+    return ret
+
+
+def open_dir(path: str) -> Optional[int]:
+    """Open a directory that a worker has written to, if it is still a directory."""
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+
+
+def open_output(dir_fd: int, name: str) -> Optional[BinaryIO]:
+    """Open a file that a worker has left behind, if it is a regular file.
+
+    A worker may replace its output with a symlink to a file that only this process
+    can read (e.g., its own standard input, under /proc), or with a FIFO that blocks
+    whoever opens it, so neither of them is opened.
+    """
+    try:
+        fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=dir_fd)
+    except OSError:
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        return None
+    return os.fdopen(fd, "rb")
+
+
+def read_number(dir_fd: int, name: str) -> int:
+    """Read a number that a worker has stored in a file."""
+    f = open_output(dir_fd, name)
+    if f is None:
+        raise errors.PageCountMismatch()
+    with f:
+        try:
+            return int(f.read(16).strip())
+        except ValueError:
+            raise errors.InvalidPixelData()
+
+
+def get_pages(dir_fd: int, compressed: bool) -> List[Tuple[int, int, int, int]]:
+    """Get the width, height, bit depth and data size of each page that a worker has
+    stored, the same way that the pixels-to-PDF stage reads them.
+
+    Raise a ConversionException if the next stage would reject them.
+    """
+    num_pages = len(
+        [n for n in os.listdir(dir_fd) if n.startswith("page-") and n.endswith(".rgb")]
+    )
+    if num_pages == 0:
+        raise errors.PageCountMismatch()
+    if num_pages > errors.MAX_PAGES:
+        raise errors.MaxPagesException()
+
+    pages = []
+    for page in range(1, num_pages + 1):
+        width = read_number(dir_fd, f"page-{page}.width")
+        height = read_number(dir_fd, f"page-{page}.height")
+        depth = read_number(dir_fd, f"page-{page}.depth")
+        check_page_dimensions(width, height, depth)
+        f = open_output(dir_fd, f"page-{page}.rgb")
+        if f is None:
+            raise errors.PageCountMismatch()
+        with f:
+            size = os.fstat(f.fileno()).st_size
+        pixels_size = get_pixels_size(width, height, depth)
+        if compressed and size > max_deflated_size(pixels_size):
+            raise errors.InvalidPixelData()
+        elif not compressed and size != pixels_size:
+            raise errors.InvalidPixelData()
+        pages.append((width, height, depth, size))
+    return pages
+
+
+def copy_to_stdout(f: Optional[BinaryIO], size: int) -> None:
+    """Send exactly `size` bytes of a file to the host, as data frames.
+
+    If the file is missing or shorter than expected, zeros are sent in its place, so
+    that the stream stays in sync. The data are then rejected by the next stage.
+    """
+    while size > 0:
+        chunk_size = min(size, COPY_CHUNK_SIZE)
+        chunk = f.read(chunk_size) if f is not None else b""
+        if not chunk:
+            chunk = bytes(chunk_size)
+        write_data(chunk)
+        size -= len(chunk)
+
+
+def send_pages(document: int, dir_fd: int, compressed: bool) -> None:
+    """Send the pages that a worker has stored to the host, if they are valid."""
+    pages = get_pages(dir_fd, compressed)
+    write_int(document)
+    write_int(len(pages))
+    for page, (width, height, depth, size) in enumerate(pages, start=1):
+        write_int(width)
+        write_int(height)
+        write_int(depth)
+        write_int(size, 4)
+        f = open_output(dir_fd, f"page-{page}.rgb")
+        try:
+            copy_to_stdout(f, size)
+        finally:
+            if f is not None:
+                f.close()
+
+
+def send_safe_pdf(document: int, dir_fd: int) -> None:
+    """Send the safe PDF that a worker has stored to the host."""
+    f = open_output(dir_fd, "safe-output-compressed.pdf")
+    if f is None:
+        raise errors.UnexpectedConversionError()
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        write_int(document)
+        write_int(size, SAFE_PDF_SIZE_LEN)
+        copy_to_stdout(f, size)
+
+
+def send_log(dir_fd: int) -> None:
+    """Send the debug log that a worker has stored to the host, if any."""
+    f = open_output(dir_fd, "captured_output.txt")
+    if f is None:
+        return
+    with f:
+        write_frames(STREAM_FRAME_LOG, f.read(MAX_CAPTURED_OUTPUT))
+
+
+def read_exactly(size: int) -> bytes:
+    """Read exactly `size` bytes from the standard input."""
+    data = sys.stdin.buffer.read(size)
+    if len(data) < size:
+        raise EOFError()
+    return data
+
+
+def read_int(size: int = 2) -> int:
+    return int.from_bytes(read_exactly(size), signed=False)
+
+
+def read_document(filename: str) -> bool:
+    """Read the next document from the standard input, and store it in a file."""
+    size_bytes = sys.stdin.buffer.read(DOCUMENT_SIZE_LEN)
+    if len(size_bytes) < DOCUMENT_SIZE_LEN:
+        return False
+    size = int.from_bytes(size_bytes, signed=False)
+    with open(filename, "wb") as f:
+        while size > 0:
+            chunk = sys.stdin.buffer.read(min(size, COPY_CHUNK_SIZE))
+            if not chunk:
+                return False
+            f.write(chunk)
+            size -= len(chunk)
+    return True
+
+
+def read_pixels(pixels_dir: str) -> Optional[int]:
+    """Read the pages of the next document from the standard input, and store them
+    the way that the doc-to-pixels stage does.
+
+    Return the index of the document, or None if the host has stopped sending
+    documents.
+    """
+    index_bytes = sys.stdin.buffer.read(2)
+    if not index_bytes:
+        return None
+    elif len(index_bytes) < 2:
+        raise EOFError()
+    document = int.from_bytes(index_bytes, signed=False)
+    num_pages = read_int()
+    for page in range(1, num_pages + 1):
+        filename_base = f"{pixels_dir}/page-{page}"
+        for extension in ("width", "height", "depth"):
+            with open(f"{filename_base}.{extension}", "w") as f:
+                f.write(str(read_int()))
+        size = read_int(4)
+        with open(f"{filename_base}.rgb", "wb") as f:
+            while size > 0:
+                chunk = read_exactly(min(size, COPY_CHUNK_SIZE))
+                f.write(chunk)
+                size -= len(chunk)
+    return document
+
+
+def doc_to_pixels(batch_size: int) -> int:
+    """Convert each document of the batch to pixels.
+
+    The pages of each document that has been converted are sent to the host, before
+    its error code.
+    """
+    compressed = os.environ.get("COMPRESS_PIXELS") == "1"
+    for document in range(1, batch_size + 1):
+        wipe_scratch_dirs()
+        os.mkdir("/tmp/dangerzone")
+        worker = start_worker("dangerzone.conversion.doc_to_pixels")
+        if not read_document("/tmp/input_file"):
+            # The host has stopped sending documents.
+            kill_stray_processes()
+            return 1
+
+        ret = run_worker(document, worker)
+
+        dir_fd = open_dir("/tmp/dangerzone")
+        try:
+            if dir_fd is None:
+                raise errors.PageCountMismatch()
+            send_log(dir_fd)
+            if ret == 0:
+                send_pages(document, dir_fd, compressed)
+        except errors.ConversionException as e:
+            ret = ret or e.error_code
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+        emit(document, error_code=ret)
+
+    wipe_scratch_dirs()
+    return 0
+
+
+def pixels_to_pdf(batch_size: int) -> int:
+    """Convert the pages of each document that the host sends to a safe PDF.
+
+    The safe PDF of each document that has been converted is sent to the host, before
+    its error code.
+    """
+    for _ in range(batch_size):
+        wipe_scratch_dirs()
+        os.mkdir("/tmp/dangerzone")
+        worker = start_worker("dangerzone.conversion.pixels_to_pdf")
+        try:
+            document = read_pixels("/tmp/dangerzone")
+        except EOFError:
+            # The host has stopped sending pages in the middle of a document.
+            kill_stray_processes()
+            return 1
+        if document is None:
+            # The host has no more documents for this stage.
+            break
+
+        ret = run_worker(document, worker)
+
+        dir_fd = open_dir("/safezone")
+        try:
+            if dir_fd is None:
+                raise errors.UnexpectedConversionError()
+            send_log(dir_fd)
+            if ret == 0:
+                send_safe_pdf(document, dir_fd)
+        except errors.ConversionException as e:
+            ret = ret or e.error_code
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+        emit(document, error_code=ret)
+
+    kill_stray_processes()
+    wipe_scratch_dirs()
+    return 0
+
+
+def main(args: List[str]) -> int:
+    batch_size = int(os.environ["BATCH_SIZE"])
+    stages = {"doc_to_pixels": doc_to_pixels, "pixels_to_pdf": pixels_to_pdf}
+    if len(args) != 1 or args[0] not in stages:
+        print(f"Usage: batch.py {{{','.join(stages)}}}", file=sys.stderr)
+        return 2
+    make_undumpable()
+    return stages[args[0]](batch_size)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
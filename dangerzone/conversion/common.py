@@ -1,21 +1,84 @@
 #!/usr/bin/env python3
 
 import asyncio
+import concurrent.futures
 import glob
 import json
 import os
 import re
 import shutil
+import signal
 import subprocess
 import sys
 import time
+import zlib
 from abc import abstractmethod
-from typing import Callable, Dict, List, Optional, Tuple, Union
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from . import errors
 
 TIMEOUT_PER_PAGE: float = 30  # (seconds)
 TIMEOUT_PER_MB: float = 30  # (seconds)
 TIMEOUT_MIN: float = 60  # (seconds)
 DEFAULT_DPI = 150  # Pixels per inch
+MIN_DPI = 36  # Pixels per inch
+MAX_DPI = 600  # Pixels per inch
+# The resolutions (in pixels per inch) that users can pick, depending on whether they
+# care more about the conversion speed or the quality of the safe PDF.
+QUALITY_PRESETS: Dict[str, int] = {
+    "fast": 96,
+    "standard": DEFAULT_DPI,
+    "archival": 300,
+}
+# The resolution (in pixels per inch) and the number of pages of a preview, which is a
+# quick look at the first pages of a document, before converting it in full.
+PREVIEW_DPI = 48
+PREVIEW_PAGES = 3
+PIPELINE_POLL_INTERVAL: float = 0.1  # (seconds)
+# The maximum size of the output of the commands that a converter keeps for debugging.
+MAX_CAPTURED_OUTPUT = 1024 * 1024  # (bytes)
+
+# A range of pages in a selection of pages, e.g., "3", "3-5" or "3-".
+PAGE_RANGE_RE = re.compile(r"([0-9]+)(-([0-9]*))?")
+# The maximum size of a selection of pages, which is sent to the disposable qube after
+# its size, in 2 bytes.
+MAX_PAGES_SIZE = 2**16 - 1  # (bytes)
+
+# When the conversion stages run as a pipeline, the existence of this file in the pixels
+# directory signals the pixels-to-PDF stage that the doc-to-pixels stage has exited, and
+# that no more pages will show up.
+DOC_TO_PIXELS_EXITED_FILENAME = "doc_to_pixels_exited"
+
+# The events of the memory controller of the cgroup of the sandbox, which count the
+# processes that the kernel has killed because the sandbox ran out of memory.
+MEMORY_EVENTS_FILENAME = "/sys/fs/cgroup/memory.events"
+
+# When the conversion stages stream their output (see `dangerzone/conversion/stream.py`),
+# they split it in frames, so that their progress reports travel along with their data.
+# Each frame is a tag, the size of its payload, and the payload itself. Larger payloads
+# are split in many frames.
+STREAM_FRAME_DATA = b"d"
+STREAM_FRAME_PROGRESS = b"p"
+STREAM_FRAME_LOG = b"l"
+STREAM_FRAME_SIZE_LEN = 4
+MAX_STREAM_FRAME_SIZE = 1024 * 1024  # (bytes)
+
+# Pages are mostly white space, so even the fastest compression level shrinks them
+# considerably, without slowing down the conversion.
+PIXELS_COMPRESSION_LEVEL = 1
+
+# The bit depths that the pixels of a page can have, when they cross the sanitization
+# boundary. Pages that contain only shades of gray, or only black and white, travel
+# with one channel, or one bit per pixel respectively, instead of three RGB channels.
+DEPTH_RGB = 24
+DEPTH_GRAYSCALE = 8
+DEPTH_BILEVEL = 1
+PAGE_DEPTHS = (DEPTH_RGB, DEPTH_GRAYSCALE, DEPTH_BILEVEL)
+
+# Translation tables between bilevel grayscale pixels and bits, where black pixels are
+# 0 and white pixels are 1.
+_BILEVEL_TO_BIT = bytes.maketrans(b"\xff", b"\x01")
+_BIT_TO_BILEVEL = bytes.maketrans(b"\x01", b"\xff")
 
 
 def running_on_qubes() -> bool:
@@ -23,28 +86,239 @@ def running_on_qubes() -> bool:
     return os.path.exists("/usr/share/qubes/marker-vm")
 
 
-def calculate_timeout(size: float, pages: Optional[float] = None) -> float:
+def calculate_timeout(
+    size: float, pages: Optional[float] = None, dpi: int = DEFAULT_DPI
+) -> float:
     """Calculate the timeout for a command.
 
-    The timeout calculation takes two factors in mind:
+    The timeout calculation takes three factors in mind:
 
     1. The size (in MiBs) of the dataset (document, multiple pages).
     2. The number of pages in the dataset.
+    3. The resolution that the pages are rendered in.
 
     It then calculates proportional timeout values based on the above, and keeps the
     large one.  This way, we can handle several corner cases:
 
     * Documents with lots of pages, but small file size.
     * Single images with large file size.
+
+    The time it takes to process a page grows with the number of its pixels, i.e.,
+    with the square of the resolution. Resolutions lower than the default one keep the
+    default per-page timeout though, since not every step of the conversion gets
+    faster with fewer pixels.
     """
     # Do not have timeouts lower than 10 seconds, if the file size is small, since
     # we need to take into account the program's startup time as well.
     timeout = max(TIMEOUT_PER_MB * size, TIMEOUT_MIN)
     if pages:
-        timeout = max(timeout, TIMEOUT_PER_PAGE * pages)
+        dpi_factor = max((dpi / DEFAULT_DPI) ** 2, 1.0)
+        timeout = max(timeout, TIMEOUT_PER_PAGE * pages * dpi_factor)
     return timeout
 
 
+def parse_pages(pages: str) -> List[Tuple[int, Optional[int]]]:
+    """Parse a selection of pages, such as "1-3,7,10-".
+
+    Return the inclusive ranges of page numbers, which start at 1. Ranges without an end
+    extend to the last page of the document.
+
+    :raises ValueError: if the selection is not valid
+    """
+    if len(pages.encode()) > MAX_PAGES_SIZE:
+        raise ValueError("The selection of pages is too long")
+    ranges: List[Tuple[int, Optional[int]]] = []
+    for part in pages.replace(" ", "").split(","):
+        match = PAGE_RANGE_RE.fullmatch(part)
+        if match is None:
+            raise ValueError(f"Invalid page range '{part}'")
+        first = int(match.group(1))
+        last = first if match.group(2) is None else None
+        if match.group(3):
+            last = int(match.group(3))
+        if first < 1 or (last is not None and last < first):
+            raise ValueError(f"Invalid page range '{part}'")
+        ranges.append((first, last))
+    return ranges
+
+
+def select_pages(pages: Optional[str], page_count: int) -> List[int]:
+    """Get the indices of the selected pages of a document, in page order.
+
+    Pages past the end of the document are ignored. If no pages are selected, all of
+    the pages are.
+    """
+    if not pages:
+        return list(range(page_count))
+    selected: Set[int] = set()
+    for first, last in parse_pages(pages):
+        last = page_count if last is None else min(last, page_count)
+        selected.update(range(first - 1, last))
+    return sorted(selected)
+
+
+def deflate_pixels(pixels: bytes) -> bytes:
+    """Compress the pixels of a page, before they cross the sanitization boundary."""
+    return zlib.compress(pixels, PIXELS_COMPRESSION_LEVEL)
+
+
+def max_deflated_size(size: int) -> int:
+    """Get the maximum size that a compressed buffer of `size` bytes can have.
+
+    This is the same upper bound that zlib's `compressBound()` function calculates.
+    """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def inflate_pixels(untrusted_data: Union[bytes, memoryview], size: int) -> bytes:
+    """Decompress the pixels of a page, and ensure that they have the expected size.
+
+    The decompression never produces more than `size` bytes, so a malicious page cannot
+    make us allocate more memory than a legitimate page of the same dimensions would.
+    If the decompressed data are not exactly `size` bytes long, or the compressed
+    stream is malformed, an InvalidPixelData exception is raised.
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        pixels = decompressor.decompress(untrusted_data, size)
+        if not decompressor.eof:
+            # We may have stopped right before the end of the stream. Consume the rest
+            # of it, and ensure that it does not contain any more pixels.
+            if decompressor.decompress(decompressor.unconsumed_tail, 1):
+                raise errors.InvalidPixelData()
+    except zlib.error as e:
+        raise errors.InvalidPixelData() from e
+
+    if len(pixels) != size or not decompressor.eof or decompressor.unused_data:
+        raise errors.InvalidPixelData()
+    return pixels
+
+
+def max_rendered_pages(workers: int) -> int:
+    """Get how many rendered pages the doc-to-pixels stage holds in memory at most.
+
+    Each render worker holds the page that it renders, and the stage holds one more,
+    which it sends to the next stage in the meantime.
+    """
+    return workers + 1
+
+
+def get_pixels_size(width: int, height: int, depth: int) -> int:
+    """Get the size (in bytes) of the pixels of a page, for the given bit depth."""
+    return (width * height * depth + 7) // 8
+
+
+def pack_bits(gray: bytes) -> bytes:
+    """Pack bilevel grayscale pixels (0x00 or 0xff) into one bit per pixel.
+
+    The bits are packed in big-endian order, and the last byte is padded with zeros.
+    """
+    bits = gray.translate(_BILEVEL_TO_BIT) + bytes(-len(gray) % 8)
+    size = len(bits) // 8
+    # Take every 8th pixel, starting from each bit of a byte, as a big number whose
+    # bytes are 0 or 1, and shift it into place. The bytes never carry into each
+    # other, so the numbers can be combined in one go.
+    packed = 0
+    for bit in range(8):
+        packed |= int.from_bytes(bits[bit::8], "big") << (7 - bit)
+    return packed.to_bytes(size, "big")
+
+
+def unpack_bits(packed: bytes, num_pixels: int) -> bytes:
+    """Unpack one bit per pixel into `num_pixels` grayscale pixels (0x00 or 0xff).
+
+    The packed pixels must be exactly as long as `num_pixels` requires, and their
+    padding bits must be zeros. Otherwise, an InvalidPixelData exception is raised.
+    """
+    size = len(packed)
+    if size != get_pixels_size(num_pixels, 1, DEPTH_BILEVEL):
+        raise errors.InvalidPixelData()
+    if size and packed[-1] & (0xFF >> (num_pixels - (size - 1) * 8)):
+        raise errors.InvalidPixelData()
+
+    number = int.from_bytes(packed, "big")
+    ones = int.from_bytes(b"\x01" * size, "big")
+    bits = bytearray(size * 8)
+    for bit in range(8):
+        bits[bit::8] = ((number >> (7 - bit)) & ones).to_bytes(size, "big")
+    del bits[num_pixels:]
+    return bytes(bits.translate(_BIT_TO_BILEVEL))
+
+
+def reduce_colorspace(rgb: bytes) -> Tuple[int, bytes]:
+    """Find the smallest bit depth that can hold the pixels of a page losslessly.
+
+    Return the bit depth, and the pixels in that depth. Pages where every pixel has
+    equal RGB channels are converted to grayscale, and grayscale pages that have only
+    black and white pixels are further packed into one bit per pixel.
+    """
+    gray = rgb[0::3]
+    if gray != rgb[1::3] or gray != rgb[2::3]:
+        return DEPTH_RGB, rgb
+    if gray.translate(None, b"\x00\xff"):
+        return DEPTH_GRAYSCALE, gray
+    return DEPTH_BILEVEL, pack_bits(gray)
+
+
+def wait_for_input() -> None:
+    """Wait until the batch runner signals that the input of this stage is in place.
+
+    The batch runner starts each worker before its input is in place, so that the
+    worker loads its heavy modules in the meantime. Workers that run on their own
+    return right away.
+    """
+    if os.environ.get("WAIT_FOR_INPUT") != "1":
+        return
+    import fitz  # noqa: F401
+
+    sys.stdin.buffer.read(1)
+
+
+def get_oom_kill_count() -> Optional[int]:
+    """Get how many processes the kernel has killed in the sandbox, because it ran out
+    of memory, if the cgroup of the sandbox tells (cgroups v2 only)."""
+    try:
+        with open(MEMORY_EVENTS_FILENAME) as f:
+            for line in f:
+                key, _, value = line.partition(" ")
+                if key == "oom_kill":
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def killed_by_oom(oom_kill_count: Optional[int]) -> bool:
+    """Check if a process that has been killed with SIGKILL ran out of memory.
+
+    This is the case if the kernel has killed a process in the sandbox since it counted
+    `oom_kill_count` of them (see `get_oom_kill_count()`). If the count is unknown, the
+    kernel is assumed to have killed it, since nothing else in the sandbox does.
+    """
+    if oom_kill_count is None:
+        return True
+    count = get_oom_kill_count()
+    return count is None or count > oom_kill_count
+
+
+async def shutdown_executor(
+    executor: concurrent.futures.Executor, pending: Iterable[object]
+) -> None:
+    """Cancel the tasks that have not started yet, and wait for the rest to finish.
+
+    The executor is shut down in a thread, so that the event loop keeps running while
+    the tasks finish. Python 3.8 lacks the `cancel_futures` argument of `shutdown()`,
+    so the pending futures are cancelled here instead.
+    """
+    for future in pending:
+        if isinstance(future, asyncio.Future):
+            future.cancel()
+    # The cancellation reaches the futures of the executor through callbacks of the
+    # event loop, which have to run before the executor is shut down.
+    await asyncio.sleep(0)
+    await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+
 def get_tessdata_dir() -> str:
     if running_on_qubes():
         return "/usr/share/tesseract/tessdata/"
@@ -52,11 +326,76 @@ def get_tessdata_dir() -> str:
         return "/usr/share/tessdata/"
 
 
+class OutputCapture:
+    """Capture the output of commands, up to a limit.
+
+    Commands such as LibreOffice and Tesseract may print megabytes of output. Only the
+    first and the last `limit / 2` bytes of it are kept, since they are the most useful
+    for debugging, and the last ones are stored in a ring buffer. The bytes in between
+    are dropped, and counted.
+    """
+
+    def __init__(self, limit: int = MAX_CAPTURED_OUTPUT) -> None:
+        if limit < 2:
+            raise ValueError(f"Expected a limit of at least 2 bytes (got {limit})")
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray(self.tail_limit)
+        self.tail_pos = 0
+        self.tail_written = 0
+        self.total = 0
+
+    @property
+    def dropped(self) -> int:
+        """The number of bytes that have been dropped so far."""
+        return self.total - len(self.head) - min(self.tail_written, self.tail_limit)
+
+    def write(self, data: bytes) -> None:
+        self.total += len(data)
+        n_head = min(len(data), self.head_limit - len(self.head))
+        if n_head > 0:
+            self.head += data[:n_head]
+        rest = memoryview(data)[n_head:]
+        if not rest:
+            return
+
+        # Only the last bytes of the data can end up in the ring buffer.
+        self.tail_written += len(rest)
+        rest = rest[-self.tail_limit :]
+        n_end = min(len(rest), self.tail_limit - self.tail_pos)
+        self.tail[self.tail_pos : self.tail_pos + n_end] = rest[:n_end]
+        self.tail[: len(rest) - n_end] = rest[n_end:]
+        self.tail_pos = (self.tail_pos + len(rest)) % self.tail_limit
+
+    def getvalue(self) -> bytes:
+        """Get the captured output, with a note about the bytes that were dropped."""
+        if self.tail_written <= self.tail_limit:
+            tail = self.tail[: self.tail_written]
+        else:
+            tail = self.tail[self.tail_pos :] + self.tail[: self.tail_pos]
+        note = b""
+        if self.dropped:
+            note = f"\n[... {self.dropped} bytes dropped ...]\n".encode()
+        return bytes(self.head + note + tail)
+
+
 class DangerzoneConverter:
-    def __init__(self, progress_callback: Optional[Callable] = None) -> None:
+    def __init__(
+        self,
+        progress_callback: Optional[Callable] = None,
+        capture_limit: int = MAX_CAPTURED_OUTPUT,
+    ) -> None:
         self.percentage: float = 0.0
         self.progress_callback = progress_callback
-        self.captured_output: bytes = b""
+        self.capture_limit = capture_limit
+        self.output = OutputCapture(capture_limit)
+        self.dpi = DEFAULT_DPI
+
+    @property
+    def captured_output(self) -> bytes:
+        """The output of the commands that the converter has run so far."""
+        return self.output.getvalue()
 
     async def read_stream(
         self, sr: asyncio.StreamReader, callback: Optional[Callable] = None
@@ -69,15 +408,18 @@ class DangerzoneConverter:
         Note that the lines are in bytes, since we can't assume that all command output will
         be UTF-8 encoded. Higher level commands are advised to decode the output to Unicode,
         if they know its encoding.
+
+        The output is bounded in the same way as the captured output of the converter
+        (see `OutputCapture`).
         """
-        buf = b""
+        buf = OutputCapture(self.capture_limit)
         while not sr.at_eof():
             line = await sr.readline()
-            self.captured_output += line
+            self.output.write(line)
             if callback is not None:
                 await callback(line)
-            buf += line
-        return buf
+            buf.write(line)
+        return buf.getvalue()
 
     async def run_command(
         self,
@@ -94,11 +436,14 @@ class DangerzoneConverter:
         Run a command using asyncio.subprocess, consume its standard streams, and return its
         output in bytes.
 
+        :raises OutOfMemoryException: if the kernel kills the process with SIGKILL,
+          because the sandbox has run out of memory
         :raises RuntimeError: if the process returns a non-zero exit status
         :raises TimeoutError: if the process times out
         """
         # Start the provided command, and return a handle. The command will run in the
         # background.
+        oom_kill_count = get_oom_kill_count()
         proc = await asyncio.subprocess.create_subprocess_exec(
             *args,
             stdout=asyncio.subprocess.PIPE,
@@ -107,7 +452,7 @@ class DangerzoneConverter:
 
         # Log command to debug log so we can trace back which errors
         # are from each command
-        self.captured_output += f"[COMMAND] {' '.join(args)}\n".encode()
+        self.output.write(f"[COMMAND] {' '.join(args)}\n".encode())
 
         assert proc.stdout is not None
         assert proc.stderr is not None
@@ -127,6 +472,8 @@ class DangerzoneConverter:
             ret = await asyncio.wait_for(proc.wait(), timeout=timeout)
         except asyncio.exceptions.TimeoutError:
             raise TimeoutError(timeout_message)
+        if ret == -signal.SIGKILL and killed_by_oom(oom_kill_count):
+            raise errors.OutOfMemoryException()
         if ret != 0:
             raise RuntimeError(error_message)
 
@@ -143,7 +490,7 @@ class DangerzoneConverter:
         if not int(os.environ.get("ENABLE_TIMEOUTS", 1)):
             return None
 
-        return calculate_timeout(size, pages)
+        return calculate_timeout(size, pages, self.dpi)
 
     @abstractmethod
     async def convert(self) -> None:
@@ -8,21 +8,89 @@ Here are the steps, with progress bar percentages:
 """
 
 import asyncio
+import collections
+import concurrent.futures
 import glob
 import os
 import re
 import shutil
+import subprocess
 import sys
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
 
 import fitz
 import magic
 
 from . import errors
-from .common import DEFAULT_DPI, DangerzoneConverter, running_on_qubes
+from .common import (
+    DEFAULT_DPI,
+    DEPTH_RGB,
+    DangerzoneConverter,
+    deflate_pixels,
+    reduce_colorspace,
+    running_on_qubes,
+    select_pages,
+    shutdown_executor,
+    wait_for_input,
+)
+from .libreoffice import (
+    LIBREOFFICE_PROFILE_DIR,
+    get_convert_to_arg,
+    get_profile_args,
+    start_warm_libreoffice,
+    stop_warm_libreoffice,
+)
+
+# The document that a render worker process renders the pages of (see
+# `open_worker_document()`).
+worker_document: Optional[fitz.Document] = None
+
+
+def encode_page(pix: fitz.Pixmap, reduce: bool, compress: bool) -> Tuple[int, bytes]:
+    """Encode the pixels of a rendered page, so that they can cross the boundary.
+
+    If requested, the pixels are first reduced to the smallest bit depth that holds
+    them losslessly, and then compressed. Return the bit depth and the encoded pixels.
+    """
+    if reduce:
+        depth, pixels = reduce_colorspace(pix.samples)
+        return depth, deflate_pixels(pixels) if compress else pixels
+    return DEPTH_RGB, deflate_pixels(pix.samples_mv) if compress else pix.samples
+
+
+def open_worker_document(filename: str, filetype: Optional[str]) -> None:
+    """Open the document in a render worker process.
+
+    This runs once in each worker process, so that the document is not opened again for
+    every page that the worker renders.
+    """
+    global worker_document
+    worker_document = fitz.open(filename, filetype=filetype)
+
+
+def render_page(
+    index: int, dpi: int, reduce: bool, compress: bool
+) -> Tuple[int, int, int, bytes]:
+    """Render a page of the document of a render worker process into pixels.
+
+    It returns the width, height, bit depth and pixels of the page with the given
+    index. The pixels are encoded in the worker process as well (see `encode_page()`).
+    """
+    assert worker_document is not None
+    pix = worker_document[index].get_pixmap(dpi=dpi)
+    depth, pixels = encode_page(pix, reduce, compress)
+    return pix.width, pix.height, depth, pixels
 
 
 class DocumentToPixels(DangerzoneConverter):
+    # A LibreOffice instance that has been started before the document arrived (see
+    # `main()`), and converts it to PDF if it is an Office document.
+    warm_libreoffice: Optional[subprocess.Popen] = None
+
+    # Whether the pages are streamed to the caller by the write_page_* functions below,
+    # instead of being written to files.
+    streams_pages = False
+
     # XXX: These functions write page data and metadata to a separate file. For now,
     # they act as an anchor point for Qubes to stream back page data/metadata in
     # real time. In the future, they will be completely replaced by their streaming
@@ -40,65 +108,97 @@ class DocumentToPixels(DangerzoneConverter):
         with open(filename, "w") as f:
             f.write(str(height))
 
+    async def write_page_depth(self, depth: int, filename: str) -> None:
+        with open(filename, "w") as f:
+            f.write(str(depth))
+
     async def write_page_data(self, data: bytes, filename: str) -> None:
-        with open(filename, "wb") as f:
+        # Write the page data under a temporary name first, and then rename it. This
+        # way, a page is visible with its final name only once it has been fully
+        # written, which is what the next stage waits for when the stages are
+        # pipelined.
+        part_filename = f"{filename}.part"
+        with open(part_filename, "wb") as f:
             f.write(data)
+        os.replace(part_filename, filename)
 
-    async def convert(self) -> None:
+    async def convert(
+        self,
+        render_workers: int = 1,
+        pipeline: bool = False,
+        reduce_colorspace: bool = False,
+        compress: bool = False,
+        dpi: int = DEFAULT_DPI,
+        pages: Optional[str] = None,
+    ) -> None:
+        self.dpi = dpi
         conversions: Dict[str, Dict[str, Optional[str]]] = {
             # .pdf
             "application/pdf": {"type": None},
             # .docx
             "application/vnd.openxmlformats-officedocument.wordprocessingml.document": {
                 "type": "libreoffice",
+                "pdf_filter": "writer_pdf_Export",
             },
             # .doc
             "application/msword": {
                 "type": "libreoffice",
+                "pdf_filter": "writer_pdf_Export",
             },
             # .docm
             "application/vnd.ms-word.document.macroEnabled.12": {
                 "type": "libreoffice",
+                "pdf_filter": "writer_pdf_Export",
             },
             # .xlsx
             "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": {
                 "type": "libreoffice",
+                "pdf_filter": "calc_pdf_Export",
             },
             # .xls
             "application/vnd.ms-excel": {
                 "type": "libreoffice",
+                "pdf_filter": "calc_pdf_Export",
             },
             # .pptx
             "application/vnd.openxmlformats-officedocument.presentationml.presentation": {
                 "type": "libreoffice",
+                "pdf_filter": "impress_pdf_Export",
             },
             # .ppt
             "application/vnd.ms-powerpoint": {
                 "type": "libreoffice",
+                "pdf_filter": "impress_pdf_Export",
             },
             # .odt
             "application/vnd.oasis.opendocument.text": {
                 "type": "libreoffice",
+                "pdf_filter": "writer_pdf_Export",
             },
             # .odg
             "application/vnd.oasis.opendocument.graphics": {
                 "type": "libreoffice",
+                "pdf_filter": "draw_pdf_Export",
             },
             # .odp
             "application/vnd.oasis.opendocument.presentation": {
                 "type": "libreoffice",
+                "pdf_filter": "impress_pdf_Export",
             },
             # .ods
             "application/vnd.oasis.opendocument.spreadsheet": {
                 "type": "libreoffice",
+                "pdf_filter": "calc_pdf_Export",
             },
             # .ods / .ots
             "application/vnd.oasis.opendocument.spreadsheet-template": {
                 "type": "libreoffice",
+                "pdf_filter": "calc_pdf_Export",
             },
             # .odt / .ott
             "application/vnd.oasis.opendocument.text-template": {
                 "type": "libreoffice",
+                "pdf_filter": "writer_pdf_Export",
             },
             # .hwp
             # Commented MIMEs are not used in `file` and don't conform to the rules.
@@ -114,6 +214,7 @@ class DocumentToPixels(DangerzoneConverter):
             # },
             "application/x-hwp": {
                 "type": "libreoffice",
+                "pdf_filter": "writer_pdf_Export",
                 "libreoffice_ext": "h2orestart.oxt",
             },
             # .hwpx
@@ -127,10 +228,12 @@ class DocumentToPixels(DangerzoneConverter):
             # },
             "application/x-hwp+zip": {
                 "type": "libreoffice",
+                "pdf_filter": "writer_pdf_Export",
                 "libreoffice_ext": "h2orestart.oxt",
             },
             "application/hwp+zip": {
                 "type": "libreoffice",
+                "pdf_filter": "writer_pdf_Export",
                 "libreoffice_ext": "h2orestart.oxt",
             },
             # At least .odt, .docx, .odg, .odp, .ods, and .pptx
@@ -171,11 +274,21 @@ class DocumentToPixels(DangerzoneConverter):
             if file_type == hwpx_file_type:
                 mime_type = "application/x-hwp+zip"
 
-        # Convert input document to PDF
+        # Reject documents that are too large, before converting them
         conversion = conversions[mime_type]
+        size = os.path.getsize("/tmp/input_file")
+        if size > errors.MAX_INPUT_SIZE:
+            raise errors.MaxInputSizeException()
+        uses_libreoffice = conversion["type"] == "libreoffice"
+        if uses_libreoffice and size > errors.MAX_LIBREOFFICE_INPUT_SIZE:
+            raise errors.MaxLibreofficeInputSizeException()
+
+        # Convert input document to PDF
         if conversion["type"] is None:
+            doc_filename = "/tmp/input_file"
+            doc_filetype: Optional[str] = mime_type
             try:
-                doc = fitz.open("/tmp/input_file", filetype=mime_type)
+                doc = fitz.open(doc_filename, filetype=doc_filetype)
             except (ValueError, fitz.FileDataError):
                 raise errors.DocCorruptedException()
         elif conversion["type"] == "libreoffice":
@@ -186,91 +299,206 @@ class DocumentToPixels(DangerzoneConverter):
             #     https://github.com/freedomofpress/dangerzone/issues/498
             if libreoffice_ext == "h2orestart.oxt" and running_on_qubes():
                 raise errors.DocFormatUnsupportedHWPQubes()
-            if libreoffice_ext:
-                await self.install_libreoffice_ext(libreoffice_ext)
             self.update_progress("Converting to PDF using LibreOffice")
-            args = [
-                "libreoffice",
-                "--headless",
-                "--safe-mode",
-                "--convert-to",
-                "pdf",
-                "--outdir",
-                "/tmp",
-                "/tmp/input_file",
-            ]
-            await self.run_command(
-                args,
-                error_message="Conversion to PDF with LibreOffice failed",
-            )
-            pdf_filename = "/tmp/input_file.pdf"
+            if not await self.convert_with_warm_libreoffice():
+                args = [
+                    "libreoffice",
+                    "--headless",
+                    "--safe-mode",
+                    *get_profile_args(LIBREOFFICE_PROFILE_DIR),
+                    "--convert-to",
+                    get_convert_to_arg(conversion.get("pdf_filter")),
+                    "--outdir",
+                    "/tmp",
+                    "/tmp/input_file",
+                ]
+                await self.run_command(
+                    args,
+                    error_message="Conversion to PDF with LibreOffice failed",
+                )
+            doc_filename = "/tmp/input_file.pdf"
+            doc_filetype = None
             # XXX: Sometimes, LibreOffice can fail with status code 0. So, we need to
             # always check if the file exists. See:
             #
             #     https://github.com/freedomofpress/dangerzone/issues/494
-            if not os.path.exists(pdf_filename):
+            if not os.path.exists(doc_filename):
                 raise errors.LibreofficeFailure()
             try:
-                doc = fitz.open(pdf_filename)
+                doc = fitz.open(doc_filename)
             except (ValueError, fitz.FileDataError):
                 raise errors.DocCorruptedException()
         else:
             # NOTE: This should never be reached
             raise errors.DocFormatUnsupported()
         self.percentage += 3
+        # The document is a PDF by now, so LibreOffice should not use up the memory of
+        # the sandbox while the pages are rendered.
+        self.stop_warm_libreoffice()
 
-        # Obtain number of pages
+        # Obtain number of pages, and keep only the selected ones
         if doc.page_count > errors.MAX_PAGES:
             raise errors.MaxPagesException()
-        await self.write_page_count(doc.page_count)
+        page_indices = select_pages(pages, doc.page_count)
+        if not page_indices:
+            raise errors.NoSelectedPagesException()
+        page_count = len(page_indices)
+        await self.write_page_count(page_count)
+
+        # When the stages are pipelined, write the pages straight into the output
+        # directory, so that the next stage can pick them up as soon as they are ready.
+        if pipeline:
+            out_dir = "/tmp/dangerzone"
+            with open(f"{out_dir}/page_count.part", "w") as f:
+                f.write(str(page_count))
+            os.replace(f"{out_dir}/page_count.part", f"{out_dir}/page_count")
+        else:
+            out_dir = "/tmp"
+
+        if render_workers > 1 and page_count > 1:
+            rendered_pages = self.render_pages_parallel(
+                doc_filename,
+                doc_filetype,
+                page_indices,
+                render_workers,
+                reduce_colorspace,
+                compress,
+            )
+        else:
+            rendered_pages = self.render_pages_serial(
+                doc, page_indices, reduce_colorspace, compress
+            )
 
-        percentage_per_page = 45.0 / doc.page_count
-        page_base = "/tmp/page"
-        for page in doc.pages():
-            # TODO check if page.number is doc-controlled
-            page_num = page.number + 1  # pages start in 1
+        # The selected pages are numbered from 1 onwards, like the pages of a whole
+        # document, so that the next stage sees a document of `page_count` pages.
+        percentage_per_page = 45.0 / page_count
+        page_base = f"{out_dir}/page"
+        async for page_num, width, height, depth, pixels in rendered_pages:
             rgb_filename = f"{page_base}-{page_num}.rgb"
             width_filename = f"{page_base}-{page_num}.width"
             height_filename = f"{page_base}-{page_num}.height"
+            depth_filename = f"{page_base}-{page_num}.depth"
 
             self.percentage += percentage_per_page
-            self.update_progress(
-                f"Converting page {page_num}/{doc.page_count} to pixels"
-            )
-            pix = page.get_pixmap(dpi=DEFAULT_DPI)
-            rgb_buf = pix.samples_mv
-            await self.write_page_width(pix.width, width_filename)
-            await self.write_page_height(pix.height, height_filename)
-            await self.write_page_data(rgb_buf, rgb_filename)
+            self.update_progress(f"Converting page {page_num}/{page_count} to pixels")
+            await self.write_page_width(width, width_filename)
+            await self.write_page_height(height, height_filename)
+            await self.write_page_depth(depth, depth_filename)
+            await self.write_page_data(pixels, rgb_filename)
 
         final_files = (
-            glob.glob("/tmp/page-*.rgb")
-            + glob.glob("/tmp/page-*.width")
-            + glob.glob("/tmp/page-*.height")
+            glob.glob(f"{page_base}-*.rgb")
+            + glob.glob(f"{page_base}-*.width")
+            + glob.glob(f"{page_base}-*.height")
+            + glob.glob(f"{page_base}-*.depth")
         )
 
         # XXX: Sanity check to avoid situations like #560.
-        if not running_on_qubes() and len(final_files) != 3 * doc.page_count:
+        if not self.streams_pages and len(final_files) != 4 * page_count:
             raise errors.PageCountMismatch()
 
         # Move converted files into /tmp/dangerzone
-        for filename in final_files:
-            shutil.move(filename, "/tmp/dangerzone")
+        if not pipeline:
+            for filename in final_files:
+                shutil.move(filename, "/tmp/dangerzone")
 
         self.update_progress("Converted document to pixels")
 
-    async def install_libreoffice_ext(self, libreoffice_ext: str) -> None:
-        self.update_progress(f"Installing LibreOffice extension '{libreoffice_ext}'")
-        unzip_args = [
-            "unzip",
-            "-d",
-            f"/usr/lib/libreoffice/share/extensions/{libreoffice_ext}/",
-            f"/libreoffice_ext/{libreoffice_ext}",
-        ]
-        await self.run_command(
-            unzip_args,
-            error_message="LibreOffice extension installation failed (unzipping)",
+    async def render_pages_serial(
+        self, doc: fitz.Document, page_indices: List[int], reduce: bool, compress: bool
+    ) -> AsyncIterator[Tuple[int, int, int, int, bytes]]:
+        """Render the pages of a document one by one, in the current process."""
+        for page_num, index in enumerate(page_indices, start=1):  # pages start in 1
+            pix = doc[index].get_pixmap(dpi=self.dpi)
+            depth, pixels = encode_page(pix, reduce, compress)
+            yield page_num, pix.width, pix.height, depth, pixels
+
+    async def render_pages_parallel(
+        self,
+        filename: str,
+        filetype: Optional[str],
+        page_indices: List[int],
+        workers: int,
+        reduce: bool,
+        compress: bool,
+    ) -> AsyncIterator[Tuple[int, int, int, int, bytes]]:
+        """Render the pages of a document using a pool of worker processes.
+
+        Each worker process opens the document on its own and renders one page at a
+        time. The rendered pages are yielded in page order, regardless of the order in
+        which the workers finish.
+        """
+        loop = asyncio.get_running_loop()
+        indices = iter(page_indices)
+        pending: Deque[asyncio.Future] = collections.deque()
+        page_num = 1  # pages start in 1
+
+        def render_next_pages() -> None:
+            # Keep a page in flight for each worker, so that the rendered pages that
+            # wait to be sent in order do not pile up in memory (see
+            # `max_rendered_pages()`).
+            while len(pending) < workers:
+                index = next(indices, None)
+                if index is None:
+                    break
+                future = loop.run_in_executor(
+                    executor, render_page, index, self.dpi, reduce, compress
+                )
+                pending.append(future)
+
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=open_worker_document,
+            initargs=(filename, filetype),
         )
+        try:
+            render_next_pages()
+            while pending:
+                try:
+                    width, height, depth, pixels = await pending.popleft()
+                except concurrent.futures.BrokenExecutor:
+                    # A worker process has been killed, which only the kernel does in
+                    # the sandbox, when it runs out of memory.
+                    raise errors.OutOfMemoryException()
+                # Keep the workers busy while this page is sent.
+                render_next_pages()
+                yield page_num, width, height, depth, pixels
+                page_num += 1
+        finally:
+            await shutdown_executor(executor, pending)
+
+    async def convert_with_warm_libreoffice(self) -> bool:
+        """Convert the document to PDF with the warm LibreOffice instance, if any.
+
+        Return False if the document should be converted by a LibreOffice process of
+        its own instead, e.g., because the warm instance has exited, or the Python
+        bindings of LibreOffice are missing.
+        """
+        if self.warm_libreoffice is None or self.warm_libreoffice.poll() is not None:
+            return False
+        try:
+            await self.run_command(
+                [
+                    sys.executable,
+                    "-m",
+                    "dangerzone.conversion.libreoffice",
+                    "/tmp/input_file",
+                    "/tmp/input_file.pdf",
+                ],
+                error_message="Conversion to PDF with a warm LibreOffice failed",
+            )
+        except RuntimeError:
+            # Leave the verdict on the document to a LibreOffice process of its own,
+            # which is what converts Office documents without a warm instance.
+            return False
+        finally:
+            self.stop_warm_libreoffice()
+        return True
+
+    def stop_warm_libreoffice(self) -> None:
+        if self.warm_libreoffice is not None:
+            stop_warm_libreoffice(self.warm_libreoffice)
+            self.warm_libreoffice = None
 
     def detect_mime_type(self, path: str) -> str:
         """Detect MIME types in a platform-agnostic type.
@@ -287,16 +515,33 @@ class DocumentToPixels(DangerzoneConverter):
 
 
 async def main() -> int:
+    # Start LibreOffice while the sandbox waits for its document, so that Office
+    # documents do not have to wait for it to start.
+    warm_libreoffice = None
+    if os.environ.get("WARM_LIBREOFFICE") == "1":
+        warm_libreoffice = start_warm_libreoffice()
+    wait_for_input()
+    render_workers = int(os.environ.get("RENDER_WORKERS", 1))
+    pipeline = os.environ.get("PIPELINE") == "1"
+    reduce_colorspace = os.environ.get("REDUCE_COLORSPACE") == "1"
+    compress = os.environ.get("COMPRESS_PIXELS") == "1"
+    dpi = int(os.environ.get("DPI", DEFAULT_DPI))
+    pages = os.environ.get("PAGES")
     converter = DocumentToPixels()
+    converter.warm_libreoffice = warm_libreoffice
 
     try:
-        await converter.convert()
+        await converter.convert(
+            render_workers, pipeline, reduce_colorspace, compress, dpi, pages
+        )
         error_code = 0  # Success!
     except errors.ConversionException as e:  # Expected Errors
         error_code = e.error_code
     except Exception as e:
         converter.update_progress(str(e), error=True)
         error_code = errors.UnexpectedConversionError.error_code
+    finally:
+        converter.stop_warm_libreoffice()
     if not running_on_qubes():
         # Write debug information (containers version)
         with open("/tmp/dangerzone/captured_output.txt", "wb") as container_log:
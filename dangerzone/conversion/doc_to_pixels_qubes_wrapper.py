@@ -9,11 +9,27 @@ from typing import Optional, TextIO
 from . import errors
 from .doc_to_pixels import DocumentToPixels
 
+COPY_CHUNK_SIZE = 1024 * 1024
 
-def _read_bytes() -> bytes:
-    """Read bytes from the stdin."""
-    data = sys.stdin.buffer.read()
-    if data is None:
+
+def _read_file(filename: str) -> None:
+    """Read the rest of the stdin into a file, in chunks."""
+    with open(filename, "wb") as f:
+        shutil.copyfileobj(sys.stdin.buffer, f, COPY_CHUNK_SIZE)
+
+
+def _read_int(size: int = 2) -> int:
+    """Read `size` bytes from the stdin, and decode them as int."""
+    data = sys.stdin.buffer.read(size)
+    if data is None or len(data) < size:
+        raise EOFError
+    return int.from_bytes(data, signed=False)
+
+
+def _read_bytes(size: int) -> bytes:
+    """Read exactly `size` bytes from the stdin."""
+    data = sys.stdin.buffer.read(size)
+    if data is None or len(data) < size:
         raise EOFError
     return data
 
@@ -26,8 +42,8 @@ def _write_text(text: str, file: TextIO = sys.stdout) -> None:
     _write_bytes(text.encode(), file=file)
 
 
-def _write_int(num: int, file: TextIO = sys.stdout) -> None:
-    _write_bytes(num.to_bytes(2, signed=False), file=file)
+def _write_int(num: int, file: TextIO = sys.stdout, size: int = 2) -> None:
+    _write_bytes(num.to_bytes(size, signed=False), file=file)
 
 
 # ==== ASYNC METHODS ====
@@ -38,8 +54,16 @@ def _write_int(num: int, file: TextIO = sys.stdout) -> None:
 # they shouldn't cause a problem.
 
 
-async def read_bytes() -> bytes:
-    return await asyncio.to_thread(_read_bytes)
+async def read_file(filename: str) -> None:
+    return await asyncio.to_thread(_read_file, filename)
+
+
+async def read_int(size: int = 2) -> int:
+    return await asyncio.to_thread(_read_int, size)
+
+
+async def read_bytes(size: int) -> bytes:
+    return await asyncio.to_thread(_read_bytes, size)
 
 
 async def write_bytes(data: bytes, file: TextIO = sys.stdout) -> None:
@@ -50,8 +74,8 @@ async def write_text(text: str, file: TextIO = sys.stdout) -> None:
     return await asyncio.to_thread(_write_text, text, file=file)
 
 
-async def write_int(num: int, file: TextIO = sys.stdout) -> None:
-    return await asyncio.to_thread(_write_int, num, file=file)
+async def write_int(num: int, file: TextIO = sys.stdout, size: int = 2) -> None:
+    return await asyncio.to_thread(_write_int, num, file=file, size=size)
 
 
 class QubesDocumentToPixels(DocumentToPixels):
@@ -61,6 +85,7 @@ class QubesDocumentToPixels(DocumentToPixels):
     #
     # https://github.com/freedomofpress/dangerzone/issues/443
     # https://github.com/freedomofpress/dangerzone/issues/557
+    streams_pages = True
 
     async def write_page_count(self, count: int) -> None:
         return await write_int(count)
@@ -71,7 +96,12 @@ class QubesDocumentToPixels(DocumentToPixels):
     async def write_page_height(self, height: int, filename: str) -> None:
         return await write_int(height)
 
+    async def write_page_depth(self, depth: int, filename: str) -> None:
+        return await write_int(depth)
+
     async def write_page_data(self, data: bytes, filename: str) -> None:
+        # The page data may be compressed, so their size has to precede them.
+        await write_int(len(data), size=4)
         return await write_bytes(data)
 
 
@@ -82,16 +112,27 @@ async def main() -> None:
     out_dir.mkdir()
 
     try:
-        data = await read_bytes()
-    except EOFError:
+        dpi = await read_int()
+        compress = await read_int() == 1
+        # The selection of pages, if any (see `select_pages()`).
+        pages = (await read_bytes(await read_int())).decode() or None
+    except (EOFError, UnicodeDecodeError):
         sys.exit(1)
-
-    with open("/tmp/input_file", "wb") as f:
-        f.write(data)
+    # The document can be large, so it is stored as it arrives, instead of being read
+    # in memory as a whole.
+    await read_file("/tmp/input_file")
 
     try:
         converter = QubesDocumentToPixels()
-        await converter.convert()
+        # The disposable qube is dedicated to this conversion, so we can use all of its
+        # CPUs for rendering pages.
+        await converter.convert(
+            render_workers=os.cpu_count() or 1,
+            reduce_colorspace=True,
+            compress=compress,
+            dpi=dpi,
+            pages=pages,
+        )
     except errors.ConversionException as e:
         await write_bytes(str(e).encode(), file=sys.stderr)
         sys.exit(e.error_code)
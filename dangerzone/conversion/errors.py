@@ -5,6 +5,10 @@ ERROR_SHIFT = 128
 MAX_PAGES = 10000
 MAX_PAGE_WIDTH = 10000
 MAX_PAGE_HEIGHT = 10000
+# The maximum size (in bytes) of a document, and of a document that LibreOffice
+# converts to PDF, which expands a lot more in memory.
+MAX_INPUT_SIZE = 1024**3
+MAX_LIBREOFFICE_INPUT_SIZE = 512 * 1024**2
 
 
 class ConversionException(Exception):
@@ -32,11 +36,39 @@ class QubesQrexecFailed(ConversionException):
     )
 
 
+class OutOfMemoryException(ConversionException):
+    """The kernel killed a process of the sandbox, because it ran out of memory.
+
+    The error code is the exit code of a container whose main process was killed with
+    SIGKILL, so that the host can reconstruct this error from it."""
+
+    error_code = ERROR_SHIFT + 9
+    error_message = "The conversion ran out of memory"
+
+
 class DocFormatUnsupported(ConversionException):
     error_code = ERROR_SHIFT + 10
     error_message = "The document format is not supported"
 
 
+class MaxInputSizeException(ConversionException):
+    """Max size of a document enforced by the client (to fail early) but also the
+    server, which distrusts the client"""
+
+    error_code = ERROR_SHIFT + 49
+    error_message = (
+        f"The document exceeds the maximum size ({MAX_INPUT_SIZE // 1024**2} MiB)"
+    )
+
+
+class MaxLibreofficeInputSizeException(MaxInputSizeException):
+    error_code = ERROR_SHIFT + 50
+    error_message = (
+        "The document exceeds the maximum size of documents that are converted with "
+        f"LibreOffice ({MAX_LIBREOFFICE_INPUT_SIZE // 1024**2} MiB)"
+    )
+
+
 class DocFormatUnsupportedHWPQubes(DocFormatUnsupported):
     error_code = ERROR_SHIFT + 16
     error_message = "HWP / HWPX formats are not supported in Qubes"
@@ -86,6 +118,16 @@ class PageCountMismatch(PagesException):
     )
 
 
+class InvalidPixelData(PagesException):
+    error_code = ERROR_SHIFT + 47
+    error_message = "A page contained invalid pixel data"
+
+
+class NoSelectedPagesException(PagesException):
+    error_code = ERROR_SHIFT + 48
+    error_message = "None of the selected pages are in the document"
+
+
 class InterruptedConversion(ConversionException):
     """Protocol received num of bytes different than expected"""
 
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Convert a document to PDF with a LibreOffice instance that is already running.
+
+Starting LibreOffice for each document takes several seconds. A sandbox that is
+started ahead of time can instead start LibreOffice while it waits for its document
+(see `start_warm_libreoffice()`), and then convert the document through the UNO
+interface of LibreOffice, by running this script:
+
+    python3 -m dangerzone.conversion.libreoffice <input file> <output PDF>
+
+The LibreOffice instance converts a single document, and is stopped afterwards, just
+like the LibreOffice process that converts a document in a sandbox that was not
+started ahead of time.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from typing import Any, List, Optional, Tuple
+
+from . import errors
+
+# The name of the pipe through which the warm LibreOffice instance accepts UNO
+# connections.
+LIBREOFFICE_PIPE_NAME = "dangerzone"
+
+# A LibreOffice profile that is created when the container image is built. It is
+# read-only, so LibreOffice runs with a copy of it (see `get_profile_args()`).
+LIBREOFFICE_PROFILE_TEMPLATE = "/opt/libreoffice-profile"
+
+# The profile of a LibreOffice process that converts a document on its own.
+LIBREOFFICE_PROFILE_DIR = "/tmp/libreoffice-profile"
+
+# The profile of the warm LibreOffice instance. It is different from the profile above,
+# so that a LibreOffice process that starts afterwards does not hand its document over
+# to the warm instance.
+LIBREOFFICE_WARM_PROFILE_DIR = "/tmp/libreoffice-warm"
+
+# Where the Python bindings of LibreOffice are installed.
+LIBREOFFICE_PROGRAM_DIR = "/usr/lib/libreoffice/program"
+
+# How long (in seconds) to wait for the warm LibreOffice instance to accept connections,
+# in case it is still starting.
+LIBREOFFICE_CONNECT_TIMEOUT = 60
+
+# The pages that LibreOffice exports to PDF. One page more than the maximum is enough to
+# reject a document with too many pages, without exporting all of them.
+EXPORT_PAGE_RANGE = f"1-{errors.MAX_PAGES + 1}"
+
+# The PDF export filter for each type of document.
+PDF_EXPORT_FILTERS = [
+    ("com.sun.star.text.GenericTextDocument", "writer_pdf_Export"),
+    ("com.sun.star.sheet.SpreadsheetDocument", "calc_pdf_Export"),
+    ("com.sun.star.presentation.PresentationDocument", "impress_pdf_Export"),
+    ("com.sun.star.drawing.DrawingDocument", "draw_pdf_Export"),
+]
+
+
+def get_convert_to_arg(pdf_filter: Optional[str]) -> str:
+    """Get the `--convert-to` argument of LibreOffice, for a PDF export filter.
+
+    The number of exported pages is limited only if the filter is known, since
+    LibreOffice does not accept the options of a filter without its name.
+    """
+    if pdf_filter is None:
+        return "pdf"
+    options = {"PageRange": {"type": "string", "value": EXPORT_PAGE_RANGE}}
+    return f"pdf:{pdf_filter}:{json.dumps(options)}"
+
+
+def get_profile_args(profile_dir: str) -> List[str]:
+    """Get the arguments that make LibreOffice use a profile in the given directory.
+
+    The profile starts off as a copy of the one that the container image ships with, if
+    any, so that LibreOffice does not spend its startup time creating a new one.
+    """
+    if os.path.isdir(LIBREOFFICE_PROFILE_TEMPLATE) and not os.path.exists(profile_dir):
+        shutil.copytree(LIBREOFFICE_PROFILE_TEMPLATE, profile_dir, symlinks=True)
+    return [f"-env:UserInstallation=file://{profile_dir}"]
+
+
+def start_warm_libreoffice() -> Optional[subprocess.Popen]:
+    """Start a LibreOffice instance that waits for a document to convert.
+
+    Return None if the Python bindings of LibreOffice, which are needed to convert
+    documents through it, are not installed.
+    """
+    if not os.path.exists(os.path.join(LIBREOFFICE_PROGRAM_DIR, "uno.py")):
+        return None
+    return subprocess.Popen(
+        [
+            "libreoffice",
+            "--headless",
+            "--safe-mode",
+            "--invisible",
+            "--nologo",
+            "--nodefault",
+            "--norestore",
+            *get_profile_args(LIBREOFFICE_WARM_PROFILE_DIR),
+            f"--accept=pipe,name={LIBREOFFICE_PIPE_NAME};urp;StarOffice.ComponentContext",
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def stop_warm_libreoffice(proc: subprocess.Popen) -> None:
+    proc.kill()
+    proc.wait()
+
+
+def make_properties(**properties: Any) -> Tuple[Any, ...]:
+    from com.sun.star.beans import PropertyValue
+
+    values = []
+    for name, value in properties.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        values.append(prop)
+    return tuple(values)
+
+
+def connect(timeout: float) -> Any:
+    """Connect to the warm LibreOffice instance, and get its desktop."""
+    import uno
+    from com.sun.star.connection import NoConnectException
+
+    local_context = uno.getComponentContext()
+    resolver = local_context.ServiceManager.createInstanceWithContext(
+        "com.sun.star.bridge.UnoUrlResolver", local_context
+    )
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            context = resolver.resolve(
+                f"uno:pipe,name={LIBREOFFICE_PIPE_NAME};urp;StarOffice.ComponentContext"
+            )
+            break
+        except NoConnectException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+    return context.ServiceManager.createInstanceWithContext(
+        "com.sun.star.frame.Desktop", context
+    )
+
+
+def convert(desktop: Any, input_filename: str, output_filename: str) -> None:
+    """Convert a document to PDF, the way `libreoffice --convert-to pdf` does."""
+    import uno
+
+    # Never run the macros of the document, or fetch its links.
+    doc = desktop.loadComponentFromURL(
+        uno.systemPathToFileUrl(input_filename),
+        "_blank",
+        0,
+        make_properties(
+            Hidden=True, ReadOnly=True, MacroExecutionMode=0, UpdateDocMode=0
+        ),
+    )
+    if doc is None:
+        raise RuntimeError("LibreOffice could not open the document")
+    try:
+        for service, pdf_filter in PDF_EXPORT_FILTERS:
+            if doc.supportsService(service):
+                break
+        else:
+            raise RuntimeError("LibreOffice cannot export the document to PDF")
+        filter_data = uno.Any(
+            "[]com.sun.star.beans.PropertyValue",
+            make_properties(PageRange=EXPORT_PAGE_RANGE),
+        )
+        # The filter data has to keep its UNO type, hence the explicit invocation.
+        uno.invoke(
+            doc,
+            "storeToURL",
+            (
+                uno.systemPathToFileUrl(output_filename),
+                make_properties(FilterName=pdf_filter, FilterData=filter_data),
+            ),
+        )
+    finally:
+        doc.close(True)
+
+
+def main(args: List[str]) -> int:
+    if len(args) != 2:
+        print("Usage: libreoffice.py <input file> <output PDF>", file=sys.stderr)
+        return 2
+    sys.path.append(LIBREOFFICE_PROGRAM_DIR)
+    desktop = connect(LIBREOFFICE_CONNECT_TIMEOUT)
+    convert(desktop, args[0], args[1])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
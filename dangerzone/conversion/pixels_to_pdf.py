@@ -5,76 +5,473 @@ Here are the steps, with progress bar percentages:
 - 50%-95%: Convert each page of pixels into a PDF (each page takes 45/n%, where n is the number of pages)
 - 95%-100%: Compress the final PDF
 """
+
 import asyncio
+import collections
+import concurrent.futures
+import functools
 import glob
+import hashlib
 import json
+import multiprocessing.context
 import os
 import shutil
 import sys
-from typing import Optional
+import time
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from . import errors
+from .common import (
+    DEFAULT_DPI,
+    DEPTH_BILEVEL,
+    DEPTH_RGB,
+    DOC_TO_PIXELS_EXITED_FILENAME,
+    PAGE_DEPTHS,
+    PIPELINE_POLL_INTERVAL,
+    DangerzoneConverter,
+    get_pixels_size,
+    get_tessdata_dir,
+    inflate_pixels,
+    running_on_qubes,
+    shutdown_executor,
+    unpack_bits,
+    wait_for_input,
+)
+
+if TYPE_CHECKING:
+    import fitz
+
+
+# The number of pages that each OCR worker process may have queued, when pages are
+# OCRed in parallel. Larger queues keep the workers busy, while smaller ones keep the
+# OCRed pages that wait to be inserted in order from piling up in memory.
+OCR_PAGES_PER_WORKER = 2
+
+# The size of the pixels of the pages that may be held in memory, before they are
+# written to the safe PDF.
+SAFE_PDF_FLUSH_SIZE = 64 * 1024 * 1024
+
+
+def limit_ocr_threads(threads: int) -> None:
+    """Limit the threads that Tesseract uses to OCR a page.
+
+    Tesseract may spread the OCR of a page over OpenMP threads, which oversubscribes
+    the CPUs when many pages are OCRed at once. OpenMP reads the limit once it is
+    loaded, so this must be called before PyMuPDF is loaded. It runs in each OCR worker
+    process as it starts, which is early enough for workers that are spawned. Workers
+    that are forked inherit the OpenMP settings of their parent instead, so the
+    conversion stages in the sandbox also call this at startup.
+    """
+    os.environ["OMP_THREAD_LIMIT"] = str(threads)
+
+
+def get_pixmap(
+    width: int, height: int, depth: int, untrusted_pixels: bytes, dpi: int
+) -> "fitz.Pixmap":
+    """Create a pixmap from the (uncompressed) pixels of a page."""
+    # XXX lazy loading of fitz module to avoid import issues on non-Qubes systems
+    import fitz
+
+    if depth == DEPTH_BILEVEL:
+        untrusted_pixels = unpack_bits(untrusted_pixels, width * height)
+    colorspace = fitz.CS_RGB if depth == DEPTH_RGB else fitz.CS_GRAY
+    pixmap = fitz.Pixmap(
+        fitz.Colorspace(colorspace), width, height, untrusted_pixels, False
+    )
+    pixmap.set_dpi(dpi, dpi)
+    return pixmap
+
 
-from .common import DEFAULT_DPI, DangerzoneConverter, get_tessdata_dir, running_on_qubes
+def ocr_page(
+    width: int,
+    height: int,
+    depth: int,
+    untrusted_pixels: bytes,
+    dpi: int,
+    ocr_lang: str,
+) -> bytes:
+    """OCR a page, and return it as a searchable PDF.
+
+    This function runs in a worker process, when pages are OCRed in parallel.
+    """
+    pixmap = get_pixmap(width, height, depth, untrusted_pixels, dpi)
+    return pixmap.pdfocr_tobytes(
+        compress=True,
+        language=ocr_lang,
+        tessdata=get_tessdata_dir(),
+    )
+
+
+def is_blank_page(width: int, height: int, depth: int, untrusted_pixels: bytes) -> bool:
+    """Check if all the pixels of a page have the same color."""
+    if depth == DEPTH_BILEVEL:
+        untrusted_pixels = unpack_bits(untrusted_pixels, width * height)
+    pixel_size = 3 if depth == DEPTH_RGB else 1
+    first_pixel = untrusted_pixels[:pixel_size]
+    return untrusted_pixels == first_pixel * (len(untrusted_pixels) // pixel_size)
+
+
+def check_page_dimensions(width: int, height: int, depth: int) -> None:
+    """Ensure that the dimensions and bit depth of a page are within bounds."""
+    if not (1 <= width <= errors.MAX_PAGE_WIDTH):
+        raise errors.MaxPageWidthException()
+    if not (1 <= height <= errors.MAX_PAGE_HEIGHT):
+        raise errors.MaxPageHeightException()
+    if depth not in PAGE_DEPTHS:
+        raise errors.InvalidPixelData()
+
+
+class SafePDFWriter:
+    """Write the pages of the safe PDF to a file, while they are converted.
+
+    PyMuPDF keeps the pages that are placed on a PDF in memory, along with their
+    uncompressed pixels, until the PDF is saved. Instead of saving all the pages at
+    the end, the writer saves them incrementally, once their pixels add up to
+    `flush_size`, and then reopens the PDF, so that the saved pages are dropped from
+    memory. This way, the memory that a conversion needs does not grow with the
+    number of pages.
+    """
+
+    def __init__(self, path: str, flush_size: int = SAFE_PDF_FLUSH_SIZE) -> None:
+        # XXX lazy loading of fitz module to avoid import issues on non-Qubes systems
+        import fitz
+
+        self.path = path
+        self.flush_size = flush_size
+        self.doc = fitz.Document()
+        self.pending_size = 0
+        self.saved = False
+
+    def page_added(self, size: int) -> None:
+        """Account for a page that has been added, with pixels of the given size."""
+        self.pending_size += size
+        if self.pending_size >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pages that are in memory to the file, and drop them from memory."""
+        # XXX lazy loading of fitz module to avoid import issues on non-Qubes systems
+        import fitz
+
+        self.close()
+        self.doc = fitz.open(self.path)
+
+    def close(self) -> None:
+        """Write the pages that are in memory to the file, and close the PDF."""
+        # XXX lazy loading of fitz module to avoid import issues on non-Qubes systems
+        import fitz
+
+        if not self.saved:
+            self.doc.save(self.path, deflate_images=True)
+            self.saved = True
+        elif self.pending_size:
+            # Append the new pages to the file, without rewriting the saved ones.
+            self.doc.save(
+                self.path,
+                incremental=True,
+                encryption=fitz.PDF_ENCRYPT_KEEP,
+                deflate_images=True,
+            )
+        self.doc.close()
+        self.pending_size = 0
 
 
 class PixelsToPDF(DangerzoneConverter):
+    # How the progress of the doc-to-pixels stage is tracked, when the stages are
+    # pipelined (see `doc_to_pixels_exited()`).
+    pipeline_exited_filename: Optional[str] = None
+    pages_pending = 0
+
     async def convert(
-        self, ocr_lang: Optional[str] = None, tempdir: Optional[str] = None
+        self,
+        ocr_lang: Optional[str] = None,
+        tempdir: Optional[str] = None,
+        pipeline: bool = False,
+        compressed: bool = False,
+        dpi: int = DEFAULT_DPI,
+        ocr_workers: int = 1,
+        input_size: float = 0,
     ) -> None:
+        """Convert the pages that the doc-to-pixels stage has stored to a safe PDF.
+
+        If the stages are pipelined, the pages are converted while they show up. The
+        size (in MiB) of the original document bounds the time that the doc-to-pixels
+        stage may take to count its pages.
+        """
         self.percentage = 50.0
+        self.dpi = dpi
         if tempdir is None:
             tempdir = "/tmp"
+        self.pipeline_exited_filename = None
+        if pipeline:
+            self.pipeline_exited_filename = (
+                f"{tempdir}/dangerzone/{DOC_TO_PIXELS_EXITED_FILENAME}"
+            )
 
-        # XXX lazy loading of fitz module to avoid import issues on non-Qubes systems
-        import fitz
+        if pipeline:
+            num_pages = await self.read_page_count(
+                f"{tempdir}/dangerzone/page_count", self.calculate_timeout(input_size)
+            )
+        else:
+            num_pages = len(glob.glob(f"{tempdir}/dangerzone/page-*.rgb"))
 
-        num_pages = len(glob.glob(f"{tempdir}/dangerzone/page-*.rgb"))
-        total_size = 0.0
+        # Move converted files into /safezone
+        if running_on_qubes():
+            safe_pdf_path = f"{tempdir}/safe-output-compressed.pdf"
+        else:
+            safe_pdf_path = f"/safezone/safe-output-compressed.pdf"
 
-        safe_doc = fitz.Document()
+        pages = self.read_pages(tempdir, num_pages, compressed)
+        await self.convert_pages(
+            pages,
+            num_pages,
+            safe_pdf_path,
+            ocr_lang,
+            dpi=dpi,
+            ocr_workers=ocr_workers,
+        )
 
-        # Convert RGB files to PDF files
-        percentage_per_page = 45.0 / num_pages
+    async def read_pages(
+        self, tempdir: str, num_pages: int, compressed: bool
+    ) -> AsyncIterator[Tuple[int, int, int, bytes]]:
+        """Read the pages that the doc-to-pixels stage has stored in files.
+
+        Yield the width, height, bit depth and pixels of each page.
+        """
         for page_num in range(1, num_pages + 1):
             filename_base = f"{tempdir}/dangerzone/page-{page_num}"
             rgb_filename = f"{filename_base}.rgb"
             width_filename = f"{filename_base}.width"
             height_filename = f"{filename_base}.height"
+            depth_filename = f"{filename_base}.depth"
+
+            # The page data are written last, so once they are in place, the rest of
+            # the page files are there as well.
+            await self.wait_for_file(rgb_filename, self.calculate_timeout(0, 1))
 
             with open(width_filename) as f:
                 width = int(f.read().strip())
             with open(height_filename) as f:
                 height = int(f.read().strip())
+            with open(depth_filename) as f:
+                depth = int(f.read().strip())
+            check_page_dimensions(width, height, depth)
             with open(rgb_filename, "rb") as rgb_f:
-                untrusted_rgb_data = rgb_f.read()
-            # The first few operations happen on a per-page basis.
-            page_size = len(untrusted_rgb_data)
-            total_size += page_size
-            timeout = self.calculate_timeout(page_size, 1)
-            pixmap = fitz.Pixmap(
-                fitz.Colorspace(fitz.CS_RGB), width, height, untrusted_rgb_data, False
+                untrusted_pixels = rgb_f.read()
+            if compressed:
+                pixels_size = get_pixels_size(width, height, depth)
+                untrusted_pixels = inflate_pixels(untrusted_pixels, pixels_size)
+            yield width, height, depth, untrusted_pixels
+
+    async def convert_pages(
+        self,
+        pages: AsyncIterator[Tuple[int, int, int, bytes]],
+        num_pages: int,
+        safe_pdf_path: str,
+        ocr_lang: Optional[str] = None,
+        pipeline: bool = False,
+        dpi: int = DEFAULT_DPI,
+        ocr_workers: int = 1,
+        flush_size: int = SAFE_PDF_FLUSH_SIZE,
+        mp_context: Optional[multiprocessing.context.BaseContext] = None,
+    ) -> None:
+        """Convert pages of pixels to a safe PDF.
+
+        The pages are the width, height, bit depth and (uncompressed) pixels of each
+        page, in order. They may come straight from the doc-to-pixels stage, without
+        a round-trip to the disk. If `pipeline` is true, the pages are still being
+        produced while they are converted.
+
+        If OCR is enabled, up to `ocr_workers` pages are OCRed in parallel, by a pool
+        of worker processes, and inserted in page order. The worker processes are
+        started with `mp_context`, if given.
+
+        The pages are written to the safe PDF incrementally, whenever `flush_size`
+        bytes of them have been converted (see `SafePDFWriter`).
+        """
+        self.percentage = 50.0
+        self.dpi = dpi
+        self.pages_pending = num_pages if pipeline else 0
+
+        # XXX lazy loading of fitz module to avoid import issues on non-Qubes systems
+        import fitz
+
+        total_size = 0.0
+
+        safe_pdf = SafePDFWriter(safe_pdf_path, flush_size)
+
+        # Convert RGB files to PDF files
+        percentage_per_page = 45.0 / num_pages
+        page_num = 0
+
+        # The first page with each content, so that identical pages are inserted once,
+        # and then copied.
+        first_pages: Dict[Tuple[int, int, int, bytes], int] = {}
+        pages_deduplicated = 0
+        pixels_deduplicated = 0
+        blank_pages = 0
+
+        loop = asyncio.get_running_loop()
+        executor = None
+        # The pages that wait to be inserted in order, when pages are OCRed in
+        # parallel. They are either being OCRed, or are ready to be inserted.
+        pending: Deque[Union[asyncio.Future, Callable[[], None]]] = collections.deque()
+        max_pending = 0
+        pages_inserted = 0
+        if ocr_lang and ocr_workers > 1 and num_pages > 1:
+            # Each worker OCRs one page at a time, with a single thread (see
+            # `limit_ocr_threads()`).
+            workers = min(ocr_workers, num_pages)
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=mp_context,
+                initializer=limit_ocr_threads,
+                initargs=(1,),
             )
-            pixmap.set_dpi(DEFAULT_DPI, DEFAULT_DPI)
-            if ocr_lang:  # OCR the document
-                self.update_progress(
-                    f"Converting page {page_num}/{num_pages} from pixels to searchable PDF"
-                )
-                page_pdf_bytes = pixmap.pdfocr_tobytes(
-                    compress=True,
-                    language=ocr_lang,
-                    tessdata=get_tessdata_dir(),
-                )
-                ocr_pdf = fitz.open("pdf", page_pdf_bytes)
-            else:  # Don't OCR
-                self.update_progress(
-                    f"Converting page {page_num}/{num_pages} from pixels to PDF"
-                )
-                page_doc = fitz.Document()
-                page_doc.insert_file(pixmap)
-                page_pdf_bytes = page_doc.tobytes(deflate_images=True)
+            max_pending = OCR_PAGES_PER_WORKER * workers
+
+        def insert_image_page(
+            width: int, height: int, depth: int, untrusted_pixels: bytes
+        ) -> None:
+            pixmap = get_pixmap(width, height, depth, untrusted_pixels, self.dpi)
+            # Place the pixels on a new page of the safe PDF directly, instead of
+            # going through a PDF of their own. The page has the size that the pixels
+            # have in the resolution they were rendered in.
+            page = safe_pdf.doc.new_page(
+                width=width * 72 / self.dpi, height=height * 72 / self.dpi
+            )
+            page.insert_image(page.rect, pixmap=pixmap)
+            safe_pdf.page_added(len(untrusted_pixels))
+
+        def insert_pdf_page(page_pdf_bytes: bytes) -> None:
+            safe_pdf.doc.insert_pdf(fitz.open("pdf", page_pdf_bytes))
+            safe_pdf.page_added(len(page_pdf_bytes))
+
+        def copy_page(first_page: int) -> None:
+            # The copy shares the image (and fonts) of the first page.
+            safe_pdf.doc.fullcopy_page(first_page)
+            safe_pdf.page_added(0)
 
-            safe_doc.insert_pdf(fitz.open("pdf", page_pdf_bytes))
+        async def insert_pending_page() -> None:
+            """Insert the oldest page that waits to be inserted."""
+            nonlocal pages_inserted
+            page = pending.popleft()
+            pages_inserted += 1
+            self.update_pipeline_progress(
+                f"Converting page {pages_inserted}/{num_pages} from pixels to searchable PDF"
+            )
+            if isinstance(page, asyncio.Future):
+                try:
+                    page_pdf_bytes = await page
+                except concurrent.futures.BrokenExecutor:
+                    # A worker process has been killed, which only the kernel does in
+                    # the sandbox, when it runs out of memory.
+                    raise errors.OutOfMemoryException()
+                insert_pdf_page(page_pdf_bytes)
+            else:
+                page()
             self.percentage += percentage_per_page
 
+        try:
+            async for width, height, depth, untrusted_pixels in pages:
+                page_num += 1
+                if page_num > num_pages:
+                    raise errors.MaxPagesException()
+                if pipeline:
+                    self.pages_pending = num_pages - page_num
+
+                check_page_dimensions(width, height, depth)
+                if len(untrusted_pixels) != get_pixels_size(width, height, depth):
+                    raise errors.InvalidPixelData()
+                # The first few operations happen on a per-page basis.
+                page_size = len(untrusted_pixels)
+                total_size += page_size
+                timeout = self.calculate_timeout(page_size, 1)
+
+                digest = hashlib.sha256(untrusted_pixels).digest()
+                first_page = first_pages.setdefault(
+                    (width, height, depth, digest), page_num - 1
+                )
+                insert: Callable[[], None]
+                if first_page != page_num - 1:  # Copy a previous page
+                    pages_deduplicated += 1
+                    pixels_deduplicated += page_size
+                    insert = functools.partial(copy_page, first_page)
+                elif not ocr_lang or is_blank_page(
+                    width, height, depth, untrusted_pixels
+                ):  # Don't OCR
+                    if ocr_lang:
+                        blank_pages += 1
+                    insert = functools.partial(
+                        insert_image_page, width, height, depth, untrusted_pixels
+                    )
+                elif executor is not None:  # OCR the page in parallel
+                    future = loop.run_in_executor(
+                        executor,
+                        ocr_page,
+                        width,
+                        height,
+                        depth,
+                        untrusted_pixels,
+                        self.dpi,
+                        ocr_lang,
+                    )
+                    pending.append(future)
+                    while len(pending) > max_pending:
+                        await insert_pending_page()
+                    continue
+                else:  # OCR the page
+                    self.update_pipeline_progress(
+                        f"Converting page {page_num}/{num_pages} from pixels to searchable PDF"
+                    )
+                    page_pdf_bytes = ocr_page(
+                        width, height, depth, untrusted_pixels, self.dpi, ocr_lang
+                    )
+                    insert_pdf_page(page_pdf_bytes)
+                    self.percentage += percentage_per_page
+                    continue
+
+                if executor is not None:
+                    # Insert the page after the pages that are still being OCRed.
+                    pending.append(insert)
+                    while len(pending) > max_pending:
+                        await insert_pending_page()
+                    continue
+
+                if ocr_lang:
+                    text = f"Converting page {page_num}/{num_pages} from pixels to searchable PDF"
+                else:
+                    text = f"Converting page {page_num}/{num_pages} from pixels to PDF"
+                self.update_pipeline_progress(text)
+                insert()
+                self.percentage += percentage_per_page
+
+            while pending:
+                await insert_pending_page()
+        finally:
+            if executor is not None:
+                await shutdown_executor(executor, pending)
+
+        if pages_deduplicated:
+            self.update_progress(
+                f"Reused {pages_deduplicated} duplicate pages, saving"
+                f" {pixels_deduplicated / 1024**2:.1f} MiB of pixels"
+            )
+        if blank_pages:
+            self.update_progress(f"Skipped the OCR of {blank_pages} blank pages")
+
+        if page_num != num_pages:
+            raise errors.InterruptedConversion()
+
         # Next operations apply to the all the pages, so we need to recalculate the
         # timeout.
         timeout = self.calculate_timeout(total_size, num_pages)
@@ -82,23 +479,86 @@ class PixelsToPDF(DangerzoneConverter):
         self.percentage = 100.0
         self.update_progress("Safe PDF created")
 
-        # Move converted files into /safezone
-        if running_on_qubes():
-            safe_pdf_path = f"{tempdir}/safe-output-compressed.pdf"
-        else:
-            safe_pdf_path = f"/safezone/safe-output-compressed.pdf"
+        safe_pdf.close()
+
+    def doc_to_pixels_exited(self) -> bool:
+        """Check if the doc-to-pixels stage has exited, when the stages are pipelined."""
+        if self.pipeline_exited_filename is not None:
+            return os.path.exists(self.pipeline_exited_filename)
+        return self.pages_pending == 0
+
+    async def wait_for_file(
+        self, filename: str, timeout: Optional[float] = None
+    ) -> None:
+        """Wait until the doc-to-pixels stage has created a file.
 
-        safe_doc.save(safe_pdf_path, deflate_images=True)
+        If the stages are not pipelined, the file should already be there. Else, poll
+        for the file until it shows up, until the doc-to-pixels stage has exited, or
+        until the timeout (in seconds) expires.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not os.path.exists(filename):
+            if self.doc_to_pixels_exited():
+                # Check one last time, in case the file was created right before the
+                # doc-to-pixels stage exited.
+                if os.path.exists(filename):
+                    break
+                raise errors.InterruptedConversion()
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(
+                    "Timed out while waiting for the pages of the document"
+                )
+            await asyncio.sleep(PIPELINE_POLL_INTERVAL)
+
+    async def read_page_count(
+        self, filename: str, timeout: Optional[float] = None
+    ) -> int:
+        """Read the number of pages that the doc-to-pixels stage will produce."""
+        await self.wait_for_file(filename, timeout)
+        with open(filename) as f:
+            num_pages = int(f.read().strip())
+        if not (1 <= num_pages <= errors.MAX_PAGES):
+            raise errors.MaxPagesException()
+        return num_pages
+
+    def update_pipeline_progress(self, text: str) -> None:
+        """Report progress, unless the doc-to-pixels stage is still running.
+
+        When the stages are pipelined, both of them report progress at the same time.
+        In order to not confuse the user with two interleaved progress reports, hold
+        back the per-page progress of this stage, until the previous one has exited.
+        """
+        if self.doc_to_pixels_exited():
+            self.update_progress(text)
 
 
 async def main() -> int:
+    ocr_workers = int(os.environ.get("OCR_WORKERS", 1))
+    if ocr_workers > 1:
+        limit_ocr_threads(1)
+    wait_for_input()
     ocr_lang = os.environ.get("OCR_LANGUAGE") if os.environ.get("OCR") == "1" else None
+    pipeline = os.environ.get("PIPELINE") == "1"
+    compressed = os.environ.get("COMPRESS_PIXELS") == "1"
+    dpi = int(os.environ.get("DPI", DEFAULT_DPI))
+    input_size = int(os.environ.get("INPUT_SIZE", 0)) / 1024**2
     converter = PixelsToPDF()
 
     try:
-        await converter.convert(ocr_lang)
+        await converter.convert(
+            ocr_lang,
+            pipeline=pipeline,
+            compressed=compressed,
+            dpi=dpi,
+            ocr_workers=ocr_workers,
+            input_size=input_size,
+        )
         error_code = 0  # Success!
 
+    except errors.ConversionException as e:
+        converter.update_progress(str(e), error=True)
+        error_code = e.error_code
+
     except (RuntimeError, TimeoutError, ValueError) as e:
         converter.update_progress(str(e), error=True)
         error_code = 1
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Convert a document in a pair of containers that stream the pages through the host,
+instead of storing them in a directory that both of them mount.
+
+The host sends the document to the standard input of the first container, which
+renders its pages and streams them to its standard output, in the same way that the
+disposable qubes do (see `doc_to_pixels_qubes_wrapper.py`): first the page count, and
+then the width, height, bit depth, size and (compressed) pixels of each page. The host
+checks the pages as they arrive, within the timeouts of the conversion, and relays them
+to the standard input of the second container, which converts them to a safe PDF, and
+streams it back to the host.
+
+Since the containers report their progress through their standard output as well,
+everything they write there is split in frames: a tag of one byte, the size of the
+payload in 4 bytes, and the payload itself. Data frames (`d`) carry the streams above,
+progress frames (`p`) the JSON progress reports of the converters, and log frames (`l`)
+the output of the commands that the converters have run:
+
+    python3 -m dangerzone.conversion.stream {doc_to_pixels,pixels_to_pdf}
+"""
+
+import asyncio
+import json
+import os
+import sys
+import threading
+from typing import AsyncIterator, List, Tuple
+
+from . import errors
+from .common import (
+    DEFAULT_DPI,
+    MAX_STREAM_FRAME_SIZE,
+    STREAM_FRAME_DATA,
+    STREAM_FRAME_LOG,
+    STREAM_FRAME_PROGRESS,
+    STREAM_FRAME_SIZE_LEN,
+    get_pixels_size,
+    inflate_pixels,
+    max_deflated_size,
+)
+from .doc_to_pixels import DocumentToPixels
+from .doc_to_pixels_qubes_wrapper import read_bytes, read_file, read_int
+from .pixels_to_pdf import PixelsToPDF, check_page_dimensions, limit_ocr_threads
+
+SAFE_PDF_PATH = "/tmp/safe-output-compressed.pdf"
+
+# Data frames are written from worker threads, while progress frames are written from
+# the main thread, so the frames are written one at a time.
+_frames_lock = threading.Lock()
+
+
+def write_frames(tag: bytes, payload: bytes) -> None:
+    """Write a payload to the standard output, in as many frames as it takes."""
+    stdout = sys.stdout.buffer
+    with _frames_lock, memoryview(payload) as view:
+        for start in range(0, len(view), MAX_STREAM_FRAME_SIZE):
+            chunk = view[start : start + MAX_STREAM_FRAME_SIZE]
+            stdout.write(tag + len(chunk).to_bytes(STREAM_FRAME_SIZE_LEN, signed=False))
+            stdout.write(chunk)
+        stdout.flush()
+
+
+async def write_data(data: bytes) -> None:
+    return await asyncio.to_thread(write_frames, STREAM_FRAME_DATA, data)
+
+
+async def write_int(num: int, size: int = 2) -> None:
+    return await write_data(num.to_bytes(size, signed=False))
+
+
+def write_progress(error: bool, text: str, percentage: float) -> None:
+    status = {"error": error, "text": text, "percentage": int(percentage)}
+    write_frames(STREAM_FRAME_PROGRESS, json.dumps(status).encode())
+
+
+class StreamDocumentToPixels(DocumentToPixels):
+    streams_pages = True
+
+    async def write_page_count(self, count: int) -> None:
+        return await write_int(count)
+
+    async def write_page_width(self, width: int, filename: str) -> None:
+        return await write_int(width)
+
+    async def write_page_height(self, height: int, filename: str) -> None:
+        return await write_int(height)
+
+    async def write_page_depth(self, depth: int, filename: str) -> None:
+        return await write_int(depth)
+
+    async def write_page_data(self, data: bytes, filename: str) -> None:
+        # The page data may be compressed, so their size has to precede them.
+        await write_int(len(data), size=4)
+        return await write_data(data)
+
+    def update_progress(self, text: str, *, error: bool = False) -> None:
+        write_progress(error, text, self.percentage)
+
+
+class StreamPixelsToPDF(PixelsToPDF):
+    def update_progress(self, text: str, *, error: bool = False) -> None:
+        write_progress(error, text, self.percentage)
+
+
+async def read_pages(
+    num_pages: int, compressed: bool
+) -> AsyncIterator[Tuple[int, int, int, bytes]]:
+    """Read the pages that the host relays from the doc-to-pixels stage.
+
+    Yield the width, height, bit depth and pixels of each page.
+    """
+    try:
+        for _ in range(num_pages):
+            width = await read_int()
+            height = await read_int()
+            depth = await read_int()
+            check_page_dimensions(width, height, depth)
+            pixels_size = get_pixels_size(width, height, depth)
+            size = await read_int(4)
+            if size > max_deflated_size(pixels_size):
+                raise errors.InvalidPixelData()
+            untrusted_pixels = await read_bytes(size)
+            if compressed:
+                untrusted_pixels = inflate_pixels(untrusted_pixels, pixels_size)
+            elif size != pixels_size:
+                raise errors.InvalidPixelData()
+            yield width, height, depth, untrusted_pixels
+    except EOFError:
+        raise errors.InterruptedConversion()
+
+
+async def doc_to_pixels() -> int:
+    render_workers = int(os.environ.get("RENDER_WORKERS", 1))
+    reduce_colorspace = os.environ.get("REDUCE_COLORSPACE") == "1"
+    compress = os.environ.get("COMPRESS_PIXELS") == "1"
+    dpi = int(os.environ.get("DPI", DEFAULT_DPI))
+    pages = os.environ.get("PAGES")
+    # The document can be large, so it is stored as it arrives, instead of being read
+    # in memory as a whole.
+    await read_file("/tmp/input_file")
+    converter = StreamDocumentToPixels()
+
+    try:
+        await converter.convert(
+            render_workers,
+            reduce_colorspace=reduce_colorspace,
+            compress=compress,
+            dpi=dpi,
+            pages=pages,
+        )
+        error_code = 0  # Success!
+    except errors.ConversionException as e:  # Expected Errors
+        error_code = e.error_code
+    except Exception as e:
+        converter.update_progress(str(e), error=True)
+        error_code = errors.UnexpectedConversionError.error_code
+
+    # Write debug information
+    write_frames(STREAM_FRAME_LOG, converter.captured_output)
+    return error_code
+
+
+async def pixels_to_pdf() -> int:
+    ocr_workers = int(os.environ.get("OCR_WORKERS", 1))
+    if ocr_workers > 1:
+        limit_ocr_threads(1)
+    ocr_lang = os.environ.get("OCR_LANGUAGE") if os.environ.get("OCR") == "1" else None
+    compressed = os.environ.get("COMPRESS_PIXELS") == "1"
+    dpi = int(os.environ.get("DPI", DEFAULT_DPI))
+    converter = StreamPixelsToPDF()
+
+    try:
+        try:
+            num_pages = await read_int()
+        except EOFError:
+            raise errors.InterruptedConversion()
+        if not (1 <= num_pages <= errors.MAX_PAGES):
+            raise errors.MaxPagesException()
+        # The pages arrive while the previous stage is still rendering the next ones.
+        await converter.convert_pages(
+            read_pages(num_pages, compressed),
+            num_pages,
+            SAFE_PDF_PATH,
+            ocr_lang,
+            pipeline=True,
+            dpi=dpi,
+            ocr_workers=ocr_workers,
+        )
+        with open(SAFE_PDF_PATH, "rb") as f:
+            while chunk := f.read(MAX_STREAM_FRAME_SIZE):
+                await write_data(chunk)
+        error_code = 0  # Success!
+
+    except errors.ConversionException as e:
+        converter.update_progress(str(e), error=True)
+        error_code = e.error_code
+
+    except (RuntimeError, TimeoutError, ValueError) as e:
+        converter.update_progress(str(e), error=True)
+        error_code = 1
+
+    # Write debug information
+    write_frames(STREAM_FRAME_LOG, converter.captured_output)
+    return error_code
+
+
+def main(args: List[str]) -> int:
+    stages = {"doc_to_pixels": doc_to_pixels, "pixels_to_pdf": pixels_to_pdf}
+    if len(args) != 1 or args[0] not in stages:
+        print(f"Usage: stream.py {{{','.join(stages)}}}", file=sys.stderr)
+        return 2
+    return asyncio.run(stages[args[0]]())
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
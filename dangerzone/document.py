@@ -37,6 +37,7 @@ class Document:
         output_filename: Optional[str] = None,
         suffix: str = SAFE_EXTENSION,
         archive: bool = False,
+        pages: Optional[str] = None,
     ) -> None:
         # NOTE: See https://github.com/freedomofpress/dangerzone/pull/216#discussion_r1015449418
         self.id = secrets.token_urlsafe(6)[0:6]
@@ -56,6 +57,9 @@ class Document:
 
         self.archive_after_conversion = archive
 
+        # The pages that are converted, if not all of them (see `parse_pages()`).
+        self.pages = pages
+
     @staticmethod
     def normalize_filename(filename: str) -> str:
         return os.path.abspath(filename)
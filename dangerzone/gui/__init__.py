@@ -140,6 +140,10 @@ def gui_main(
     else:
         container = Container(enable_timeouts=enable_timeouts)
         dangerzone = DangerzoneGui(app, isolation_provider=container)
+        container.configure_pool(
+            dangerzone.settings.get("container_pool_size"),
+            dangerzone.settings.get("container_pool_idle_timeout"),
+        )
 
     # Allow Ctrl-C to smoothly quit the program instead of throwing an exception
     signal.signal(signal.SIGINT, signal.SIG_DFL)
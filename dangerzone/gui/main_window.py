@@ -21,6 +21,12 @@ else:
         from PySide2 import QtCore, QtGui, QtSvg, QtWidgets
 
 from .. import errors
+from ..conversion.common import (
+    DEFAULT_DPI,
+    PREVIEW_PAGES,
+    QUALITY_PRESETS,
+    parse_pages,
+)
 from ..document import SAFE_EXTENSION, Document
 from ..isolation_provider.container import Container, NoContainerTechException
 from ..isolation_provider.dummy import Dummy
@@ -508,6 +514,7 @@ class ContentWidget(QtWidgets.QWidget):
 
         self.doc_selection_widget.hide()
         self.settings_widget.show()
+        self.documents_list.show()
 
         if len(docs) > 0:
             self.documents_added.emit(docs)
@@ -698,6 +705,31 @@ class SettingsWidget(QtWidgets.QWidget):
         ocr_layout.addWidget(self.ocr_combobox)
         ocr_layout.addStretch()
 
+        # Quality of the safe document
+        self.quality_label = QtWidgets.QLabel("Quality")
+        self.quality_combobox = QtWidgets.QComboBox()
+        for name, dpi in QUALITY_PRESETS.items():
+            self.quality_combobox.addItem(f"{name.capitalize()} ({dpi} DPI)", name)
+        quality_layout = QtWidgets.QHBoxLayout()
+        quality_layout.addWidget(self.quality_label)
+        quality_layout.addWidget(self.quality_combobox)
+        quality_layout.addStretch()
+
+        # Convert only some pages of the documents
+        self.pages_checkbox = QtWidgets.QCheckBox("Convert only pages")
+        self.pages_checkbox.clicked.connect(self.update_ui)
+        self.pages = QtWidgets.QLineEdit()
+        self.pages.setPlaceholderText("e.g., 1-3,7,10-")
+        self.pages.textChanged.connect(self.update_ui)
+        self.pages_invalid = QtWidgets.QLabel("(invalid page range)")
+        self.pages_invalid.setStyleSheet("color: red")
+        self.pages_invalid.hide()
+        pages_layout = QtWidgets.QHBoxLayout()
+        pages_layout.addWidget(self.pages_checkbox)
+        pages_layout.addWidget(self.pages)
+        pages_layout.addWidget(self.pages_invalid)
+        pages_layout.addStretch()
+
         # Button
         self.start_button = QtWidgets.QPushButton()
         self.start_button.clicked.connect(self.start_button_clicked)
@@ -722,6 +754,8 @@ class SettingsWidget(QtWidgets.QWidget):
         layout.addLayout(save_group_box_layout)
         layout.addLayout(open_layout)
         layout.addLayout(ocr_layout)
+        layout.addLayout(quality_layout)
+        layout.addLayout(pages_layout)
         layout.addSpacing(20)
         layout.addLayout(button_layout)
         layout.addStretch()
@@ -752,6 +786,10 @@ class SettingsWidget(QtWidgets.QWidget):
         if index != -1:
             self.ocr_combobox.setCurrentIndex(index)
 
+        index = self.quality_combobox.findData(self.dangerzone.settings.get("quality"))
+        if index != -1:
+            self.quality_combobox.setCurrentIndex(index)
+
         if self.dangerzone.settings.get("open"):
             self.open_checkbox.setCheckState(QtCore.Qt.Checked)
         else:
@@ -778,6 +816,21 @@ class SettingsWidget(QtWidgets.QWidget):
             self.safe_extension_invalid.show()
             return False
 
+    def check_pages_are_valid(self) -> bool:
+        if self.pages_checkbox.checkState() == QtCore.Qt.Unchecked:
+            # ignore validity if converting every page
+            self.pages_invalid.hide()
+            return True
+
+        try:
+            parse_pages(self.pages.text())
+        except ValueError:
+            # prevent starting conversion until correct
+            self.pages_invalid.show()
+            return False
+        self.pages_invalid.hide()
+        return True
+
     def check_either_save_or_open(self) -> bool:
         return (
             self.save_checkbox.checkState() == QtCore.Qt.Checked
@@ -801,6 +854,7 @@ class SettingsWidget(QtWidgets.QWidget):
     def update_ui(self) -> None:
         conversion_readiness_conditions = [
             self.check_safe_extension_is_valid(),
+            self.check_pages_are_valid(),
             self.check_either_save_or_open(),
         ]
         if all(conversion_readiness_conditions):
@@ -862,6 +916,9 @@ class SettingsWidget(QtWidgets.QWidget):
                 (_, tmp) = tempfile.mkstemp(suffix=".pdf", prefix="dangerzone_")
                 document.output_filename = tmp
 
+            if self.pages_checkbox.isChecked():
+                document.pages = self.pages.text()
+
         # Update settings
         self.dangerzone.settings.set(
             "save", self.save_checkbox.checkState() == QtCore.Qt.Checked
@@ -872,6 +929,7 @@ class SettingsWidget(QtWidgets.QWidget):
             "ocr", self.ocr_checkbox.checkState() == QtCore.Qt.Checked
         )
         self.dangerzone.settings.set("ocr_language", self.ocr_combobox.currentText())
+        self.dangerzone.settings.set("quality", self.quality_combobox.currentData())
         self.dangerzone.settings.set(
             "open", self.open_checkbox.checkState() == QtCore.Qt.Checked
         )
@@ -892,18 +950,21 @@ class ConvertTask(QtCore.QObject):
         dangerzone: DangerzoneGui,
         document: Document,
         ocr_lang: Optional[str] = None,
+        dpi: int = DEFAULT_DPI,
     ) -> None:
         super(ConvertTask, self).__init__()
         self.document = document
         self.ocr_lang = ocr_lang
+        self.dpi = dpi
         self.error = False
         self.dangerzone = dangerzone
 
     def convert_document(self) -> None:
-        self.dangerzone.isolation_provider.convert(
+        self.dangerzone.convert_document(
             self.document,
             self.ocr_lang,
             self.progress_callback,
+            self.dpi,
         )
         self.finished.emit(self.error)
 
@@ -914,6 +975,23 @@ class ConvertTask(QtCore.QObject):
         self.update.emit(error, text, percentage)
 
 
+class PreviewThread(QtCore.QThread):
+    preview_ready = QtCore.Signal(str)
+    update = QtCore.Signal(bool, str, int)
+
+    def __init__(self, dangerzone: DangerzoneGui, document: Document) -> None:
+        super(PreviewThread, self).__init__()
+        self.dangerzone = dangerzone
+        self.document = document
+
+    def run(self) -> None:
+        preview_filename = self.dangerzone.preview_document(
+            self.document, self.update.emit
+        )
+        # An empty filename means that the preview could not be converted.
+        self.preview_ready.emit(preview_filename or "")
+
+
 class DocumentsListWidget(QtWidgets.QListWidget):
     def __init__(self, dangerzone: DangerzoneGui) -> None:
         super().__init__()
@@ -942,14 +1020,22 @@ class DocumentsListWidget(QtWidgets.QListWidget):
             self.docs_list.append(document)
             self.docs_list_widget_map[document] = widget
 
+        # Prepare the sandboxes for the conversion, while the user reviews the
+        # settings.
+        if docs:
+            self.dangerzone.warm_up(self.get_ocr_lang(), self.get_dpi(), docs[0])
+
     def start_conversion(self) -> None:
         if not self.thread_pool_initized:
             max_jobs = self.dangerzone.isolation_provider.get_max_parallel_conversions()
             self.thread_pool = ThreadPool(max_jobs)
 
         for doc in self.docs_list:
-            task = ConvertTask(self.dangerzone, doc, self.get_ocr_lang())
+            task = ConvertTask(
+                self.dangerzone, doc, self.get_ocr_lang(), self.get_dpi()
+            )
             doc_widget = self.docs_list_widget_map[doc]
+            doc_widget.conversion_started()
             task.update.connect(doc_widget.update_progress)
             task.finished.connect(doc_widget.all_done)
             self.thread_pool.apply_async(task.convert_document)
@@ -962,6 +1048,9 @@ class DocumentsListWidget(QtWidgets.QListWidget):
             ]
         return ocr_lang
 
+    def get_dpi(self) -> int:
+        return QUALITY_PRESETS.get(self.dangerzone.settings.get("quality"), DEFAULT_DPI)
+
 
 class DocumentWidget(QtWidgets.QWidget):
     def __init__(
@@ -1005,14 +1094,62 @@ class DocumentWidget(QtWidgets.QWidget):
         self.progress.setRange(0, 100)
         self.progress.setValue(0)
 
+        # Preview button
+        self.preview_button = QtWidgets.QPushButton("Preview")
+        self.preview_button.setToolTip(
+            f"Convert the first {PREVIEW_PAGES} pages quickly, at a low resolution"
+            " and without OCR"
+        )
+        self.preview_button.clicked.connect(self.preview_clicked)
+        self.preview_thread: Optional[PreviewThread] = None
+
         # Layout
         layout = QtWidgets.QHBoxLayout()
         layout.addWidget(self.status_image)
         layout.addWidget(self.dangerous_doc_label)
         layout.addWidget(self.progress)
         layout.addWidget(self.error_label)
+        layout.addWidget(self.preview_button)
         self.setLayout(layout)
 
+    def preview_clicked(self) -> None:
+        self.preview_button.setDisabled(True)
+        self.preview_button.setText("Previewing...")
+        self.error_label.hide()
+        self.progress.show()
+        self.preview_thread = PreviewThread(self.dangerzone, self.document)
+        self.preview_thread.update.connect(self.update_preview_progress)
+        self.preview_thread.preview_ready.connect(self.preview_ready)
+        self.preview_thread.start()
+
+    def update_preview_progress(self, error: bool, text: str, percentage: int) -> None:
+        # The conversion of the document takes over the progress bar, once started.
+        if not self.document.is_unconverted():
+            return
+        if error:
+            self.error_label.setText(text)
+            self.error_label.setToolTip(text)
+            self.error_label.show()
+            self.progress.hide()
+        else:
+            self.progress.setToolTip(text)
+            self.progress.setValue(percentage)
+
+    def preview_ready(self, preview_filename: str) -> None:
+        self.preview_button.setText("Preview")
+        self.preview_button.setEnabled(True)
+        if not preview_filename:
+            return
+        if self.document.is_unconverted():
+            self.progress.setValue(0)
+        self.dangerzone.open_pdf_viewer(preview_filename)
+
+    def conversion_started(self) -> None:
+        self.preview_button.hide()
+        self.error_label.hide()
+        self.progress.setValue(0)
+        self.progress.show()
+
     def update_progress(self, error: bool, text: str, percentage: int) -> None:
         self.update_status_image()
         if error:
@@ -1,13 +1,16 @@
 import logging
+import os
 import subprocess
 from abc import ABC, abstractmethod
-from typing import Callable, Optional
+from typing import Callable, List, Optional
 
 from colorama import Fore, Style
 
+from ..cache import PixelCache
+from ..conversion.common import DEFAULT_DPI
 from ..conversion.errors import ConversionException
 from ..document import Document
-from ..util import replace_control_chars
+from ..util import get_available_memory, replace_control_chars
 
 log = logging.getLogger(__name__)
 
@@ -18,6 +21,54 @@ PIXELS_TO_PDF_LOG_START = "----- PIXELS TO PDF LOG START -----"
 PIXELS_TO_PDF_LOG_END = "----- PIXELS TO PDF LOG END -----"
 
 
+class SandboxLimits:
+    """The resources that a sandbox can use at most.
+
+    A limit of None means that the resource is not limited.
+    """
+
+    def __init__(
+        self,
+        cpus: Optional[int] = None,
+        memory: Optional[int] = None,
+        pids: Optional[int] = None,
+    ) -> None:
+        self.cpus = cpus
+        self.memory = memory
+        self.pids = pids
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, SandboxLimits):
+            return False
+        return (self.cpus, self.memory, self.pids) == (
+            other.cpus,
+            other.memory,
+            other.pids,
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"SandboxLimits(cpus={self.cpus}, memory={self.memory}, pids={self.pids})"
+        )
+
+    def covers(self, other: Optional["SandboxLimits"]) -> bool:
+        """Check if a sandbox with these limits can run a conversion that needs the
+        other ones."""
+        if other is None:
+            other = SandboxLimits()
+
+        def covers_limit(limit: Optional[int], other_limit: Optional[int]) -> bool:
+            if limit is None:
+                return True
+            return other_limit is not None and limit >= other_limit
+
+        return (
+            covers_limit(self.cpus, other.cpus)
+            and covers_limit(self.memory, other.memory)
+            and covers_limit(self.pids, other.pids)
+        )
+
+
 class IsolationProvider(ABC):
     """
     Abstracts an isolation provider
@@ -32,11 +83,13 @@ class IsolationProvider(ABC):
         document: Document,
         ocr_lang: Optional[str],
         progress_callback: Optional[Callable] = None,
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
     ) -> None:
         self.progress_callback = progress_callback
         document.mark_as_converting()
         try:
-            success = self._convert(document, ocr_lang)
+            success = self._convert(document, ocr_lang, dpi, limits)
         except ConversionException as e:
             success = False
             self.print_progress_trusted(document, True, str(e), 0)
@@ -46,6 +99,50 @@ class IsolationProvider(ABC):
                 f"An exception occurred while converting document '{document.id}'"
             )
             self.print_progress_trusted(document, True, str(e), 0)
+        self.mark_as_done(document, success)
+
+    def convert_batch(
+        self,
+        documents: List[Document],
+        ocr_lang: Optional[str],
+        progress_callback: Optional[Callable] = None,
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
+    ) -> None:
+        """Convert a batch of documents.
+
+        By default, the documents are converted one after the other. Isolation
+        providers that can convert many documents more efficiently in one go should
+        override this method.
+        """
+        for document in documents:
+            self.convert(document, ocr_lang, progress_callback, dpi, limits)
+
+    def warm_up(
+        self,
+        ocr_lang: Optional[str],
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
+    ) -> None:
+        """Prepare for the conversion of documents with the given settings.
+
+        Isolation providers that can start their sandboxes ahead of time should
+        override this method. By default, it does nothing.
+        """
+
+    def has_warm_sandboxes(self) -> bool:
+        """Check if `warm_up()` prepares any sandboxes. By default, it does not."""
+        return False
+
+    def use_pixel_cache(self, pixel_cache: PixelCache) -> None:
+        """Reuse the pages of documents that have been converted to pixels before.
+
+        Isolation providers that store the pages on the host between the conversion
+        stages should override this method. By default, it does nothing.
+        """
+
+    def mark_as_done(self, document: Document, success: bool) -> None:
+        """Update the state of a document, once its conversion has finished."""
         if success:
             document.mark_as_safe()
             if document.archive_after_conversion:
@@ -58,6 +155,8 @@ class IsolationProvider(ABC):
         self,
         document: Document,
         ocr_lang: Optional[str],
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
     ) -> bool:
         pass
 
@@ -93,6 +192,14 @@ class IsolationProvider(ABC):
     def get_max_parallel_conversions(self) -> int:
         pass
 
+    def get_cpu_count(self) -> int:
+        """Get the number of CPUs that are available to the conversions."""
+        return os.cpu_count() or 1
+
+    def get_memory_size(self) -> Optional[int]:
+        """Get the memory (in bytes) that is available to the conversions, if known."""
+        return get_available_memory()
+
     def sanitize_conversion_str(self, untrusted_conversion_str: str) -> str:
         conversion_string = replace_control_chars(untrusted_conversion_str)
 
@@ -1,22 +1,49 @@
+import atexit
+import concurrent.futures
 import gzip
 import json
 import logging
 import os
 import pathlib
 import platform
+import secrets
 import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
-from typing import Any, Callable, List, Optional, Tuple
+import threading
+import time
+from typing import IO, Any, Callable, Dict, List, Optional, Set, Tuple
 
-from ..conversion.errors import exception_from_error_code
+from ..cache import PixelCache
+from ..conversion import errors
+from ..conversion.common import (
+    DEFAULT_DPI,
+    DOC_TO_PIXELS_EXITED_FILENAME,
+    MAX_STREAM_FRAME_SIZE,
+    PAGE_DEPTHS,
+    STREAM_FRAME_DATA,
+    STREAM_FRAME_LOG,
+    STREAM_FRAME_PROGRESS,
+    STREAM_FRAME_SIZE_LEN,
+    calculate_timeout,
+    get_pixels_size,
+    max_deflated_size,
+)
+from ..conversion.errors import (
+    InterruptedConversion,
+    OutOfMemoryException,
+    UnexpectedConversionError,
+    exception_from_error_code,
+)
 from ..document import Document
 from ..util import (
+    Stopwatch,
     get_resource_path,
     get_subprocess_startupinfo,
     get_tmp_dir,
+    nonblocking_readinto,
     replace_control_chars,
 )
 from .base import (
@@ -24,6 +51,7 @@ from .base import (
     PIXELS_TO_PDF_LOG_END,
     PIXELS_TO_PDF_LOG_START,
     IsolationProvider,
+    SandboxLimits,
 )
 
 # Define startupinfo for subprocesses
@@ -36,18 +64,311 @@ else:
 
 log = logging.getLogger(__name__)
 
+# The maximum number of documents that a single pair of containers converts in batch
+# mode. Larger batches amortize the startup cost of the containers better, while
+# smaller ones limit the documents that fail if a container crashes.
+MAX_BATCH_SIZE = 50
+
+# The size (in bytes) of the header that precedes each document, when sending it to
+# the container in batch mode.
+BATCH_DOCUMENT_SIZE_LEN = 8
+
+# The size (in bytes) of the header that precedes each safe PDF, when the container
+# sends it back in batch mode.
+BATCH_SAFE_PDF_SIZE_LEN = 8
+
+# The time (in seconds) after which the warm sandboxes of the pool are discarded, if no
+# conversion has taken place in the meantime.
+DEFAULT_POOL_IDLE_TIMEOUT = 5 * 60
+
+# How often (in seconds) the pool checks that its sandboxes are still alive.
+POOL_CHECK_INTERVAL = 5
+
+# The time (in seconds) that a container is given to exit on its own, once it is
+# discarded.
+SANDBOX_EXIT_TIMEOUT = 5
+
+# The maximum time (in seconds) that a container takes to start up.
+STARTUP_TIME_SECONDS = 60
+
+# The size of the chunks that the document is sent in, when the containers stream their
+# output.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class NoContainerTechException(Exception):
     def __init__(self, container_tech: str) -> None:
         super().__init__(f"{container_tech} is not installed")
 
 
+def get_container_name(conversion_id: str, stage: str) -> str:
+    """Get the name of the container that runs a stage of a conversion."""
+    return f"dangerzone-{conversion_id}-{stage}"
+
+
+class BatchSandbox:
+    """A pair of containers that convert a batch of documents.
+
+    The containers are started before the documents are known, so a sandbox can wait
+    in a pool until a conversion needs it. It is discarded after one use.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        ocr_lang: Optional[str],
+        dpi: int,
+        limits: Optional[SandboxLimits],
+    ) -> None:
+        self.batch_size = batch_size
+        self.ocr_lang = ocr_lang
+        self.dpi = dpi
+        self.limits = limits
+        # The containers are named after the sandbox, so that they can be killed.
+        sandbox_id = secrets.token_urlsafe(6)[0:6]
+        self.doc_to_pixels_name = get_container_name(sandbox_id, "doc-to-pixels")
+        self.pixels_to_pdf_name = get_container_name(sandbox_id, "pixels-to-pdf")
+        self.tmp_dir = tempfile.TemporaryDirectory(dir=get_tmp_dir())
+        # Where the second stage stores each safe PDF, before it sends it to the host.
+        # The host never reads this directory.
+        self.safe_dir = pathlib.Path(self.tmp_dir.name) / "safe"
+        self.safe_dir.mkdir()
+        # Where the host stores the safe PDFs that it receives.
+        self.output_dir = pathlib.Path(self.tmp_dir.name) / "output"
+        self.output_dir.mkdir()
+        self.doc_to_pixels: Optional[subprocess.Popen] = None
+        self.pixels_to_pdf: Optional[subprocess.Popen] = None
+
+    def get_settings(
+        self,
+    ) -> Tuple[Optional[str], int, Optional[SandboxLimits]]:
+        return (self.ocr_lang, self.dpi, self.limits)
+
+    def can_convert(
+        self, ocr_lang: Optional[str], dpi: int, limits: Optional[SandboxLimits]
+    ) -> bool:
+        """Check if the sandbox can convert a document with the given settings."""
+        if (self.ocr_lang, self.dpi) != (ocr_lang, dpi):
+            return False
+        return self.limits is None or self.limits.covers(limits)
+
+    def processes(self) -> List[subprocess.Popen]:
+        return [p for p in (self.doc_to_pixels, self.pixels_to_pdf) if p is not None]
+
+    def kill(self) -> None:
+        """Kill the containers, if they have started."""
+        if self.doc_to_pixels is not None:
+            Container.kill_container(self.doc_to_pixels_name, self.doc_to_pixels)
+        if self.pixels_to_pdf is not None:
+            Container.kill_container(self.pixels_to_pdf_name, self.pixels_to_pdf)
+
+    def is_alive(self) -> bool:
+        """Check if both containers are still waiting for their input."""
+        processes = self.processes()
+        return len(processes) == 2 and all(p.poll() is None for p in processes)
+
+    def close(self) -> None:
+        """Stop the containers, if they are still running, and clean up."""
+        # Closing the standard input of the containers makes them exit on their own.
+        for p in self.processes():
+            try:
+                if p.stdin is not None:
+                    p.stdin.close()
+            except OSError:
+                pass
+        for p in self.processes():
+            try:
+                p.wait(SANDBOX_EXIT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.kill()
+                p.wait()
+            if p.stdout is not None:
+                p.stdout.close()
+        # The containers have exited, so there is no exit code left to check.
+        for name in (self.doc_to_pixels_name, self.pixels_to_pdf_name):
+            Container.was_killed(name)
+        self.tmp_dir.cleanup()
+
+
+class ContainerStream:
+    """The standard output of a container that streams its output in frames.
+
+    The payloads of the data frames are read as a single stream of bytes. The progress
+    reports and the log of the container are handled as they show up in between (see
+    `dangerzone/conversion/stream.py`).
+
+    If a timeout is set, every read has to finish before it expires.
+    """
+
+    def __init__(
+        self,
+        f: IO[bytes],
+        on_progress: Callable[[str], None],
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.f = f
+        self.on_progress = on_progress
+        self.set_timeout(timeout)
+        # The bytes of the current data frame that have not been read yet.
+        self.data_left = 0
+        self.untrusted_log = bytearray()
+
+    @staticmethod
+    def is_supported() -> bool:
+        """Check if the output of containers can be streamed on this platform.
+
+        The reads switch the pipe between blocking and non-blocking mode, and wait on
+        it with `select()`, which Windows supports only for sockets.
+        """
+        return platform.system() != "Windows"
+
+    def set_timeout(self, timeout: Optional[float]) -> None:
+        """Set a timeout for the reads from now on."""
+        os.set_blocking(self.f.fileno(), timeout is None)
+        self.sw = Stopwatch(timeout)
+        self.sw.start()
+
+    def _readinto(self, buf: memoryview) -> int:
+        """Read bytes into a buffer, until it is full or the stream ends."""
+        if len(buf) == 0:
+            return 0
+        if self.sw.timeout is not None:
+            return nonblocking_readinto(self.f, buf, self.sw.remaining)
+        read = 0
+        while read < len(buf):
+            n = os.readv(self.f.fileno(), [buf[read:]])
+            if n == 0:
+                break
+            read += n
+        return read
+
+    def next_data_frame(self) -> bool:
+        """Handle the frames up to the next data frame.
+
+        Return False if the stream ends before that.
+        """
+        header = bytearray(len(STREAM_FRAME_DATA) + STREAM_FRAME_SIZE_LEN)
+        while True:
+            n = self._readinto(memoryview(header))
+            if n == 0:
+                return False
+            if n != len(header):
+                raise InterruptedConversion()
+            tag = bytes(header[:1])
+            size = int.from_bytes(header[1:], "big", signed=False)
+            if size > MAX_STREAM_FRAME_SIZE:
+                raise UnexpectedConversionError("Invalid frame returned from container")
+            if tag == STREAM_FRAME_DATA:
+                self.data_left = size
+                if size > 0:
+                    return True
+                continue
+
+            untrusted_payload = bytearray(size)
+            if self._readinto(memoryview(untrusted_payload)) != size:
+                raise InterruptedConversion()
+            if tag == STREAM_FRAME_PROGRESS:
+                self.on_progress(untrusted_payload.decode("ascii", errors="replace"))
+            elif tag == STREAM_FRAME_LOG:
+                room = MAX_CONVERSION_LOG_CHARS - len(self.untrusted_log)
+                self.untrusted_log += untrusted_payload[:room]
+            else:
+                raise UnexpectedConversionError("Invalid frame returned from container")
+
+    def readinto(self, buf: memoryview) -> None:
+        """Read exactly `len(buf)` bytes of data into a buffer."""
+        read = 0
+        while read < len(buf):
+            if self.data_left == 0 and not self.next_data_frame():
+                raise InterruptedConversion()
+            n = min(self.data_left, len(buf) - read)
+            if self._readinto(buf[read : read + n]) != n:
+                raise InterruptedConversion()
+            read += n
+            self.data_left -= n
+
+    def read_int(self, size: int = 2) -> int:
+        """Read `size` bytes of data, and decode them as int."""
+        buf = bytearray(size)
+        self.readinto(memoryview(buf))
+        return int.from_bytes(buf, "big", signed=False)
+
+    def has_data(self) -> bool:
+        """Check if there is more data, handling the frames up to it."""
+        return self.data_left > 0 or self.next_data_frame()
+
+    def copy_to(self, f: IO[bytes], size: int) -> None:
+        """Copy exactly `size` bytes of data to a file, in chunks."""
+        buf = bytearray(min(size, MAX_STREAM_FRAME_SIZE))
+        while size > 0:
+            n = min(size, len(buf))
+            with memoryview(buf)[:n] as view:
+                self.readinto(view)
+                f.write(view)
+            size -= n
+
+    def read_to_end(self, f: Optional[IO[bytes]] = None) -> None:
+        """Handle the rest of the frames, and write the data that they carry to a file.
+
+        If no file is given, the container should not send any more data.
+        """
+        buf = bytearray(MAX_STREAM_FRAME_SIZE)
+        while self.has_data():
+            if f is None:
+                raise UnexpectedConversionError(
+                    "Unexpected data returned from container"
+                )
+            with memoryview(buf)[: self.data_left] as view:
+                self.readinto(view)
+                f.write(view)
+
+
 class Container(IsolationProvider):
     # Name of the dangerzone container
     CONTAINER_NAME = "dangerzone.rocks/dangerzone"
 
-    def __init__(self, enable_timeouts: bool) -> None:
+    # The names of the containers that the host has killed (see `kill_container()`).
+    killed_containers: Set[str] = set()
+
+    def __init__(
+        self,
+        enable_timeouts: bool,
+        pipeline: bool = False,
+        reduce_colorspace: bool = True,
+        compress_pixels: bool = False,
+        streaming: bool = True,
+    ) -> None:
         self.enable_timeouts = 1 if enable_timeouts else 0
+        # Whether the containers that share a pixels directory run at the same time.
+        # The second one then reads the directory while the first one can still write
+        # to it, so this is opt-in.
+        self.pipeline = pipeline
+        self.reduce_colorspace = reduce_colorspace
+        # Whether the pages are compressed before they leave the first container. This
+        # trades CPU time for less data to copy, so it is opt-in.
+        self.compress_pixels = compress_pixels
+        # Whether the containers that convert a single document stream the pages
+        # through their standard streams, instead of through shared directories (see
+        # `dangerzone/conversion/stream.py`). Streaming conversions are always
+        # pipelined.
+        self.streaming = streaming and ContainerStream.is_supported()
+        self.cgroup_controllers: Optional[List[str]] = None
+        self.pixel_cache: Optional[PixelCache] = None
+
+        # A pool of warm sandboxes, each of which converts a single document. It is
+        # disabled by default (see `configure_pool()`).
+        self.pool: List[BatchSandbox] = []
+        self.pool_size = 0
+        self.pool_idle_timeout: float = DEFAULT_POOL_IDLE_TIMEOUT
+        self.pool_settings: Tuple[Optional[str], int, Optional[SandboxLimits]] = (
+            None,
+            DEFAULT_DPI,
+            None,
+        )
+        self.pool_last_used = 0.0
+        self.pool_lock = threading.Lock()
+        self.pool_wakeup = threading.Event()
+        self.pool_thread: Optional[threading.Thread] = None
         super().__init__()
 
     @staticmethod
@@ -177,6 +498,43 @@ class Container(IsolationProvider):
             )
             self.print_progress_trusted(document, True, error_message, -1)
 
+    def parse_batch_progress(
+        self,
+        documents: List[Document],
+        untrusted_line: str,
+        on_document_done: Callable[[int, int], None],
+    ) -> None:
+        """
+        Parses a line returned by a container in batch mode.
+        """
+        try:
+            untrusted_status = json.loads(untrusted_line)
+
+            index = untrusted_status["document"]
+            self.assert_field_type(index, int)
+            if not (1 <= index <= len(documents)):
+                raise ValueError("Status field has invalid document index")
+
+            if "error_code" in untrusted_status:
+                error_code = untrusted_status["error_code"]
+                self.assert_field_type(error_code, int)
+            else:
+                status = untrusted_status["status"]
+                self.assert_field_type(status, str)
+        except Exception:
+            line = replace_control_chars(untrusted_line)
+            log.error(f"Invalid JSON returned from container:\n\n\tUNTRUSTED> {line}")
+            return
+
+        document = documents[index - 1]
+        if not document.is_converting():
+            # Ignore any report for a document whose conversion has finished.
+            return
+        if "error_code" in untrusted_status:
+            on_document_done(index, error_code)
+        else:
+            self.parse_progress(document, status)
+
     def exec(
         self,
         document: Document,
@@ -201,12 +559,226 @@ class Container(IsolationProvider):
             p.communicate()
             return p.returncode
 
-    def exec_container(
+    def start_stream_process(self, args: List[str]) -> subprocess.Popen:
+        """Start a container that streams its output, without waiting for it."""
+        args_str = " ".join(shlex.quote(s) for s in args)
+        log.info("> " + args_str)
+
+        # The standard error of the container is not part of the stream, so it is
+        # shown only in development mode, e.g., in case the container crashes.
+        dev_mode = getattr(sys, "dangerzone_dev", False)
+        return subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=None if dev_mode else subprocess.DEVNULL,
+            startupinfo=startupinfo,
+        )
+
+    @staticmethod
+    def kill_container(name: str, process: subprocess.Popen) -> None:
+        """Kill a container, and the process of the container runtime that started it.
+
+        Killing the process alone leaves the container running, since the container
+        runtime does not forward SIGKILL to the container. The container is recorded as
+        killed, so that its exit code is not mistaken for running out of memory (see
+        `was_killed()`).
+        """
+        Container.killed_containers.add(name)
+        try:
+            subprocess.run(
+                [Container.get_runtime(), "kill", name],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=SANDBOX_EXIT_TIMEOUT,
+                startupinfo=startupinfo,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            log.exception(f"Could not kill container {name}")
+        process.kill()
+
+    @staticmethod
+    def was_killed(name: str) -> bool:
+        """Check if the host has killed a container, and forget about it.
+
+        A container that the host has killed exits with the same code as a container
+        that the kernel has killed because it ran out of memory. Its conversion has
+        failed for another reason then, which is reported on its own.
+        """
+        try:
+            Container.killed_containers.remove(name)
+            return True
+        except KeyError:
+            return False
+
+    def send_documents(self, documents: List[Document], stdin: IO[bytes]) -> None:
+        """Send the documents of a batch to a container, one after the other."""
+        try:
+            for document in documents:
+                with open(document.input_filename, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    stdin.write(
+                        size.to_bytes(BATCH_DOCUMENT_SIZE_LEN, "big", signed=False)
+                    )
+                    # Send exactly as many bytes as announced, even if the file
+                    # changes in the meantime.
+                    while size > 0:
+                        chunk_size = min(size, 1024 * 1024)
+                        chunk = f.read(chunk_size) or bytes(chunk_size)
+                        stdin.write(chunk)
+                        size -= len(chunk)
+            stdin.close()
+        except (OSError, ValueError):
+            # The container has exited early. The documents that it did not convert
+            # will be reported as failed.
+            log.debug("Could not send all the documents of the batch to the container")
+
+    def send_document(self, document: Document, stdin: IO[bytes]) -> None:
+        """Send a document to a container that streams its output."""
+        try:
+            with open(document.input_filename, "rb") as f:
+                shutil.copyfileobj(f, stdin, UPLOAD_CHUNK_SIZE)
+            stdin.close()
+        except (OSError, ValueError):
+            # The container has exited early, and its exit code tells why.
+            log.debug(f"Could not send document {document.id} to the container")
+
+    def relay_page(self, stream: ContainerStream, stdin: IO[bytes]) -> None:
+        """Relay a page from a container to another, once its header is checked.
+
+        The header of a page is its width, height, bit depth and the size of its
+        (compressed) pixels, which are relayed in chunks, as they arrive.
+        """
+        width = stream.read_int()
+        height = stream.read_int()
+        if not (1 <= width <= errors.MAX_PAGE_WIDTH):
+            raise errors.MaxPageWidthException()
+        if not (1 <= height <= errors.MAX_PAGE_HEIGHT):
+            raise errors.MaxPageHeightException()
+        depth = stream.read_int()
+        if depth not in PAGE_DEPTHS:
+            raise errors.InvalidPixelData()
+
+        # The pixels may be compressed, so read their size first, and make sure that it
+        # is within bounds, before reading them.
+        pixels_size = get_pixels_size(width, height, depth)
+        deflated_size = stream.read_int(size=4)
+        if not (1 <= deflated_size <= max_deflated_size(pixels_size)):
+            raise errors.InvalidPixelData()
+        for num in (width, height, depth):
+            stdin.write(num.to_bytes(2, "big", signed=False))
+        stdin.write(deflated_size.to_bytes(4, "big", signed=False))
+        stream.copy_to(stdin, deflated_size)
+
+    def get_stream_timeout(
+        self, document: Document, n_pages: Optional[int] = None, dpi: int = DEFAULT_DPI
+    ) -> Optional[float]:
+        """Get the timeout of the streams of a conversion, before and after the number
+        of its pages is known."""
+        if not self.enable_timeouts:
+            return None
+        size = os.path.getsize(document.input_filename) / 1024**2
+        if n_pages is None:
+            return calculate_timeout(size) + STARTUP_TIME_SECONDS
+        return calculate_timeout(size, n_pages, dpi)
+
+    def wait_container(self, name: str, process: subprocess.Popen) -> int:
+        """Wait for a container that has closed its output to exit.
+
+        Return its exit code. A container that does not exit in time is killed.
+        """
+        try:
+            return process.wait(SANDBOX_EXIT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.kill_container(name, process)
+            process.wait()
+            self.was_killed(name)
+            raise UnexpectedConversionError("The container did not exit in time")
+
+    def relay_pages(
         self,
         document: Document,
+        doc_to_pixels: subprocess.Popen,
+        pixels_to_pdf_stdin: IO[bytes],
+        dpi: int,
+        pixels_to_pdf_stream: Optional[ContainerStream] = None,
+    ) -> None:
+        """Relay the pages that the first container streams to the second one.
+
+        The pages are checked as they arrive, the same way as the pages that the
+        disposable qubes stream on Qubes, and they have to arrive within the timeouts of
+        the conversion. Nothing is relayed after a page that fails the checks. Once the
+        number of pages is known, the timeouts of both streams are set for it.
+        """
+        assert doc_to_pixels.stdout is not None
+        doc_to_pixels_name = get_container_name(document.id, "doc-to-pixels")
+        stream = ContainerStream(
+            doc_to_pixels.stdout,
+            lambda untrusted_line: self.parse_progress(document, untrusted_line),
+            self.get_stream_timeout(document),
+        )
+        try:
+            try:
+                n_pages = stream.read_int()
+                if n_pages == 0 or n_pages > errors.MAX_PAGES:
+                    raise errors.MaxPagesException()
+                if self.enable_timeouts:
+                    timeout = self.get_stream_timeout(document, n_pages, dpi)
+                    stream.set_timeout(timeout)
+                    if pixels_to_pdf_stream is not None:
+                        pixels_to_pdf_stream.set_timeout(timeout)
+                pixels_to_pdf_stdin.write(n_pages.to_bytes(2, "big", signed=False))
+
+                for _ in range(n_pages):
+                    self.relay_page(stream, pixels_to_pdf_stdin)
+
+                # The rest of the stream is the final progress report and the log.
+                stream.read_to_end()
+            finally:
+                # Let the second container know that no more pages will show up.
+                try:
+                    pixels_to_pdf_stdin.close()
+                except OSError:
+                    pass
+                if getattr(sys, "dangerzone_dev", False):
+                    untrusted_log = stream.untrusted_log.decode(
+                        "ascii", errors="replace"
+                    )
+                    log.info(
+                        f"Conversion output (doc to pixels):\n{self.sanitize_conversion_str(untrusted_log)}"
+                    )
+        except InterruptedConversion:
+            # The first container has exited, and its exit code tells why, unless the
+            # host has killed it.
+            ret = self.wait_container(doc_to_pixels_name, doc_to_pixels)
+            if self.was_killed(doc_to_pixels_name):
+                raise
+            # XXX Reconstruct exception from error code
+            raise exception_from_error_code(ret)  # type: ignore [misc]
+        except BrokenPipeError:
+            # The second container has exited early, and its exit code tells why.
+            self.kill_container(doc_to_pixels_name, doc_to_pixels)
+            doc_to_pixels.wait()
+            return
+        except BaseException:
+            # Stop the first container, so that it does not keep sending pages that
+            # nobody reads.
+            self.kill_container(doc_to_pixels_name, doc_to_pixels)
+            doc_to_pixels.wait()
+            raise
+
+        ret = self.wait_container(doc_to_pixels_name, doc_to_pixels)
+        self.was_killed(doc_to_pixels_name)
+        if ret != 0:
+            log.error("documents-to-pixels failed")
+            # XXX Reconstruct exception from error code
+            raise exception_from_error_code(ret)  # type: ignore [misc]
+
+    def get_container_args(
+        self,
         command: List[str],
         extra_args: List[str] = [],
-    ) -> int:
+    ) -> List[str]:
         container_runtime = self.get_runtime()
 
         if self.get_runtime_name() == "podman":
@@ -231,14 +803,143 @@ class Container(IsolationProvider):
             + command
         )
 
-        args = [container_runtime] + args
+        return [container_runtime] + args
+
+    def exec_container(
+        self,
+        document: Document,
+        command: List[str],
+        extra_args: List[str] = [],
+    ) -> int:
+        args = self.get_container_args(command, extra_args)
         return self.exec(document, args)
 
+    def get_env_args(self, env: Dict[str, str]) -> List[str]:
+        """Get the arguments that pass environment variables to a container."""
+        args = []
+        for key, val in env.items():
+            args += ["-e", f"{key}={val}"]
+        return args
+
+    def get_cgroup_controllers(self) -> List[str]:
+        """Get the cgroup controllers that can limit the resources of a container.
+
+        Rootless Podman can only use the controllers that the system delegates to the
+        user, which may be none at all (e.g., with cgroups v1).
+        """
+        if self.cgroup_controllers is None:
+            controllers = ["cpu", "memory", "pids"]
+            if self.get_runtime_name() == "podman":
+                try:
+                    output = subprocess.check_output(
+                        [
+                            self.get_runtime(),
+                            "info",
+                            "--format",
+                            "{{.Host.CgroupControllers}}",
+                        ],
+                        text=True,
+                        startupinfo=get_subprocess_startupinfo(),
+                    )
+                    available = output.strip().strip("[]").split()
+                except (OSError, subprocess.CalledProcessError):
+                    log.exception("Could not get the cgroup controllers of Podman")
+                    available = []
+                controllers = [c for c in controllers if c in available]
+            self.cgroup_controllers = controllers
+        return self.cgroup_controllers
+
+    def get_limit_args(self, limits: Optional[SandboxLimits]) -> List[str]:
+        """Get the arguments that limit the resources of a container."""
+        if limits is None:
+            return []
+        controllers = self.get_cgroup_controllers()
+        args = []
+        if limits.cpus is not None and "cpu" in controllers:
+            args += ["--cpus", str(limits.cpus)]
+        if limits.memory is not None and "memory" in controllers:
+            # Do not let the container swap, so that it is killed once it exceeds its
+            # memory limit, instead of slowing down the rest of the system.
+            args += ["--memory", str(limits.memory)]
+            args += ["--memory-swap", str(limits.memory)]
+        if limits.pids is not None and "pids" in controllers:
+            args += ["--pids-limit", str(limits.pids)]
+        return args
+
+    def get_worker_count(self, limits: Optional[SandboxLimits] = None) -> int:
+        """Get how many worker processes a stage can use, one for each CPU."""
+        workers = self.get_cpu_count()
+        if limits is not None and limits.cpus is not None:
+            workers = min(workers, limits.cpus)
+        return workers
+
+    def use_pixel_cache(self, pixel_cache: PixelCache) -> None:
+        """Reuse the pages of documents that have been converted to pixels before.
+
+        The pages of warm sandboxes and batches are not visible to the host, so
+        documents are converted one by one while the cache is in use.
+        """
+        self.pixel_cache = pixel_cache
+
+    def get_pixel_cache_key(self, document: Document, dpi: int) -> str:
+        assert self.pixel_cache is not None
+        return self.pixel_cache.get_key(
+            document.input_filename,
+            dpi=dpi,
+            pages=document.pages,
+            reduce_colorspace=self.reduce_colorspace,
+            compress_pixels=self.compress_pixels,
+        )
+
+    def get_doc_to_pixels_env(
+        self,
+        dpi: int,
+        limits: Optional[SandboxLimits] = None,
+        pages: Optional[str] = None,
+    ) -> Dict[str, str]:
+        """Get the environment of the doc-to-pixels stage."""
+        env = {
+            "ENABLE_TIMEOUTS": str(self.enable_timeouts),
+            "RENDER_WORKERS": str(self.get_worker_count(limits)),
+            "PIPELINE": "1" if self.pipeline else "0",
+            "REDUCE_COLORSPACE": "1" if self.reduce_colorspace else "0",
+            "COMPRESS_PIXELS": "1" if self.compress_pixels else "0",
+            "DPI": str(dpi),
+        }
+        if pages:
+            env["PAGES"] = pages
+        return env
+
+    def get_pixels_to_pdf_env(
+        self,
+        ocr_lang: Optional[str],
+        dpi: int,
+        limits: Optional[SandboxLimits] = None,
+    ) -> Dict[str, str]:
+        """Get the environment of the pixels-to-PDF stage."""
+        return {
+            "TESSDATA_PREFIX": "/usr/share/tessdata",
+            "OCR": "1" if ocr_lang else "0",
+            "OCR_LANGUAGE": str(ocr_lang),
+            "OCR_WORKERS": str(self.get_worker_count(limits)),
+            "ENABLE_TIMEOUTS": str(self.enable_timeouts),
+            "PIPELINE": "1" if self.pipeline else "0",
+            "COMPRESS_PIXELS": "1" if self.compress_pixels else "0",
+            "DPI": str(dpi),
+        }
+
     def _convert(
         self,
         document: Document,
         ocr_lang: Optional[str],
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
     ) -> bool:
+        if self.streaming and self.pixel_cache is None:
+            # The pixel cache stores the pages that the first stage leaves in the
+            # pixels directory, so it needs the conversion to use one.
+            return self._convert_streaming(document, ocr_lang, dpi, limits)
+
         # Create a temporary directory inside the cache directory for this run. Then,
         # create some subdirectories for the various stages of the file conversion:
         #
@@ -260,6 +961,8 @@ class Container(IsolationProvider):
                 pixel_dir=pixel_dir,
                 safe_dir=safe_dir,
                 ocr_lang=ocr_lang,
+                dpi=dpi,
+                limits=limits,
             )
 
     def _convert_with_tmpdirs(
@@ -269,84 +972,144 @@ class Container(IsolationProvider):
         pixel_dir: pathlib.Path,
         safe_dir: pathlib.Path,
         ocr_lang: Optional[str],
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
     ) -> bool:
         success = False
 
-        if ocr_lang:
-            ocr = "1"
-        else:
-            ocr = "0"
+        # Look up the pages of the document in the pixel cache, before the document is
+        # archived.
+        pixel_cache_key = None
+        num_cached_pages = None
+        if self.pixel_cache is not None:
+            pixel_cache_key = self.get_pixel_cache_key(document, dpi)
+            num_cached_pages = self.pixel_cache.get(pixel_cache_key, str(pixel_dir))
+        pipeline = self.pipeline and num_cached_pages is None
 
         copied_file = unsafe_dir / "input_file"
         shutil.copyfile(f"{document.input_filename}", copied_file)
 
+        # When the conversion stages are pipelined, both containers mount the pixels
+        # directory at the same time. In that case, the directory needs a shared SELinux
+        # label (z), instead of a private one (Z) that would lock out the container that
+        # mounted it first.
+        pixel_dir_label = "z" if pipeline else "Z"
+
         # Convert document to pixels
-        command = [
+        doc_to_pixels_command = [
             "/usr/bin/python3",
             "-m",
             "dangerzone.conversion.doc_to_pixels",
         ]
-        extra_args = [
+        doc_to_pixels_args = [
             "-v",
             f"{copied_file}:/tmp/input_file:Z",
             "-v",
-            f"{pixel_dir}:/tmp/dangerzone:Z",
-            "-e",
-            f"ENABLE_TIMEOUTS={self.enable_timeouts}",
+            f"{pixel_dir}:/tmp/dangerzone:{pixel_dir_label}",
+        ] + self.get_env_args(self.get_doc_to_pixels_env(dpi, limits, document.pages))
+        doc_to_pixels_args += self.get_limit_args(limits)
+
+        # Convert pixels to safe PDF
+        pixels_to_pdf_command = [
+            "/usr/bin/python3",
+            "-m",
+            "dangerzone.conversion.pixels_to_pdf",
         ]
-        ret = self.exec_container(document, command, extra_args)
+        pixels_to_pdf_args = [
+            "-v",
+            f"{pixel_dir}:/tmp/dangerzone:{pixel_dir_label}",
+            "-v",
+            f"{safe_dir}:/safezone:Z",
+        ] + self.get_env_args(
+            {
+                **self.get_pixels_to_pdf_env(ocr_lang, dpi, limits),
+                # Bounds the time that the second stage waits for the first one.
+                "INPUT_SIZE": str(os.path.getsize(document.input_filename)),
+            }
+        )
+        pixels_to_pdf_args += self.get_limit_args(limits)
 
-        if getattr(sys, "dangerzone_dev", False):
-            log_path = pixel_dir / "captured_output.txt"
-            with open(log_path, "r", encoding="ascii", errors="replace") as f:
-                untrusted_log = f.read(MAX_CONVERSION_LOG_CHARS)
-            log.info(
-                f"Conversion output (doc to pixels):\n{self.sanitize_conversion_str(untrusted_log)}"
-            )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            if pipeline:
+                # Start the second stage right away, so that it can convert each page
+                # to PDF, while the first stage is still rendering the next ones.
+                pixels_to_pdf = executor.submit(
+                    self.exec_container,
+                    document,
+                    pixels_to_pdf_command,
+                    pixels_to_pdf_args,
+                )
 
-        if ret != 0:
-            log.error("documents-to-pixels failed")
+            if num_cached_pages is not None:
+                # Skip the first stage, and hand the cached pages over to the second
+                # one, the way the first stage does when the stages are pipelined.
+                self.print_progress_trusted(
+                    document, False, "Using the cached pixels of the document", 50
+                )
+                (pixel_dir / "page_count").write_text(str(num_cached_pages))
+                (pixel_dir / DOC_TO_PIXELS_EXITED_FILENAME).touch()
+                ret = 0
+            else:
+                try:
+                    ret = self.exec_container(
+                        document, doc_to_pixels_command, doc_to_pixels_args
+                    )
+                finally:
+                    if pipeline:
+                        # Let the second stage know that no more pages will show up.
+                        (pixel_dir / DOC_TO_PIXELS_EXITED_FILENAME).touch()
+
+                if getattr(sys, "dangerzone_dev", False):
+                    log_path = pixel_dir / "captured_output.txt"
+                    with open(log_path, "r", encoding="ascii", errors="replace") as f:
+                        untrusted_log = f.read(MAX_CONVERSION_LOG_CHARS)
+                    log.info(
+                        f"Conversion output (doc to pixels):\n{self.sanitize_conversion_str(untrusted_log)}"
+                    )
 
-            # XXX Reconstruct exception from error code
-            raise exception_from_error_code(ret)  # type: ignore [misc]
-        else:
-            # TODO: validate convert to pixels output
-
-            # Convert pixels to safe PDF
-            command = [
-                "/usr/bin/python3",
-                "-m",
-                "dangerzone.conversion.pixels_to_pdf",
-            ]
-            extra_args = [
-                "-v",
-                f"{pixel_dir}:/tmp/dangerzone:Z",
-                "-v",
-                f"{safe_dir}:/safezone:Z",
-                "-e",
-                "TESSDATA_PREFIX=/usr/share/tessdata",
-                "-e",
-                f"OCR={ocr}",
-                "-e",
-                f"OCR_LANGUAGE={ocr_lang}",
-                "-e",
-                f"ENABLE_TIMEOUTS={self.enable_timeouts}",
-            ]
-            ret = self.exec_container(document, command, extra_args)
             if ret != 0:
-                log.error("pixels-to-pdf failed")
+                log.error("documents-to-pixels failed")
+
+                # XXX Reconstruct exception from error code
+                raise exception_from_error_code(ret)  # type: ignore [misc]
             else:
-                # Move the final file to the right place
-                if os.path.exists(document.output_filename):
-                    os.remove(document.output_filename)
+                # TODO: validate convert to pixels output
 
-                container_output_filename = os.path.join(
-                    safe_dir, "safe-output-compressed.pdf"
-                )
-                shutil.move(container_output_filename, document.output_filename)
+                if pipeline:
+                    ret = pixels_to_pdf.result()
+                else:
+                    ret = self.exec_container(
+                        document, pixels_to_pdf_command, pixels_to_pdf_args
+                    )
+                if ret == OutOfMemoryException.error_code:
+                    log.error("pixels-to-pdf ran out of memory")
+                    raise OutOfMemoryException()
+                elif ret != 0:
+                    log.error("pixels-to-pdf failed")
+                else:
+                    # Move the final file to the right place
+                    if os.path.exists(document.output_filename):
+                        os.remove(document.output_filename)
 
-                # We did it
-                success = True
+                    container_output_filename = os.path.join(
+                        safe_dir, "safe-output-compressed.pdf"
+                    )
+                    shutil.move(container_output_filename, document.output_filename)
+
+                    # We did it
+                    success = True
+
+        if success and pixel_cache_key is not None and num_cached_pages is None:
+            # The second stage has accepted the pages, so they can be reused.
+            assert self.pixel_cache is not None
+            try:
+                self.pixel_cache.put(pixel_cache_key, str(pixel_dir))
+            except OSError as e:
+                log.warning(
+                    f"Could not cache the pixels of document {document.id}: {e}"
+                )
+        if self.pixel_cache is not None:
+            self.pixel_cache.save_stats()
 
         if getattr(sys, "dangerzone_dev", False):
             log_path = safe_dir / "captured_output.txt"
@@ -360,12 +1123,563 @@ class Container(IsolationProvider):
 
         return success
 
+    def _convert_streaming(
+        self,
+        document: Document,
+        ocr_lang: Optional[str],
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
+    ) -> bool:
+        """Convert a document in a pair of containers that stream their output.
+
+        The host sends the document to the first container, and relays the pages to
+        the second one, which sends back the safe PDF. Nothing is stored in directories
+        that the containers mount.
+        """
+        stream_command = ["/usr/bin/python3", "-m", "dangerzone.conversion.stream"]
+        # The containers are named after the document, so that they can be killed.
+        doc_to_pixels_name = get_container_name(document.id, "doc-to-pixels")
+        pixels_to_pdf_name = get_container_name(document.id, "pixels-to-pdf")
+        doc_to_pixels_args = self.get_container_args(
+            stream_command + ["doc_to_pixels"],
+            ["-i", "--name", doc_to_pixels_name]
+            + self.get_env_args(self.get_doc_to_pixels_env(dpi, limits, document.pages))
+            + self.get_limit_args(limits),
+        )
+        pixels_to_pdf_args = self.get_container_args(
+            stream_command + ["pixels_to_pdf"],
+            ["-i", "--name", pixels_to_pdf_name]
+            + self.get_env_args(self.get_pixels_to_pdf_env(ocr_lang, dpi, limits))
+            + self.get_limit_args(limits),
+        )
+
+        processes: List[Tuple[str, subprocess.Popen]] = []
+        try:
+            # Start the second stage first, so that it loads its modules while the first
+            # one renders the pages.
+            pixels_to_pdf = self.start_stream_process(pixels_to_pdf_args)
+            processes.append((pixels_to_pdf_name, pixels_to_pdf))
+            doc_to_pixels = self.start_stream_process(doc_to_pixels_args)
+            processes.append((doc_to_pixels_name, doc_to_pixels))
+            assert doc_to_pixels.stdin is not None
+            assert pixels_to_pdf.stdin is not None
+            assert pixels_to_pdf.stdout is not None
+
+            stream = ContainerStream(
+                pixels_to_pdf.stdout,
+                lambda untrusted_line: self.parse_progress(document, untrusted_line),
+                self.get_stream_timeout(document),
+            )
+            with tempfile.TemporaryDirectory(dir=get_tmp_dir()) as t:
+                safe_pdf_path = os.path.join(t, "safe-output-compressed.pdf")
+                with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                    upload = executor.submit(
+                        self.send_document, document, doc_to_pixels.stdin
+                    )
+                    relay = executor.submit(
+                        self.relay_pages,
+                        document,
+                        doc_to_pixels,
+                        pixels_to_pdf.stdin,
+                        dpi,
+                        stream,
+                    )
+                    try:
+                        with open(safe_pdf_path, "wb") as f:
+                            stream.read_to_end(f)
+                    except BaseException:
+                        # Stop the containers, so that the threads that feed them do
+                        # not wait for them forever.
+                        for name, p in processes:
+                            self.kill_container(name, p)
+                        raise
+                    finally:
+                        if getattr(sys, "dangerzone_dev", False):
+                            untrusted_log = stream.untrusted_log.decode(
+                                "ascii", errors="replace"
+                            )
+                            log.info(
+                                f"Container output: (pixels to PDF)\n"
+                                f"{PIXELS_TO_PDF_LOG_START}\n{untrusted_log}{PIXELS_TO_PDF_LOG_END}"
+                            )
+                    ret = pixels_to_pdf.wait()
+                    # The second stage fails as well when the first one does, so the
+                    # errors of the first one take precedence.
+                    relay.result()
+                    upload.result()
+
+                killed = self.was_killed(pixels_to_pdf_name)
+                if ret == OutOfMemoryException.error_code and not killed:
+                    log.error("pixels-to-pdf ran out of memory")
+                    raise OutOfMemoryException()
+                elif ret != 0:
+                    log.error("pixels-to-pdf failed")
+                    return False
+
+                # Move the final file to the right place
+                if os.path.exists(document.output_filename):
+                    os.remove(document.output_filename)
+                shutil.move(safe_pdf_path, document.output_filename)
+                return True
+        finally:
+            for name, p in processes:
+                if p.poll() is None:
+                    self.kill_container(name, p)
+                p.wait()
+                self.was_killed(name)
+                for pipe in (p.stdin, p.stdout):
+                    if pipe is not None:
+                        try:
+                            pipe.close()
+                        except OSError:
+                            pass
+
+    def convert(
+        self,
+        document: Document,
+        ocr_lang: Optional[str],
+        progress_callback: Optional[Callable] = None,
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
+    ) -> None:
+        if self.pixel_cache is not None or document.pages:
+            # The warm sandboxes render every page of their document.
+            super().convert(document, ocr_lang, progress_callback, dpi, limits)
+            return
+        sandbox = self.take_from_pool(ocr_lang, dpi, limits)
+        # Replace the sandbox that was just taken, and keep the pool warm for the
+        # next conversions.
+        self.warm_up(ocr_lang, dpi, limits)
+        if sandbox is None:
+            super().convert(document, ocr_lang, progress_callback, dpi, limits)
+        else:
+            log.debug(f"Converting document {document.id} in a warm sandbox")
+            self.progress_callback = progress_callback
+            self._convert_batch([document], ocr_lang, dpi, limits, sandbox)
+
+    def convert_batch(
+        self,
+        documents: List[Document],
+        ocr_lang: Optional[str],
+        progress_callback: Optional[Callable] = None,
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
+    ) -> None:
+        """Convert a batch of documents, using a single pair of containers.
+
+        See `dangerzone/conversion/batch.py` for how the documents are isolated from
+        each other within the containers.
+        """
+        if (
+            not ContainerStream.is_supported()
+            or self.pixel_cache is not None
+            or len({d.pages for d in documents}) > 1
+        ):
+            # The containers stream their output, and render the same pages of each
+            # document.
+            super().convert_batch(documents, ocr_lang, progress_callback, dpi, limits)
+            return
+        self.progress_callback = progress_callback
+        for i in range(0, len(documents), MAX_BATCH_SIZE):
+            batch = documents[i : i + MAX_BATCH_SIZE]
+            self._convert_batch(batch, ocr_lang, dpi, limits)
+
+    def _convert_batch(
+        self,
+        documents: List[Document],
+        ocr_lang: Optional[str],
+        dpi: int,
+        limits: Optional[SandboxLimits] = None,
+        sandbox: Optional[BatchSandbox] = None,
+    ) -> None:
+        for document in documents:
+            document.mark_as_converting()
+
+        try:
+            if sandbox is None:
+                sandbox = self.start_batch_sandbox(
+                    len(documents), ocr_lang, dpi, limits, pages=documents[0].pages
+                )
+            try:
+                self.run_batch_sandbox(documents, sandbox)
+            finally:
+                sandbox.close()
+            error_message = str(InterruptedConversion())
+        except Exception as e:
+            log.exception("An exception occurred while converting a batch")
+            error_message = str(e)
+
+        # Fail the documents that the containers did not convert, e.g., because one
+        # of them has crashed.
+        for document in documents:
+            if document.is_converting():
+                self.print_progress_trusted(document, True, error_message, 0)
+                self.mark_as_done(document, False)
+
+    def start_batch_sandbox(
+        self,
+        batch_size: int,
+        ocr_lang: Optional[str],
+        dpi: int,
+        limits: Optional[SandboxLimits] = None,
+        warm_libreoffice: bool = False,
+        pages: Optional[str] = None,
+    ) -> BatchSandbox:
+        """Start a pair of containers that will convert a batch of documents.
+
+        The containers wait for their input, so they can be started before the
+        documents are known. If `warm_libreoffice` is set, the first container starts
+        LibreOffice while it waits, so that Office documents skip its startup. If
+        `pages` is set, only the selected pages of each document are converted.
+        """
+        sandbox = BatchSandbox(batch_size, ocr_lang, dpi, limits)
+        safe_dir = sandbox.safe_dir
+
+        batch_env = {"BATCH_SIZE": str(batch_size)}
+        doc_to_pixels_env = {
+            **self.get_doc_to_pixels_env(dpi, limits, pages),
+            **batch_env,
+        }
+        if warm_libreoffice:
+            doc_to_pixels_env["WARM_LIBREOFFICE"] = "1"
+        batch_command = ["/usr/bin/python3", "-m", "dangerzone.conversion.batch"]
+
+        # Both stages keep their standard input open. The first one receives the
+        # documents through it, and the second one the pages of each document, which the
+        # host relays from the first one. Both of them exit once it is closed.
+        doc_to_pixels_args = self.get_container_args(
+            batch_command + ["doc_to_pixels"],
+            ["-i", "--name", sandbox.doc_to_pixels_name]
+            + self.get_env_args(doc_to_pixels_env)
+            + self.get_limit_args(limits),
+        )
+        pixels_to_pdf_args = self.get_container_args(
+            batch_command + ["pixels_to_pdf"],
+            ["-i", "--name", sandbox.pixels_to_pdf_name]
+            + ["-v", f"{safe_dir}:/safezone:Z"]
+            + self.get_env_args(
+                {**self.get_pixels_to_pdf_env(ocr_lang, dpi, limits), **batch_env}
+            )
+            + self.get_limit_args(limits),
+        )
+
+        try:
+            # Start the second stage first, so that it can convert each document to
+            # PDF, while the first stage is converting the next ones to pixels.
+            sandbox.pixels_to_pdf = self.start_stream_process(pixels_to_pdf_args)
+            sandbox.doc_to_pixels = self.start_stream_process(doc_to_pixels_args)
+        except Exception:
+            sandbox.close()
+            raise
+        return sandbox
+
+    def run_batch_sandbox(
+        self, documents: List[Document], sandbox: BatchSandbox
+    ) -> None:
+        """Convert a batch of documents in a pair of containers that have started."""
+        assert len(documents) == sandbox.batch_size
+        doc_to_pixels = sandbox.doc_to_pixels
+        pixels_to_pdf = sandbox.pixels_to_pdf
+        assert doc_to_pixels is not None and doc_to_pixels.stdin is not None
+        assert doc_to_pixels.stdout is not None
+        assert pixels_to_pdf is not None and pixels_to_pdf.stdin is not None
+        assert pixels_to_pdf.stdout is not None
+
+        def doc_to_pixels_done(index: int, error_code: int) -> None:
+            document = documents[index - 1]
+            # The log of each document precedes its error code.
+            untrusted_log = doc_to_pixels_stream.untrusted_log.decode(
+                "ascii", errors="replace"
+            )
+            doc_to_pixels_stream.untrusted_log.clear()
+            if getattr(sys, "dangerzone_dev", False):
+                log.info(
+                    f"Conversion output (doc to pixels):\n{self.sanitize_conversion_str(untrusted_log)}"
+                )
+            if error_code != 0:
+                log.error(f"documents-to-pixels failed for document {document.id}")
+                self.batch_document_failed(document, error_code)
+
+        def pixels_to_pdf_done(index: int, error_code: int) -> None:
+            document = documents[index - 1]
+            untrusted_log = pixels_to_pdf_stream.untrusted_log.decode(
+                "ascii", errors="replace"
+            )
+            pixels_to_pdf_stream.untrusted_log.clear()
+            if getattr(sys, "dangerzone_dev", False):
+                log.info(
+                    f"Container output: (pixels to PDF)\n"
+                    f"{PIXELS_TO_PDF_LOG_START}\n{untrusted_log}{PIXELS_TO_PDF_LOG_END}"
+                )
+            if error_code != 0:
+                log.error(f"pixels-to-pdf failed for document {document.id}")
+                self.batch_document_failed(document, error_code)
+                return
+
+            # The safe PDF of each document precedes its error code.
+            container_output_filename = sandbox.output_dir / f"{index}.pdf"
+            if not container_output_filename.exists():
+                log.error(f"pixels-to-pdf did not create document {document.id}")
+                self.batch_document_failed(
+                    document, UnexpectedConversionError.error_code
+                )
+                return
+
+            # Move the final file to the right place
+            if os.path.exists(document.output_filename):
+                os.remove(document.output_filename)
+            shutil.move(container_output_filename, document.output_filename)
+            self.mark_as_done(document, True)
+
+        doc_to_pixels_stream = ContainerStream(
+            doc_to_pixels.stdout,
+            lambda untrusted_line: self.parse_batch_progress(
+                documents, untrusted_line, doc_to_pixels_done
+            ),
+        )
+        pixels_to_pdf_stream = ContainerStream(
+            pixels_to_pdf.stdout,
+            lambda untrusted_line: self.parse_batch_progress(
+                documents, untrusted_line, pixels_to_pdf_done
+            ),
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            upload = executor.submit(
+                self.send_documents, documents, doc_to_pixels.stdin
+            )
+            relay = executor.submit(
+                self.relay_batch_pages,
+                documents,
+                sandbox,
+                doc_to_pixels_stream,
+            )
+            try:
+                self.receive_batch_pdfs(documents, sandbox, pixels_to_pdf_stream)
+                # The second stage fails as well when the first one does, so the
+                # errors of the first one take precedence.
+                relay.result()
+            except BaseException:
+                # Stop the containers, so that the threads that feed them do not wait
+                # for them forever.
+                sandbox.kill()
+                raise
+            upload.result()
+
+        rets = [
+            (doc_to_pixels.wait(), sandbox.doc_to_pixels_name),
+            (pixels_to_pdf.wait(), sandbox.pixels_to_pdf_name),
+        ]
+        if any(
+            ret == OutOfMemoryException.error_code and not self.was_killed(name)
+            for ret, name in rets
+        ):
+            # The kernel has killed a container as a whole, so the rest of its
+            # documents failed for the same reason.
+            raise OutOfMemoryException()
+
+    def relay_batch_pages(
+        self,
+        documents: List[Document],
+        sandbox: BatchSandbox,
+        stream: ContainerStream,
+    ) -> None:
+        """Relay the pages of each document that the first container of a batch has
+        converted to the second one.
+
+        The first container sends the pages of each document after the index of the
+        document, and the pages are checked as they are relayed. If anything is wrong
+        with them, the first container is no longer trusted to report on the rest of
+        the batch.
+        """
+        doc_to_pixels = sandbox.doc_to_pixels
+        assert doc_to_pixels is not None
+        assert sandbox.pixels_to_pdf is not None
+        pixels_to_pdf_stdin = sandbox.pixels_to_pdf.stdin
+        assert pixels_to_pdf_stdin is not None
+        last_index = 0
+        try:
+            while stream.has_data():
+                index = stream.read_int()
+                if not (last_index < index <= len(documents)):
+                    raise UnexpectedConversionError(
+                        "Invalid document index returned from container"
+                    )
+                last_index = index
+                n_pages = stream.read_int()
+                if n_pages == 0 or n_pages > errors.MAX_PAGES:
+                    raise errors.MaxPagesException()
+                pixels_to_pdf_stdin.write(index.to_bytes(2, "big", signed=False))
+                pixels_to_pdf_stdin.write(n_pages.to_bytes(2, "big", signed=False))
+                for _ in range(n_pages):
+                    self.relay_page(stream, pixels_to_pdf_stdin)
+                pixels_to_pdf_stdin.flush()
+        except BrokenPipeError:
+            # The second container has exited early, so the rest of the batch cannot
+            # be converted.
+            self.kill_container(sandbox.doc_to_pixels_name, doc_to_pixels)
+            raise InterruptedConversion()
+        except BaseException:
+            self.kill_container(sandbox.doc_to_pixels_name, doc_to_pixels)
+            raise
+        finally:
+            # Let the second container know that no more documents will show up.
+            try:
+                pixels_to_pdf_stdin.close()
+            except OSError:
+                pass
+
+    def receive_batch_pdfs(
+        self,
+        documents: List[Document],
+        sandbox: BatchSandbox,
+        stream: ContainerStream,
+    ) -> None:
+        """Receive the safe PDF of each document that the second container of a batch
+        has converted.
+
+        The second container sends the safe PDF of each document after the index of
+        the document and the size of the PDF.
+        """
+        last_index = 0
+        while stream.has_data():
+            index = stream.read_int()
+            if not (last_index < index <= len(documents)):
+                raise UnexpectedConversionError(
+                    "Invalid document index returned from container"
+                )
+            last_index = index
+            size = stream.read_int(BATCH_SAFE_PDF_SIZE_LEN)
+            with open(sandbox.output_dir / f"{index}.pdf", "wb") as f:
+                stream.copy_to(f, size)
+
+    def configure_pool(
+        self, size: int, idle_timeout: float = DEFAULT_POOL_IDLE_TIMEOUT
+    ) -> None:
+        """Configure the pool of warm sandboxes.
+
+        The pool keeps `size` sandboxes running, so that the conversion of a single
+        document does not have to wait for the containers to start. A size of 0
+        disables the pool. If no conversion takes place for `idle_timeout` seconds,
+        the sandboxes are discarded, until the next call to `warm_up()`.
+
+        The sandboxes stream their output, so the pool is always disabled where
+        streaming is not supported.
+        """
+        if not ContainerStream.is_supported():
+            size = 0
+        with self.pool_lock:
+            if self.pool_size == 0 and size > 0:
+                atexit.register(self.close_pool)
+            self.pool_size = size
+            self.pool_idle_timeout = idle_timeout
+        self.pool_wakeup.set()
+
+    def has_warm_sandboxes(self) -> bool:
+        return self.pool_size > 0
+
+    def warm_up(
+        self,
+        ocr_lang: Optional[str],
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
+    ) -> None:
+        if self.pool_size == 0:
+            return
+        with self.pool_lock:
+            self.pool_settings = (ocr_lang, dpi, limits)
+            self.pool_last_used = time.monotonic()
+            if self.pool_thread is None:
+                self.pool_thread = threading.Thread(
+                    target=self.maintain_pool, daemon=True
+                )
+                self.pool_thread.start()
+        self.pool_wakeup.set()
+
+    def take_from_pool(
+        self,
+        ocr_lang: Optional[str],
+        dpi: int,
+        limits: Optional[SandboxLimits] = None,
+    ) -> Optional[BatchSandbox]:
+        """Take a warm sandbox for a conversion with the given settings, if any."""
+        with self.pool_lock:
+            for sandbox in self.pool:
+                if sandbox.can_convert(ocr_lang, dpi, limits):
+                    if sandbox.is_alive():
+                        self.pool.remove(sandbox)
+                        return sandbox
+        return None
+
+    def maintain_pool(self) -> None:
+        """Keep the pool filled with warm sandboxes, in the background."""
+        while True:
+            with self.pool_lock:
+                if any(not sandbox.is_alive() for sandbox in self.pool):
+                    # A sandbox has exited on its own, e.g., because the container
+                    # image is not installed yet. Stop refilling the pool until the
+                    # next conversion, instead of starting containers in a loop.
+                    log.warning("A warm sandbox has exited unexpectedly")
+                    self.pool_last_used = 0.0
+                idle = time.monotonic() - self.pool_last_used > self.pool_idle_timeout
+                keep = []
+                if not idle:
+                    keep = [
+                        sandbox
+                        for sandbox in self.pool
+                        if sandbox.get_settings() == self.pool_settings
+                    ][: self.pool_size]
+                discard = [sandbox for sandbox in self.pool if sandbox not in keep]
+                self.pool = keep
+                missing = 0 if idle else self.pool_size - len(keep)
+                ocr_lang, dpi, limits = self.pool_settings
+
+            for sandbox in discard:
+                sandbox.close()
+
+            for _ in range(missing):
+                try:
+                    # Warm sandboxes wait for their document long enough for
+                    # LibreOffice to start in the meantime.
+                    sandbox = self.start_batch_sandbox(
+                        1, ocr_lang, dpi, limits, warm_libreoffice=True
+                    )
+                except Exception:
+                    log.exception("Could not start a warm sandbox")
+                    break
+                with self.pool_lock:
+                    self.pool.append(sandbox)
+
+            self.pool_wakeup.wait(POOL_CHECK_INTERVAL)
+            self.pool_wakeup.clear()
+
+    def close_pool(self) -> None:
+        """Discard the warm sandboxes of the pool."""
+        with self.pool_lock:
+            self.pool_size = 0
+            discard = self.pool
+            self.pool = []
+        for sandbox in discard:
+            sandbox.close()
+
+    def batch_document_failed(self, document: Document, error_code: int) -> None:
+        """Report a document of a batch as failed, based on its error code."""
+        try:
+            # XXX Reconstruct exception from error code
+            error_message = str(exception_from_error_code(error_code))
+        except ValueError as e:
+            error_message = str(e)
+        self.print_progress_trusted(document, True, error_message, 0)
+        self.mark_as_done(document, False)
+
     def get_max_parallel_conversions(self) -> int:
-        # FIXME hardcoded 1 until timeouts are more limited and better handled
-        # https://github.com/freedomofpress/dangerzone/issues/257
-        return 1
+        # The conversions are further limited by the CPUs and memory that they are
+        # expected to use (see `dangerzone/scheduler.py`).
+        return 2 * self.get_cpu_count() + 1
 
-        n_cpu = 1  # type: ignore [unreachable]
+    def get_cpu_count(self) -> int:
+        """Get the number of CPUs that are available to the containers."""
+        n_cpu = 1
         if platform.system() == "Linux":
             # if on linux containers run natively
             cpu_count = os.cpu_count()
@@ -382,4 +1696,22 @@ class Container(IsolationProvider):
             )
             n_cpu = int(n_cpu_str.strip())
 
-        return 2 * n_cpu + 1
+        return n_cpu
+
+    def get_memory_size(self) -> Optional[int]:
+        """Get the memory (in bytes) that is available to the containers, if known."""
+        if platform.system() == "Linux":
+            # if on linux containers run natively
+            return super().get_memory_size()
+
+        elif self.get_runtime_name() == "docker":
+            # For Windows and MacOS containers run in VM
+            # So we obtain the memory of the VM
+            mem_str = subprocess.check_output(
+                [self.get_runtime(), "info", "--format", "{{.MemTotal}}"],
+                text=True,
+                startupinfo=get_subprocess_startupinfo(),
+            )
+            return int(mem_str.strip())
+
+        return None
@@ -5,9 +5,10 @@ import sys
 import time
 from typing import Callable, Optional
 
+from ..conversion.common import DEFAULT_DPI
 from ..document import Document
 from ..util import get_resource_path
-from .base import IsolationProvider
+from .base import IsolationProvider, SandboxLimits
 
 log = logging.getLogger(__name__)
 
@@ -34,12 +35,16 @@ class Dummy(IsolationProvider):
         self,
         document: Document,
         ocr_lang: Optional[str],
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
     ) -> bool:
         log.debug("Dummy converter started:")
         log.debug(
             f"  - document: {os.path.basename(document.input_filename)} ({document.id})"
         )
         log.debug(f"  - ocr     : {ocr_lang}")
+        log.debug(f"  - dpi     : {dpi}")
+        log.debug(f"  - limits  : {limits}")
         log.debug("\n(simulating conversion)")
 
         success = True
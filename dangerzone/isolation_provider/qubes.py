@@ -3,18 +3,28 @@ import glob
 import inspect
 import io
 import logging
+import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import zipfile
 from pathlib import Path
-from typing import IO, Callable, Optional
+from typing import IO, AsyncIterator, Callable, List, Optional, Tuple
 
 from ..conversion import errors
-from ..conversion.common import calculate_timeout, running_on_qubes
+from ..conversion.common import (
+    DEFAULT_DPI,
+    PAGE_DEPTHS,
+    calculate_timeout,
+    get_pixels_size,
+    inflate_pixels,
+    max_deflated_size,
+    running_on_qubes,
+)
 from ..conversion.pixels_to_pdf import PixelsToPDF
 from ..document import Document
 from ..util import (
@@ -23,12 +33,14 @@ from ..util import (
     get_subprocess_startupinfo,
     get_tmp_dir,
     nonblocking_read,
+    nonblocking_readinto,
 )
 from .base import (
     MAX_CONVERSION_LOG_CHARS,
     PIXELS_TO_PDF_LOG_END,
     PIXELS_TO_PDF_LOG_START,
     IsolationProvider,
+    SandboxLimits,
 )
 
 log = logging.getLogger(__name__)
@@ -36,6 +48,11 @@ log = logging.getLogger(__name__)
 # The maximum time a qube takes to start up.
 STARTUP_TIME_SECONDS = 5 * 60  # 5 minutes
 
+# The size of the chunks that the document is sent in, and how often (in percentage
+# points) the progress of the upload is reported.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_PROGRESS_STEP = 10
+
 
 def read_bytes(f: IO[bytes], size: int, timeout: float, exact: bool = True) -> bytes:
     """Read bytes from a file-like object."""
@@ -45,9 +62,15 @@ def read_bytes(f: IO[bytes], size: int, timeout: float, exact: bool = True) -> b
     return buf
 
 
-def read_int(f: IO[bytes], timeout: float) -> int:
-    """Read 2 bytes from a file-like object, and decode them as int."""
-    untrusted_int = read_bytes(f, 2, timeout)
+def read_bytes_into(f: IO[bytes], buf: memoryview, timeout: float) -> None:
+    """Read exactly `len(buf)` bytes from a file-like object into a buffer."""
+    if nonblocking_readinto(f, buf, timeout) != len(buf):
+        raise errors.InterruptedConversion
+
+
+def read_int(f: IO[bytes], timeout: float, size: int = 2) -> int:
+    """Read `size` bytes from a file-like object, and decode them as int."""
+    untrusted_int = read_bytes(f, size, timeout)
     return int.from_bytes(untrusted_int, signed=False)
 
 
@@ -61,8 +84,13 @@ def read_debug_text(f: IO[bytes], size: int) -> str:
 class Qubes(IsolationProvider):
     """Uses a disposable qube for performing the conversion"""
 
-    def __init__(self) -> None:
+    def __init__(self, compress_pixels: bool = False) -> None:
         self.proc: Optional[subprocess.Popen] = None
+        # Whether the disposable qube compresses the pages before it sends them. This
+        # trades CPU time for less data to copy, so it is opt-in.
+        self.compress_pixels = compress_pixels
+        # The pages are OCRed in parallel, one for each CPU of this qube.
+        self.ocr_workers = os.cpu_count() or 1
         super().__init__()
 
     def install(self) -> bool:
@@ -73,87 +101,152 @@ class Qubes(IsolationProvider):
         document: Document,
         tempdir: str,
         ocr_lang: Optional[str] = None,
+        dpi: int = DEFAULT_DPI,
     ) -> bool:
         success = False
-
-        Path(f"{tempdir}/dangerzone").mkdir()
         percentage = 0.0
 
-        with open(document.input_filename, "rb") as f:
-            self.proc = self.qrexec_subprocess()
+        self.proc = self.qrexec_subprocess()
+        proc = self.proc
+
+        # Stream the document to the disposable qube in the background, and start
+        # waiting for its page count in the meantime.
+        upload_errors: List[Exception] = []
+
+        def upload() -> None:
             try:
-                assert self.proc.stdin is not None
-                self.proc.stdin.write(f.read())
-                self.proc.stdin.close()
-            except BrokenPipeError as e:
-                raise errors.InterruptedConversion()
+                self.send_document(document, dpi)
+            except Exception as e:
+                upload_errors.append(e)
+                # The disposable qube would otherwise wait for the rest of the
+                # document, and the page count would never arrive.
+                proc.kill()
 
-            # Get file size (in MiB)
-            size = os.path.getsize(document.input_filename) / 1024**2
-            timeout = calculate_timeout(size) + STARTUP_TIME_SECONDS
+        uploader = threading.Thread(target=upload, daemon=True)
+        uploader.start()
 
-            assert self.proc is not None
-            assert self.proc.stdout is not None
-            os.set_blocking(self.proc.stdout.fileno(), False)
+        # Get file size (in MiB)
+        size = os.path.getsize(document.input_filename) / 1024**2
+        timeout = calculate_timeout(size) + STARTUP_TIME_SECONDS
+
+        assert self.proc is not None
+        assert self.proc.stdout is not None
+        os.set_blocking(self.proc.stdout.fileno(), False)
 
+        try:
             n_pages = read_int(self.proc.stdout, timeout)
-            if n_pages == 0 or n_pages > errors.MAX_PAGES:
-                raise errors.MaxPagesException()
-            percentage_per_page = 50.0 / n_pages
-
-            timeout = calculate_timeout(size, n_pages)
-            sw = Stopwatch(timeout)
-            sw.start()
-            for page in range(1, n_pages + 1):
-                text = f"Converting page {page}/{n_pages} to pixels"
-                self.print_progress_trusted(document, False, text, percentage)
-
-                width = read_int(self.proc.stdout, timeout=sw.remaining)
-                height = read_int(self.proc.stdout, timeout=sw.remaining)
-                if not (1 <= width <= errors.MAX_PAGE_WIDTH):
-                    raise errors.MaxPageWidthException()
-                if not (1 <= height <= errors.MAX_PAGE_HEIGHT):
-                    raise errors.MaxPageHeightException()
-
-                num_pixels = width * height * 3  # three color channels
+        except BaseException:
+            # If the upload had failed, its error is what caused this one. Otherwise,
+            # stop the disposable qube, so that the upload does not block on it.
+            upload_failed = bool(upload_errors)
+            self.proc.kill()
+            uploader.join()
+            if upload_failed:
+                raise upload_errors[0]
+            raise
+        # The disposable qube counts the pages only after it has received the whole
+        # document, so the upload has finished by now.
+        uploader.join()
+        if upload_errors:
+            raise upload_errors[0]
+        if n_pages == 0 or n_pages > errors.MAX_PAGES:
+            raise errors.MaxPagesException()
+        percentage_per_page = 50.0 / n_pages
+
+        timeout = calculate_timeout(size, n_pages, dpi)
+        sw = Stopwatch(timeout)
+        sw.start()
+        # The compressed pixels of each page, if any, are read into the same buffer,
+        # which grows to fit the largest page so far.
+        deflated_buf = bytearray()
+
+        def read_page(page: int) -> Tuple[int, int, int, bytes]:
+            nonlocal deflated_buf, percentage
+            assert self.proc is not None
+            assert self.proc.stdout is not None
+            text = f"Converting page {page}/{n_pages} to pixels"
+            self.print_progress_trusted(document, False, text, percentage)
+
+            width = read_int(self.proc.stdout, timeout=sw.remaining)
+            height = read_int(self.proc.stdout, timeout=sw.remaining)
+            if not (1 <= width <= errors.MAX_PAGE_WIDTH):
+                raise errors.MaxPageWidthException()
+            if not (1 <= height <= errors.MAX_PAGE_HEIGHT):
+                raise errors.MaxPageHeightException()
+            depth = read_int(self.proc.stdout, timeout=sw.remaining)
+            if depth not in PAGE_DEPTHS:
+                raise errors.InvalidPixelData()
+
+            # The pixels may be compressed, so read their size first, and make sure
+            # that it is within bounds, before reading them.
+            pixels_size = get_pixels_size(width, height, depth)
+            data_size = read_int(self.proc.stdout, sw.remaining, size=4)
+            if not self.compress_pixels:
+                if data_size != pixels_size:
+                    raise errors.InvalidPixelData()
                 untrusted_pixels = read_bytes(
-                    self.proc.stdout,
-                    num_pixels,
-                    timeout=sw.remaining,
+                    self.proc.stdout, pixels_size, sw.remaining
                 )
-
-                # Wrapper code
-                with open(f"{tempdir}/dangerzone/page-{page}.width", "w") as f_width:
-                    f_width.write(str(width))
-                with open(f"{tempdir}/dangerzone/page-{page}.height", "w") as f_height:
-                    f_height.write(str(height))
-                with open(f"{tempdir}/dangerzone/page-{page}.rgb", "wb") as f_rgb:
-                    f_rgb.write(untrusted_pixels)
-
-                percentage += percentage_per_page
-
-        # Ensure nothing else is read after all bitmaps are obtained
-        self.proc.stdout.close()
-
-        # TODO handle leftover code input
-        text = "Converted document to pixels"
-        self.print_progress_trusted(document, False, text, percentage)
-
-        if getattr(sys, "dangerzone_dev", False):
-            assert self.proc.stderr is not None
-            os.set_blocking(self.proc.stderr.fileno(), False)
-            untrusted_log = read_debug_text(self.proc.stderr, MAX_CONVERSION_LOG_CHARS)
-            self.proc.stderr.close()
-            log.info(
-                f"Conversion output (doc to pixels)\n{self.sanitize_conversion_str(untrusted_log)}"
-            )
+            else:
+                # A compressed page is never empty, and empty reads are not
+                # supported anyway.
+                if not (1 <= data_size <= max_deflated_size(pixels_size)):
+                    raise errors.InvalidPixelData()
+                if len(deflated_buf) < data_size:
+                    deflated_buf = bytearray(data_size)
+                with memoryview(deflated_buf)[:data_size] as untrusted_deflated:
+                    read_bytes_into(self.proc.stdout, untrusted_deflated, sw.remaining)
+                    untrusted_pixels = inflate_pixels(untrusted_deflated, pixels_size)
+
+            percentage += percentage_per_page
+            return width, height, depth, untrusted_pixels
+
+        async def read_pages() -> AsyncIterator[Tuple[int, int, int, bytes]]:
+            """Hand the pages over to the PDF conversion, without storing them.
+
+            Each page is read in a thread, while the previous one is converted to PDF.
+            """
+            assert self.proc is not None
+            assert self.proc.stdout is not None
+            loop = asyncio.get_running_loop()
+            next_page = loop.run_in_executor(None, read_page, 1)
+            try:
+                for page in range(1, n_pages + 1):
+                    untrusted_page = await next_page
+                    if page < n_pages:
+                        next_page = loop.run_in_executor(None, read_page, page + 1)
+                    else:
+                        self.doc_to_pixels_done(document, percentage)
+                    yield untrusted_page
+            except errors.InterruptedConversion:
+                # The disposable qube has exited, and its exit code tells why.
+                raise
+            except BaseException:
+                # The conversion has failed midway. Stop the disposable qube, so that
+                # it does not keep sending pages that nobody reads.
+                self.proc.kill()
+                next_page.cancel()
+                raise
 
         def print_progress_wrapper(error: bool, text: str, percentage: float) -> None:
             self.print_progress_trusted(document, error, text, percentage)
 
         converter = PixelsToPDF(progress_callback=print_progress_wrapper)
         try:
-            asyncio.run(converter.convert(ocr_lang, tempdir))
+            asyncio.run(
+                converter.convert_pages(
+                    read_pages(),
+                    n_pages,
+                    f"{tempdir}/safe-output-compressed.pdf",
+                    ocr_lang,
+                    pipeline=True,
+                    dpi=dpi,
+                    ocr_workers=self.ocr_workers,
+                    # The OCR workers must not inherit the state of the host process,
+                    # such as an already loaded PyMuPDF (see `limit_ocr_threads()`).
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            )
         except (RuntimeError, TimeoutError, ValueError) as e:
             raise errors.UnexpectedConversionError(str(e))
         finally:
@@ -170,14 +263,74 @@ class Qubes(IsolationProvider):
 
         return success
 
+    def doc_to_pixels_done(self, document: Document, percentage: float) -> None:
+        """Wrap up the doc-to-pixels stage, once all the pages have been read."""
+        assert self.proc is not None
+        assert self.proc.stdout is not None
+        # Ensure nothing else is read after all bitmaps are obtained
+        self.proc.stdout.close()
+
+        # TODO handle leftover code input
+        text = "Converted document to pixels"
+        self.print_progress_trusted(document, False, text, percentage)
+
+        if getattr(sys, "dangerzone_dev", False):
+            assert self.proc.stderr is not None
+            os.set_blocking(self.proc.stderr.fileno(), False)
+            untrusted_log = read_debug_text(self.proc.stderr, MAX_CONVERSION_LOG_CHARS)
+            self.proc.stderr.close()
+            log.info(
+                f"Conversion output (doc to pixels)\n{self.sanitize_conversion_str(untrusted_log)}"
+            )
+
+    def send_document(self, document: Document, dpi: int) -> None:
+        """Send the conversion options, the selected pages and the document to the
+        disposable qube.
+
+        The document is sent in chunks, instead of being read in memory as a whole.
+        Writes block while the disposable qube is not reading, so the upload never
+        runs ahead of it.
+        """
+        assert self.proc is not None
+        assert self.proc.stdin is not None
+        total = os.path.getsize(document.input_filename)
+        sent = 0
+        reported = 0
+        buf = bytearray(UPLOAD_CHUNK_SIZE)
+        try:
+            # Send the resolution that the pages should be rendered in, whether they
+            # should be compressed, and the pages that should be rendered, before the
+            # document itself.
+            self.proc.stdin.write(dpi.to_bytes(2, signed=False))
+            self.proc.stdin.write(int(self.compress_pixels).to_bytes(2, signed=False))
+            pages = (document.pages or "").encode()
+            self.proc.stdin.write(len(pages).to_bytes(2, signed=False))
+            self.proc.stdin.write(pages)
+            with open(document.input_filename, "rb") as f, memoryview(buf) as view:
+                while n := f.readinto(buf):
+                    self.proc.stdin.write(view[:n])
+                    sent += n
+                    percent = sent * 100 // total
+                    if percent >= reported + UPLOAD_PROGRESS_STEP or sent == total:
+                        reported = percent
+                        text = f"Sending document to the disposable qube ({percent}%)"
+                        self.print_progress_trusted(document, False, text, 0)
+            self.proc.stdin.close()
+        except BrokenPipeError as e:
+            raise errors.InterruptedConversion()
+
     def _convert(
         self,
         document: Document,
         ocr_lang: Optional[str] = None,
+        dpi: int = DEFAULT_DPI,
+        limits: Optional[SandboxLimits] = None,
     ) -> bool:
+        # The resources of the disposable qubes are managed by Qubes OS, so the
+        # limits do not apply here.
         try:
             with tempfile.TemporaryDirectory() as t:
-                return self.__convert(document, t, ocr_lang)
+                return self.__convert(document, t, ocr_lang, dpi)
         except errors.InterruptedConversion:
             assert self.proc is not None
             error_code = self.proc.wait(3)
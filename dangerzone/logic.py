@@ -1,24 +1,36 @@
+import atexit
 import concurrent.futures
 import gzip
 import json
 import logging
+import os
 import pathlib
 import platform
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 from typing import Callable, List, Optional
 
 import colorama
 
-from . import errors, util
+from . import errors, scheduler, util
+from .cache import PixelCache, SafePDFCache
+from .conversion.common import DEFAULT_DPI, PREVIEW_DPI, PREVIEW_PAGES
+from .conversion.errors import MAX_INPUT_SIZE, MaxInputSizeException
 from .document import Document
-from .isolation_provider.base import IsolationProvider
+from .isolation_provider.base import IsolationProvider, SandboxLimits
+from .scheduler import MEMORY_BUDGET_FRACTION, ConversionCost, ResourceBudget
 from .settings import Settings
 from .util import get_resource_path
 
 log = logging.getLogger(__name__)
 
+# Convert the documents in batch mode, if there are at least this many of them. Below
+# that, the startup cost of the isolation provider is not worth amortizing.
+BATCH_MIN_DOCUMENTS = 5
+
 
 class DangerzoneCore(object):
     """
@@ -44,13 +56,27 @@ class DangerzoneCore(object):
 
         self.isolation_provider = isolation_provider
 
+        self.resource_budget: Optional[ResourceBudget] = None
+        self.resource_budget_lock = threading.Lock()
+
+        # The directory of the previews of documents (see `preview_document()`).
+        self.preview_dir: Optional[tempfile.TemporaryDirectory] = None
+        self.preview_dir_lock = threading.Lock()
+
+        self.safe_pdf_cache: Optional[SafePDFCache] = None
+        if self.settings.get("safe_pdf_cache"):
+            self.enable_safe_pdf_cache()
+        if self.settings.get("pixel_cache"):
+            self.enable_pixel_cache()
+
     def add_document_from_filename(
         self,
         input_filename: str,
         output_filename: Optional[str] = None,
         archive: bool = False,
+        pages: Optional[str] = None,
     ) -> None:
-        doc = Document(input_filename, output_filename, archive=archive)
+        doc = Document(input_filename, output_filename, archive=archive, pages=pages)
         self.add_document(doc)
 
     def add_document(self, doc: Document) -> None:
@@ -69,19 +95,254 @@ class DangerzoneCore(object):
         log.debug("Removing all documents")
         self.documents = []
 
-    def convert_documents(
-        self, ocr_lang: Optional[str], stdout_callback: Optional[Callable] = None
+    def get_resource_budget(self) -> ResourceBudget:
+        """Get the resources of the host that the conversions share.
+
+        The budget is computed on first use, since querying the isolation provider may
+        require it to be up and running.
+        """
+        with self.resource_budget_lock:
+            if self.resource_budget is None:
+                cpus = self.isolation_provider.get_cpu_count()
+                memory = self.isolation_provider.get_memory_size()
+                if memory is not None:
+                    memory = int(memory * MEMORY_BUDGET_FRACTION)
+                max_jobs = self.isolation_provider.get_max_parallel_conversions()
+                self.resource_budget = ResourceBudget(cpus, memory, max_jobs)
+                log.debug(f"Converting documents within {self.resource_budget}")
+            return self.resource_budget
+
+    def estimate_cost(self, document: Document, dpi: int) -> ConversionCost:
+        cpus = self.get_resource_budget().cpus
+        return scheduler.estimate_cost(document, dpi, cpus)
+
+    def get_sandbox_limits(self, cost: ConversionCost) -> SandboxLimits:
+        return scheduler.get_sandbox_limits(cost, self.get_resource_budget())
+
+    def enable_safe_pdf_cache(self) -> None:
+        """Reuse the safe PDFs of documents that have been converted before."""
+        if self.safe_pdf_cache is None:
+            self.safe_pdf_cache = SafePDFCache(
+                os.path.join(self.appdata_path, "safe-pdf-cache"),
+                self.settings.get("safe_pdf_cache_size"),
+            )
+
+    def enable_pixel_cache(self) -> None:
+        """Reuse the pages of documents that have been converted to pixels before."""
+        self.isolation_provider.use_pixel_cache(
+            PixelCache(
+                os.path.join(self.appdata_path, "pixel-cache"),
+                self.settings.get("pixel_cache_size"),
+            )
+        )
+
+    def get_safe_pdf_cache_key(
+        self, document: Document, ocr_lang: Optional[str], dpi: int
+    ) -> Optional[str]:
+        """Get the key of the safe PDF of a document in the cache, if it is enabled.
+
+        The key must be computed before the conversion, since the document may be
+        archived afterwards.
+        """
+        if self.safe_pdf_cache is None:
+            return None
+        return self.safe_pdf_cache.get_key(
+            document.input_filename, ocr_lang=ocr_lang, dpi=dpi, pages=document.pages
+        )
+
+    def convert_from_cache(
+        self,
+        document: Document,
+        key: str,
+        stdout_callback: Optional[Callable] = None,
+    ) -> bool:
+        """Convert a document by copying its cached safe PDF, if there is one."""
+        assert self.safe_pdf_cache is not None
+        if not self.safe_pdf_cache.get(key, document.output_filename):
+            return False
+        log.info(f"Using the cached safe PDF of {document.input_filename}")
+        if stdout_callback:
+            stdout_callback(False, "Using the cached safe PDF", 100)
+        self.isolation_provider.mark_as_done(document, True)
+        return True
+
+    def reject_oversized(
+        self,
+        document: Document,
+        stdout_callback: Optional[Callable] = None,
+    ) -> bool:
+        """Fail a document that is too large, without starting a sandbox for it.
+
+        The sandbox rejects such documents as well, since it does not trust the host.
+        """
+        try:
+            if os.path.getsize(document.input_filename) <= MAX_INPUT_SIZE:
+                return False
+        except OSError:
+            return False
+        error = MaxInputSizeException()
+        log.error(f"Rejecting {document.input_filename}: {error}")
+        if stdout_callback:
+            stdout_callback(True, str(error), 0)
+        self.isolation_provider.mark_as_done(document, False)
+        return True
+
+    def cache_safe_pdf(self, document: Document, key: Optional[str]) -> None:
+        """Store the safe PDF of a document in the cache, if it has been converted."""
+        if self.safe_pdf_cache is None or key is None or not document.is_safe():
+            return
+        try:
+            self.safe_pdf_cache.put(key, document.output_filename)
+        except OSError as e:
+            log.warning(
+                f"Could not cache the safe PDF of {document.input_filename}: {e}"
+            )
+
+    def warm_up(self, ocr_lang: Optional[str], dpi: int, document: Document) -> None:
+        """Prepare the isolation provider for the conversion of a document.
+
+        This is called from the GUI thread, so it does not query the capacity of the
+        host, nor count the pages of the document. The limits are those of a single-CPU
+        conversion of the same size class.
+        """
+        if not self.isolation_provider.has_warm_sandboxes():
+            return
+        limits = scheduler.get_sandbox_limits(scheduler.estimate_cost(document, dpi))
+        self.isolation_provider.warm_up(ocr_lang, dpi, limits)
+
+    def convert_document(
+        self,
+        document: Document,
+        ocr_lang: Optional[str],
+        stdout_callback: Optional[Callable] = None,
+        dpi: int = DEFAULT_DPI,
     ) -> None:
-        def convert_doc(document: Document) -> None:
+        """Convert a document, once the host has the resources for it."""
+        if self.reject_oversized(document, stdout_callback):
+            return
+        key = self.get_safe_pdf_cache_key(document, ocr_lang, dpi)
+        if key is not None and self.convert_from_cache(document, key, stdout_callback):
+            return
+        cost = self.estimate_cost(document, dpi)
+        limits = self.get_sandbox_limits(cost)
+        with self.get_resource_budget().reserve(cost):
             self.isolation_provider.convert(
-                document,
-                ocr_lang,
-                stdout_callback,
+                document, ocr_lang, stdout_callback, dpi, limits
             )
+        self.cache_safe_pdf(document, key)
+        if self.safe_pdf_cache is not None:
+            self.safe_pdf_cache.save_stats()
+
+    def get_preview_dir(self) -> str:
+        """Get the directory of the previews, which is removed once Dangerzone exits."""
+        with self.preview_dir_lock:
+            if self.preview_dir is None:
+                self.preview_dir = tempfile.TemporaryDirectory(
+                    prefix="dangerzone_preview_"
+                )
+                atexit.register(self.preview_dir.cleanup)
+            return self.preview_dir.name
+
+    def preview_document(
+        self,
+        document: Document,
+        stdout_callback: Optional[Callable] = None,
+    ) -> Optional[str]:
+        """Convert the first pages of a document quickly, so that it can be previewed.
+
+        The preview is converted at a low resolution and without OCR, to a temporary
+        PDF, while the document itself stays unconverted. Return the filename of the
+        preview, or None if it could not be converted.
+
+        The PDF viewer opens the preview on its own, so there is no telling when it is
+        done with it. The previews are removed once Dangerzone exits instead.
+        """
+        fd, preview_filename = tempfile.mkstemp(
+            suffix=".pdf", dir=self.get_preview_dir()
+        )
+        os.close(fd)
+        preview = Document(
+            document.input_filename, preview_filename, pages=f"1-{PREVIEW_PAGES}"
+        )
+        self.convert_document(preview, None, stdout_callback, PREVIEW_DPI)
+        if not preview.is_safe():
+            os.remove(preview_filename)
+            return None
+        return preview_filename
+
+    def convert_documents(
+        self,
+        ocr_lang: Optional[str],
+        stdout_callback: Optional[Callable] = None,
+        dpi: int = DEFAULT_DPI,
+    ) -> None:
+        keys = {}
+        documents = []
+        for document in self.documents:
+            if self.reject_oversized(document, stdout_callback):
+                continue
+            key = self.get_safe_pdf_cache_key(document, ocr_lang, dpi)
+            if key is not None and self.convert_from_cache(
+                document, key, stdout_callback
+            ):
+                continue
+            keys[document] = key
+            documents.append(document)
+        if documents:
+            self._convert_documents(documents, ocr_lang, stdout_callback, dpi)
+        for document, key in keys.items():
+            self.cache_safe_pdf(document, key)
+        if self.safe_pdf_cache is not None:
+            self.safe_pdf_cache.save_stats()
+            log.debug(f"Safe PDF cache statistics: {self.safe_pdf_cache.stats}")
+
+    def _convert_documents(
+        self,
+        documents: List[Document],
+        ocr_lang: Optional[str],
+        stdout_callback: Optional[Callable] = None,
+        dpi: int = DEFAULT_DPI,
+    ) -> None:
+        budget = self.get_resource_budget()
+        costs = {document: self.estimate_cost(document, dpi) for document in documents}
+
+        def get_batch_cost(batch: List[Document]) -> ConversionCost:
+            # A batch converts one document at a time, so it needs as many resources
+            # as the most expensive of them.
+            return ConversionCost(
+                max(costs[document].cpus for document in batch),
+                max(costs[document].memory for document in batch),
+            )
+
+        if len(documents) >= BATCH_MIN_DOCUMENTS:
+            # Convert the documents in as many parallel batches as the budget allows
+            # for the most expensive of them, while keeping each batch large enough to
+            # amortize the startup cost of the isolation provider.
+            n_batches = min(
+                budget.max_parallel(get_batch_cost(documents)),
+                len(documents) // BATCH_MIN_DOCUMENTS,
+            )
+            batches = scheduler.split_batches(documents, n_batches)
+        else:
+            batches = [[document] for document in documents]
+
+        def convert_batch(batch: List[Document]) -> None:
+            cost = get_batch_cost(batch)
+            limits = self.get_sandbox_limits(cost)
+            with budget.reserve(cost):
+                if len(batch) == 1:
+                    self.isolation_provider.convert(
+                        batch[0], ocr_lang, stdout_callback, dpi, limits
+                    )
+                else:
+                    self.isolation_provider.convert_batch(
+                        batch, ocr_lang, stdout_callback, dpi, limits
+                    )
 
-        max_jobs = self.isolation_provider.get_max_parallel_conversions()
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as executor:
-            executor.map(convert_doc, self.documents)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(budget.max_jobs, len(batches))
+        ) as executor:
+            executor.map(convert_batch, batches)
 
     def get_unconverted_documents(self) -> List[Document]:
         return [doc for doc in self.documents if doc.is_unconverted()]
@@ -0,0 +1,223 @@
+import contextlib
+import logging
+import os
+import re
+import threading
+from typing import Iterator, List, Optional
+
+from .conversion.common import DEFAULT_DPI, max_rendered_pages
+from .conversion.errors import MAX_PAGES
+from .document import Document
+from .isolation_provider.base import SandboxLimits
+
+log = logging.getLogger(__name__)
+
+# The memory (in bytes) that a conversion needs regardless of the document, for the
+# Python interpreters and PyMuPDF in the sandbox.
+MEMORY_PER_CONVERSION = 256 * 1024**2
+
+# The memory (in bytes) that LibreOffice needs, for documents that are not PDFs or
+# images.
+MEMORY_PER_LIBREOFFICE = 512 * 1024**2
+
+# How many times its size a document takes up in memory, once it is opened. Office
+# documents are compressed archives, so they expand a lot more than PDFs.
+PDF_EXPANSION_FACTOR = 2
+OFFICE_EXPANSION_FACTOR = 10
+
+# The number of pages per MiB that is assumed for a document, if its pages cannot be
+# counted before the conversion.
+ESTIMATED_PAGES_PER_MB = 10
+
+# The size (in inches) of the pages that is assumed for a document (US Letter).
+ESTIMATED_PAGE_WIDTH = 8.5
+ESTIMATED_PAGE_HEIGHT = 11
+
+# The number of pages that keep one CPU busy, when the pages of a document are
+# rendered in parallel.
+PAGES_PER_CPU = 8
+
+# The fraction of the available memory that the conversions can use, leaving some room
+# for the rest of the system.
+MEMORY_BUDGET_FRACTION = 0.75
+
+# The memory limits (in bytes) of the sandboxes, one for each size class of documents.
+# A sandbox gets the smallest limit that leaves enough headroom over the memory that its
+# conversion is expected to use.
+SANDBOX_MEMORY_CLASSES = [n * 1024**3 for n in (1, 2, 4, 8, 16)]
+SANDBOX_MEMORY_HEADROOM = 2
+
+# The maximum number of processes (and threads) in a sandbox. LibreOffice, the render
+# workers and Tesseract need a few dozens of them.
+SANDBOX_PIDS_LIMIT = 512
+
+# Extensions of the documents that the sandbox opens directly with PyMuPDF, instead of
+# LibreOffice.
+PYMUPDF_EXTENSIONS = {".pdf", ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff"}
+
+# Matches the page objects (but not the page tree objects) of a PDF.
+PDF_PAGE_RE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+
+class ConversionCost:
+    """The resources that a conversion is expected to use while it runs."""
+
+    def __init__(self, cpus: int, memory: int) -> None:
+        self.cpus = cpus
+        self.memory = memory
+
+    def __repr__(self) -> str:
+        return f"ConversionCost(cpus={self.cpus}, memory={self.memory})"
+
+
+def count_pdf_pages(filename: str) -> Optional[int]:
+    """Count the pages of a PDF, without parsing it.
+
+    This is only a hint for scheduling, since the document is untrusted. The pages are
+    not visible this way if the PDF stores its objects compressed, in which case this
+    function returns None.
+    """
+    pages = 0
+    tail = b""
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            # Prepend the end of the previous chunk, in case a match spans both of
+            # them, but skip the matches that were counted along with that chunk.
+            data = tail + chunk
+            for m in PDF_PAGE_RE.finditer(data):
+                if m.end() > len(tail):
+                    pages += 1
+            tail = data[-32:]
+            if pages > MAX_PAGES:
+                break
+    return min(pages, MAX_PAGES) if pages > 0 else None
+
+
+def estimate_cost(
+    document: Document, dpi: int = DEFAULT_DPI, cpu_count: int = 1
+) -> ConversionCost:
+    """Estimate the cost of converting a document, from its size, type and pages."""
+    size = os.path.getsize(document.input_filename)
+    _, ext = os.path.splitext(document.input_filename.lower())
+    is_pdf = ext == ".pdf"
+    uses_libreoffice = ext not in PYMUPDF_EXTENSIONS
+
+    # The pages only decide how many CPUs the conversion gets, so they are not counted
+    # if it can get only one.
+    pages = None
+    if is_pdf and cpu_count > 1:
+        try:
+            pages = count_pdf_pages(document.input_filename)
+        except OSError:
+            pass
+    if pages is None:
+        pages = max(1, min(int(size / 1024**2 * ESTIMATED_PAGES_PER_MB), MAX_PAGES))
+
+    # The pages are rendered in parallel, but a few pages are not worth more than one
+    # CPU.
+    cpus = max(1, min(pages // PAGES_PER_CPU, cpu_count))
+
+    memory = MEMORY_PER_CONVERSION
+    if uses_libreoffice:
+        memory += MEMORY_PER_LIBREOFFICE + size * OFFICE_EXPANSION_FACTOR
+    else:
+        memory += size * PDF_EXPANSION_FACTOR
+    # The doc-to-pixels stage renders a page on each CPU, and the next stage holds one
+    # more page.
+    page_pixels = int(ESTIMATED_PAGE_WIDTH * dpi) * int(ESTIMATED_PAGE_HEIGHT * dpi) * 3
+    memory += page_pixels * (max_rendered_pages(cpus) + 1)
+
+    return ConversionCost(cpus, memory)
+
+
+class ResourceBudget:
+    """Admit conversions as long as the CPUs and memory of the host suffice.
+
+    Conversions are admitted in the order they ask for resources, so that large
+    documents are not starved by smaller ones. A conversion that does not fit in the
+    budget at all is admitted once no other conversion runs. Misbehaving conversions
+    do not hold their resources forever, since the isolation providers enforce
+    timeouts.
+    """
+
+    def __init__(self, cpus: int, memory: Optional[int], max_jobs: int) -> None:
+        self.cpus = cpus
+        self.memory = memory
+        self.max_jobs = max(1, max_jobs)
+        self.free_cpus = cpus
+        self.free_memory = memory
+        self.running = 0
+        self.next_ticket = 0
+        self.serving = 0
+        self.cond = threading.Condition()
+
+    def __repr__(self) -> str:
+        return (
+            f"ResourceBudget(cpus={self.cpus}, memory={self.memory},"
+            f" max_jobs={self.max_jobs})"
+        )
+
+    def fits(self, cost: ConversionCost) -> bool:
+        """Check if a conversion fits in the resources that are free right now."""
+        if self.running == 0:
+            return True
+        if self.running >= self.max_jobs or cost.cpus > self.free_cpus:
+            return False
+        return self.free_memory is None or cost.memory <= self.free_memory
+
+    def max_parallel(self, cost: ConversionCost) -> int:
+        """Get how many conversions of the same cost fit in the budget at once."""
+        n = min(self.max_jobs, self.cpus // cost.cpus)
+        if self.memory is not None:
+            n = min(n, self.memory // cost.memory)
+        return max(1, n)
+
+    @contextlib.contextmanager
+    def reserve(self, cost: ConversionCost) -> Iterator[None]:
+        """Wait until a conversion fits in the budget, and hold its resources."""
+        with self.cond:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.cond.wait_for(lambda: self.serving == ticket and self.fits(cost))
+            self.serving += 1
+            self.running += 1
+            self.free_cpus -= cost.cpus
+            if self.free_memory is not None:
+                self.free_memory -= cost.memory
+            self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.free_cpus += cost.cpus
+                if self.free_memory is not None:
+                    self.free_memory += cost.memory
+                self.cond.notify_all()
+
+
+def get_sandbox_limits(
+    cost: ConversionCost, budget: Optional[ResourceBudget] = None
+) -> SandboxLimits:
+    """Get the limits of the sandbox for a conversion, based on its size class and
+    the capacity of the host, if known."""
+    memory = SANDBOX_MEMORY_CLASSES[-1]
+    for memory_class in SANDBOX_MEMORY_CLASSES:
+        if memory_class >= cost.memory * SANDBOX_MEMORY_HEADROOM:
+            memory = memory_class
+            break
+    cpus = cost.cpus
+    if budget is not None:
+        if budget.memory is not None:
+            memory = max(min(memory, budget.memory), SANDBOX_MEMORY_CLASSES[0])
+        cpus = min(cpus, budget.cpus)
+    return SandboxLimits(cpus=cpus, memory=memory, pids=SANDBOX_PIDS_LIMIT)
+
+
+def split_batches(documents: List[Document], n_batches: int) -> List[List[Document]]:
+    """Split documents into batches of similar size, that can run in parallel."""
+    n_batches = max(1, min(n_batches, len(documents)))
+    return [documents[i::n_batches] for i in range(n_batches)]
@@ -5,6 +5,7 @@ from typing import TYPE_CHECKING, Any, Dict, Optional
 
 from packaging import version
 
+from .cache import DEFAULT_CACHE_SIZE, DEFAULT_PIXEL_CACHE_SIZE
 from .document import SAFE_EXTENSION
 from .util import get_version
 
@@ -32,6 +33,13 @@ class Settings:
             "archive": True,
             "ocr": True,
             "ocr_language": "English",
+            "quality": "standard",
+            "container_pool_size": 0,
+            "container_pool_idle_timeout": 5 * 60,  # (seconds)
+            "safe_pdf_cache": False,
+            "safe_pdf_cache_size": DEFAULT_CACHE_SIZE,  # (bytes)
+            "pixel_cache": False,
+            "pixel_cache_size": DEFAULT_PIXEL_CACHE_SIZE,  # (bytes)
             "open": True,
             "open_app": None,
             "safe_extension": SAFE_EXTENSION,
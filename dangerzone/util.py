@@ -6,7 +6,7 @@ import string
 import subprocess
 import sys
 import time
-from typing import IO, Optional, Union
+from typing import IO, Optional, Tuple, Union
 
 import appdirs
 
@@ -26,6 +26,20 @@ def get_tmp_dir() -> Optional[str]:
     return None
 
 
+def get_available_memory() -> Optional[int]:
+    """Get the memory (in bytes) that is available for new processes, if known."""
+    if platform.system() != "Linux":
+        return None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
 def get_resource_path(filename: str) -> str:
     if getattr(sys, "dangerzone_dev", False):
         # Look for resources directory relative to python file
@@ -135,6 +149,27 @@ class Stopwatch:
         self.__exit__()
 
 
+def _nonblocking_select(
+    fd: Union[IO[bytes], int], size: int, timeout: float
+) -> Tuple[int, selectors.BaseSelector]:
+    """Validate the arguments of the non-blocking read functions, and register the
+    file descriptor for read."""
+    if not isinstance(fd, int):
+        fd = fd.fileno()
+
+    # Validate the provided arguments.
+    if os.get_blocking(fd):
+        raise ValueError("Expected a non-blocking file descriptor")
+    if size <= 0:
+        raise ValueError(f"Expected a positive size value (got {size})")
+    if timeout <= 0:
+        raise ValueError(f"Expected a positive timeout value (got {timeout})")
+
+    sel = selectors.DefaultSelector()
+    sel.register(fd, selectors.EVENT_READ)
+    return fd, sel
+
+
 def nonblocking_read(fd: Union[IO[bytes], int], size: int, timeout: float) -> bytes:
     """Opinionated read function for non-blocking fds.
 
@@ -148,24 +183,18 @@ def nonblocking_read(fd: Union[IO[bytes], int], size: int, timeout: float) -> by
 
     If the file descriptor has reached EOF, this function may return less than the
     requested number of bytes, which is the same behavior as `os.read()`.
-    """
-    if not isinstance(fd, int):
-        fd = fd.fileno()
-
-    # Validate the provided arguments.
-    if os.get_blocking(fd):
-        raise ValueError("Expected a non-blocking file descriptor")
-    if size <= 0:
-        raise ValueError(f"Expected a positive size value (got {size})")
-    if timeout <= 0:
-        raise ValueError(f"Expected a positive timeout value (got {timeout})")
 
+    For large reads, prefer `nonblocking_readinto()`, which does not allocate the
+    returned buffer.
+    """
     # Register this file descriptor only for read. Also, start the timer for the
     # timeout.
-    sel = selectors.DefaultSelector()
-    sel.register(fd, selectors.EVENT_READ)
+    fd, sel = _nonblocking_select(fd, size, timeout)
 
-    buf = b""
+    # Keep the chunks apart and join them once at the end, since concatenating them as
+    # they come takes quadratic time.
+    chunks = []
+    read = 0
     sw = Stopwatch(timeout)
     sw.start()
 
@@ -178,16 +207,19 @@ def nonblocking_read(fd: Union[IO[bytes], int], size: int, timeout: float) -> by
     while True:
         events = sel.select(sw.remaining)
         if not events:
-            raise TimeoutError(f"Timeout expired while reading {len(buf)}/{size} bytes")
+            raise TimeoutError(
+                f"Timeout expired while reading {read}/{read + size} bytes"
+            )
 
         chunk = os.read(fd, size)
-        buf += chunk
+        chunks.append(chunk)
         if chunk == b"":
             # EOF
             break
 
         # Recalculate the remaining timeout and size arguments.
         size -= len(chunk)
+        read += len(chunk)
 
         assert size >= 0
         if size == 0:
@@ -195,4 +227,37 @@ def nonblocking_read(fd: Union[IO[bytes], int], size: int, timeout: float) -> by
             break
 
     sel.close()
-    return buf
+    return b"".join(chunks)
+
+
+def nonblocking_readinto(
+    fd: Union[IO[bytes], int], buf: Union[bytearray, memoryview], timeout: float
+) -> int:
+    """Read from a non-blocking fd straight into a preallocated buffer.
+
+    This function behaves like `nonblocking_read()`, but fills `buf` in place, without
+    intermediate copies, and returns the number of bytes that it has read. This number
+    is less than the size of the buffer only if the file descriptor has reached EOF.
+    """
+    view = memoryview(buf).cast("B")
+    size = len(view)
+    fd, sel = _nonblocking_select(fd, size, timeout)
+
+    read = 0
+    sw = Stopwatch(timeout)
+    sw.start()
+    try:
+        while read < size:
+            events = sel.select(sw.remaining)
+            if not events:
+                raise TimeoutError(f"Timeout expired while reading {read}/{size} bytes")
+
+            n = os.readv(fd, [view[read:]])
+            if n == 0:
+                # EOF
+                break
+            read += n
+    finally:
+        sel.close()
+        view.release()
+    return read
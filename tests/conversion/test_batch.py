@@ -0,0 +1,80 @@
+import os
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from dangerzone.conversion import batch, errors
+from dangerzone.conversion.common import DEPTH_GRAYSCALE, deflate_pixels
+
+
+@pytest.fixture
+def dir_fd(tmp_path: Path) -> Iterator[int]:
+    fd = os.open(tmp_path, os.O_RDONLY | os.O_DIRECTORY)
+    yield fd
+    os.close(fd)
+
+
+def write_page(tmp_path: Path, page: int, width: int, height: int, data: bytes) -> None:
+    (tmp_path / f"page-{page}.width").write_text(str(width))
+    (tmp_path / f"page-{page}.height").write_text(str(height))
+    (tmp_path / f"page-{page}.depth").write_text(str(DEPTH_GRAYSCALE))
+    (tmp_path / f"page-{page}.rgb").write_bytes(data)
+
+
+def test_open_output(tmp_path: Path, dir_fd: int) -> None:
+    """Test that only regular files that a worker has left behind are opened."""
+    (tmp_path / "file").write_bytes(b"data")
+    f = batch.open_output(dir_fd, "file")
+    assert f is not None
+    with f:
+        assert f.read() == b"data"
+
+    # A worker may point its output to files that it cannot read itself, or block
+    # whoever opens it.
+    (tmp_path / "link").symlink_to(tmp_path / "file")
+    os.mkfifo(tmp_path / "fifo")
+    (tmp_path / "dir").mkdir()
+    for name in ["link", "fifo", "dir", "missing"]:
+        assert batch.open_output(dir_fd, name) is None
+
+
+def test_get_pages(tmp_path: Path, dir_fd: int) -> None:
+    """Test that the pages that a worker has left behind are checked, before they are
+    sent to the host."""
+    write_page(tmp_path, 1, 10, 5, bytes(50))
+    write_page(tmp_path, 2, 20, 5, bytes(100))
+    assert batch.get_pages(dir_fd, compressed=False) == [
+        (10, 5, DEPTH_GRAYSCALE, 50),
+        (20, 5, DEPTH_GRAYSCALE, 100),
+    ]
+
+    deflated = deflate_pixels(bytes(100))
+    write_page(tmp_path, 2, 20, 5, deflated)
+    assert batch.get_pages(dir_fd, compressed=True)[1] == (
+        20,
+        5,
+        DEPTH_GRAYSCALE,
+        len(deflated),
+    )
+    # The pages must have as many pixels as their dimensions say.
+    with pytest.raises(errors.InvalidPixelData):
+        batch.get_pages(dir_fd, compressed=False)
+
+    write_page(tmp_path, 2, 20000, 5, bytes(100))
+    with pytest.raises(errors.MaxPageWidthException):
+        batch.get_pages(dir_fd, compressed=False)
+
+    write_page(tmp_path, 2, 20, 5, bytes(100))
+    (tmp_path / "page-2.height").write_text("five")
+    with pytest.raises(errors.InvalidPixelData):
+        batch.get_pages(dir_fd, compressed=False)
+
+    # Every page up to the page count must be there.
+    (tmp_path / "page-2.height").unlink()
+    with pytest.raises(errors.PageCountMismatch):
+        batch.get_pages(dir_fd, compressed=False)
+    write_page(tmp_path, 2, 20, 5, bytes(100))
+    (tmp_path / "page-2.rgb").rename(tmp_path / "page-3.rgb")
+    with pytest.raises(errors.PageCountMismatch):
+        batch.get_pages(dir_fd, compressed=False)
@@ -0,0 +1,237 @@
+import asyncio
+import concurrent.futures
+import os
+import signal
+import threading
+from pathlib import Path
+from typing import List, Type
+
+import pytest
+from pytest import MonkeyPatch
+
+from dangerzone.conversion import common, errors
+from dangerzone.conversion.common import (
+    DEPTH_BILEVEL,
+    DEPTH_GRAYSCALE,
+    DEPTH_RGB,
+    TIMEOUT_PER_PAGE,
+    OutputCapture,
+    calculate_timeout,
+    deflate_pixels,
+    get_pixels_size,
+    inflate_pixels,
+    max_deflated_size,
+    pack_bits,
+    parse_pages,
+    reduce_colorspace,
+    select_pages,
+    shutdown_executor,
+    unpack_bits,
+)
+from dangerzone.conversion.pixels_to_pdf import PixelsToPDF
+
+
+def test_deflate_inflate_pixels() -> None:
+    """Test that compressed pixels are decompressed back to their original form."""
+    pixels = b"\xff" * 30000 + os.urandom(3000)
+    deflated = deflate_pixels(pixels)
+    assert len(deflated) < len(pixels)
+    assert len(deflated) <= max_deflated_size(len(pixels))
+    assert inflate_pixels(deflated, len(pixels)) == pixels
+
+    # Incompressible data should never exceed the calculated bound.
+    random_pixels = os.urandom(30000)
+    assert len(deflate_pixels(random_pixels)) <= max_deflated_size(30000)
+
+
+def test_inflate_pixels_invalid() -> None:
+    """Test that pixels that do not match the expected size are rejected."""
+    pixels = b"\xff" * 30000
+    deflated = deflate_pixels(pixels)
+
+    # Test 1 - Check that decompressed data that are longer or shorter than the
+    # expected size are rejected.
+    with pytest.raises(errors.InvalidPixelData):
+        inflate_pixels(deflated, len(pixels) - 1)
+    with pytest.raises(errors.InvalidPixelData):
+        inflate_pixels(deflated, len(pixels) + 1)
+
+    # Test 2 - Check that truncated streams, streams with trailing data, and
+    # malformed streams are rejected.
+    with pytest.raises(errors.InvalidPixelData):
+        inflate_pixels(deflated[:-1], len(pixels))
+    with pytest.raises(errors.InvalidPixelData):
+        inflate_pixels(deflated + b"\x00", len(pixels))
+    with pytest.raises(errors.InvalidPixelData):
+        inflate_pixels(b"not a zlib stream", len(pixels))
+
+
+def test_reduce_colorspace() -> None:
+    """Test that pages are reduced to the smallest depth that holds them losslessly."""
+    # Test 1 - Check that pages with colors are left as is.
+    rgb = os.urandom(3000)
+    assert reduce_colorspace(rgb) == (DEPTH_RGB, rgb)
+
+    # Test 2 - Check that pages with shades of gray keep a single channel.
+    gray = bytes(range(256)) * 4
+    rgb = bytes(c for c in gray for _ in range(3))
+    assert reduce_colorspace(rgb) == (DEPTH_GRAYSCALE, gray)
+
+    # Test 3 - Check that black and white pages are packed into bits, and that the
+    # bits are unpacked back into the original grayscale pixels.
+    bilevel = b"\xff" * 1000 + b"\x00\xff\x00" * 3
+    rgb = bytes(c for c in bilevel for _ in range(3))
+    depth, packed = reduce_colorspace(rgb)
+    assert depth == DEPTH_BILEVEL
+    assert packed == pack_bits(bilevel)
+    assert len(packed) == get_pixels_size(len(bilevel), 1, DEPTH_BILEVEL)
+    assert unpack_bits(packed, len(bilevel)) == bilevel
+
+
+def test_pack_bits() -> None:
+    """Test that bilevel pixels are packed in big-endian order, and that packed pixels
+    with the wrong size or with non-zero padding bits are rejected."""
+    assert pack_bits(b"") == b""
+    assert pack_bits(b"\xff" + b"\x00" * 7 + b"\xff\xff") == b"\x80\xc0"
+    assert unpack_bits(b"\x80\xc0", 10) == b"\xff" + b"\x00" * 7 + b"\xff\xff"
+    for num_pixels in range(1, 25):
+        bilevel = bytes(0xFF * (i % 3 == 0) for i in range(num_pixels))
+        assert unpack_bits(pack_bits(bilevel), num_pixels) == bilevel
+
+    with pytest.raises(errors.InvalidPixelData):
+        unpack_bits(b"\x80\xe0", 10)
+    with pytest.raises(errors.InvalidPixelData):
+        unpack_bits(b"\x80\xc0", 17)
+    with pytest.raises(errors.InvalidPixelData):
+        unpack_bits(b"\x80\xc0\x00", 10)
+
+
+def test_select_pages() -> None:
+    assert parse_pages("1-3, 7,10-") == [(1, 3), (7, 7), (10, None)]
+    assert select_pages("1-3,7,10-", 12) == [0, 1, 2, 6, 9, 10, 11]
+    # Overlapping ranges select their pages once, in page order.
+    assert select_pages("5,2-6", 12) == [1, 2, 3, 4, 5]
+    # Pages past the end of the document are ignored.
+    assert select_pages("2-20", 3) == [1, 2]
+    assert select_pages("20-", 3) == []
+    assert select_pages(None, 3) == [0, 1, 2]
+    too_long = ",".join(["1"] * 40000)
+    for pages in ["", "0", "3-1", "1,,2", "-3", "first", too_long]:
+        with pytest.raises(ValueError):
+            parse_pages(pages)
+
+
+def test_calculate_timeout_dpi() -> None:
+    """Test that the per-page timeout scales with the resolution of the pages."""
+    pages = 100
+    assert calculate_timeout(0, pages) == TIMEOUT_PER_PAGE * pages
+    assert calculate_timeout(0, pages, dpi=300) == 4 * TIMEOUT_PER_PAGE * pages
+    # Lower resolutions should not shrink the timeout.
+    assert calculate_timeout(0, pages, dpi=96) == TIMEOUT_PER_PAGE * pages
+
+
+def test_run_command_out_of_memory(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    """Test that a command that gets killed with SIGKILL is reported as an
+    out-of-memory error, which the host can reconstruct from its error code."""
+    converter = PixelsToPDF()
+    # Without the memory events of the cgroup, every SIGKILL is an out-of-memory kill.
+    memory_events = tmp_path / "memory.events"
+    monkeypatch.setattr(common, "MEMORY_EVENTS_FILENAME", str(memory_events))
+    with pytest.raises(errors.OutOfMemoryException):
+        asyncio.run(
+            converter.run_command(["sh", "-c", "kill -9 $$"], error_message="Failed")
+        )
+    with pytest.raises(RuntimeError, match="Failed"):
+        asyncio.run(converter.run_command(["false"], error_message="Failed"))
+
+    # Otherwise, only SIGKILLs that the kernel counts as out-of-memory kills are.
+    memory_events.write_text("low 0\noom 0\noom_kill 0\n")
+    with pytest.raises(RuntimeError, match="Failed"):
+        asyncio.run(
+            converter.run_command(["sh", "-c", "kill -9 $$"], error_message="Failed")
+        )
+    oom_kill = f"echo oom_kill 1 > {memory_events}; kill -9 $$"
+    with pytest.raises(errors.OutOfMemoryException):
+        asyncio.run(
+            converter.run_command(["sh", "-c", oom_kill], error_message="Failed")
+        )
+
+    # Containers whose main process is killed with SIGKILL exit with 128 + 9.
+    exception = errors.exception_from_error_code(128 + signal.SIGKILL)
+    assert isinstance(exception, errors.OutOfMemoryException)
+
+
+def test_error_codes() -> None:
+    """Test that the error codes are unique, and that none of them is the exit code of
+    a process that crashed."""
+
+    def subclasses(
+        cls: Type[errors.ConversionException],
+    ) -> List[Type[errors.ConversionException]]:
+        return [c for s in cls.__subclasses__() for c in [s] + subclasses(s)]
+
+    codes = [c.error_code for c in subclasses(errors.ConversionException)]
+    assert len(codes) == len(set(codes))
+    for sig in (signal.SIGSEGV, signal.SIGBUS, signal.SIGABRT, signal.SIGILL):
+        assert errors.ERROR_SHIFT + sig not in codes
+
+
+def test_output_capture() -> None:
+    """Test that the captured output keeps its head and tail within the limit."""
+    capture = OutputCapture(limit=10)
+    capture.write(b"abc")
+    assert capture.getvalue() == b"abc"
+    assert capture.dropped == 0
+
+    capture.write(b"defghij")
+    assert capture.getvalue() == b"abcdefghij"
+    assert capture.dropped == 0
+
+    # The ring buffer wraps around, and keeps only the last bytes.
+    capture.write(b"klm")
+    assert capture.dropped == 3
+    assert capture.getvalue() == b"abcde\n[... 3 bytes dropped ...]\nijklm"
+    capture.write(b"0123456789" * 1000)
+    assert capture.dropped == 10003
+    assert capture.getvalue().endswith(b"dropped ...]\n56789")
+
+
+def test_run_command_output_capture() -> None:
+    """Test that long command output does not grow the captured output unbounded."""
+    converter = PixelsToPDF(capture_limit=1000)
+    stdout, _ = asyncio.run(
+        converter.run_command(
+            ["sh", "-c", "seq 100000; echo last"], error_message="Failed"
+        )
+    )
+    assert len(stdout) < 1100
+    assert stdout.startswith(b"1\n2\n")
+    assert stdout.endswith(b"99999\n100000\nlast\n")
+    assert converter.output.dropped > 0
+    assert converter.captured_output.startswith(b"[COMMAND] sh -c")
+    assert converter.captured_output.endswith(b"last\n")
+
+
+def test_shutdown_executor() -> None:
+    """Test that the tasks that have not started yet are cancelled on shutdown."""
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def task(i: int) -> None:
+        calls.append(i)
+        started.set()
+        release.wait()
+
+    async def run() -> None:
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        pending = [loop.run_in_executor(executor, task, i) for i in range(10)]
+        await loop.run_in_executor(None, started.wait)
+        # The event loop should keep running while the executor shuts down.
+        loop.call_later(0.1, release.set)
+        await shutdown_executor(executor, pending)
+        assert all(future.cancelled() for future in pending[1:])
+
+    asyncio.run(run())
+    assert calls == [0]
@@ -0,0 +1,82 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from typing import List, Tuple
+
+import fitz
+import pytest
+from pytest_mock import MockerFixture
+
+from dangerzone.conversion import doc_to_pixels
+from dangerzone.conversion.common import DEPTH_RGB, max_rendered_pages
+from dangerzone.conversion.doc_to_pixels import DocumentToPixels
+
+from .. import sample_pdf
+
+
+async def collect_pages(
+    converter: DocumentToPixels, filename: str, page_indices: List[int], workers: int
+) -> List[Tuple[int, int, int, int, bytes]]:
+    if workers == 1:
+        with fitz.open(filename) as doc:
+            rendered = converter.render_pages_serial(doc, page_indices, False, False)
+            return [page async for page in rendered]
+    rendered = converter.render_pages_parallel(
+        filename, None, page_indices, workers, False, False
+    )
+    return [page async for page in rendered]
+
+
+def test_render_pages_parallel(sample_pdf: str) -> None:
+    """Test that the pages that the workers render are the same, and in the same
+    order, as the pages that are rendered one by one."""
+    converter = DocumentToPixels()
+    converter.dpi = 50
+    page_indices = [3, 0, 2]
+    parallel = asyncio.run(collect_pages(converter, sample_pdf, page_indices, 2))
+    serial = asyncio.run(collect_pages(converter, sample_pdf, page_indices, 1))
+    assert [page[0] for page in parallel] == [1, 2, 3]
+    assert parallel == serial
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_render_pages_parallel_memory(mocker: MockerFixture, workers: int) -> None:
+    """Test that the rendered pages in memory stay within the bound that the scheduler
+    budgets for."""
+    lock = threading.Lock()
+    in_memory = 0
+    max_in_memory = 0
+
+    def render_page(
+        index: int, dpi: int, reduce: bool, compress: bool
+    ) -> Tuple[int, int, int, bytes]:
+        nonlocal in_memory, max_in_memory
+        with lock:
+            in_memory += 1
+            max_in_memory = max(max_in_memory, in_memory)
+        # Let the later pages finish first, so that they wait for the earlier ones.
+        time.sleep(0.001 * (index % workers))
+        return 1, 1, DEPTH_RGB, bytes(3)
+
+    async def consume() -> List[int]:
+        nonlocal in_memory
+        page_nums = []
+        rendered = DocumentToPixels().render_pages_parallel(
+            "document.pdf", None, list(range(30)), workers, False, False
+        )
+        async for page_num, *_ in rendered:
+            # Send the page slowly, while the workers render the next ones.
+            await asyncio.sleep(0.002)
+            page_nums.append(page_num)
+            with lock:
+                in_memory -= 1
+        return page_nums
+
+    mocker.patch.object(doc_to_pixels, "render_page", render_page)
+    mocker.patch.object(doc_to_pixels, "open_worker_document")
+    mocker.patch.object(
+        concurrent.futures, "ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor
+    )
+    assert asyncio.run(consume()) == list(range(1, 31))
+    assert max_in_memory <= max_rendered_pages(workers)
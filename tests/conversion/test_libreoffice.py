@@ -0,0 +1,101 @@
+import json
+import sys
+import types
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+from pytest_mock import MockerFixture
+
+from dangerzone.conversion import errors, libreoffice
+
+
+@pytest.fixture
+def fake_uno(mocker: MockerFixture) -> None:
+    """Stand in for the Python bindings of LibreOffice, which run in the sandbox."""
+    uno = types.ModuleType("uno")
+    uno.systemPathToFileUrl = lambda path: f"file://{path}"  # type: ignore [attr-defined]
+    uno.Any = lambda type_name, value: value  # type: ignore [attr-defined]
+    uno.invoke = lambda obj, method, args: getattr(obj, method)(*args)  # type: ignore [attr-defined]
+    beans = types.ModuleType("com.sun.star.beans")
+    beans.PropertyValue = types.SimpleNamespace  # type: ignore [attr-defined]
+    mocker.patch.dict(sys.modules, {"uno": uno, "com.sun.star.beans": beans})
+
+
+@pytest.mark.parametrize(
+    "service,pdf_filter",
+    [
+        ("com.sun.star.text.GenericTextDocument", "writer_pdf_Export"),
+        ("com.sun.star.sheet.SpreadsheetDocument", "calc_pdf_Export"),
+        ("com.sun.star.presentation.PresentationDocument", "impress_pdf_Export"),
+    ],
+)
+def test_convert(
+    fake_uno: None, mocker: MockerFixture, service: str, pdf_filter: str
+) -> None:
+    """Test that documents are exported with the PDF filter of their type, and that
+    their macros are not run."""
+    desktop = mocker.MagicMock()
+    doc = desktop.loadComponentFromURL.return_value
+    # Presentations are drawings as well, so the presentation filter has to win.
+    doc.supportsService.side_effect = lambda name: name == service or (
+        service.endswith("PresentationDocument") and name.endswith("DrawingDocument")
+    )
+
+    libreoffice.convert(desktop, "/tmp/input_file", "/tmp/input_file.pdf")
+
+    url, _, _, load_props = desktop.loadComponentFromURL.call_args.args
+    assert url == "file:///tmp/input_file"
+    props: Dict[str, Any] = {p.Name: p.Value for p in load_props}
+    assert props["MacroExecutionMode"] == 0
+    assert props["ReadOnly"]
+    url, store_props = doc.storeToURL.call_args.args
+    assert url == "file:///tmp/input_file.pdf"
+    props = {p.Name: p.Value for p in store_props}
+    assert props["FilterName"] == pdf_filter
+    # Documents with too many pages are not exported in full.
+    (page_range,) = props["FilterData"]
+    assert (page_range.Name, page_range.Value) == ("PageRange", "1-10001")
+    doc.close.assert_called_once_with(True)
+
+
+def test_convert_unsupported(fake_uno: None, mocker: MockerFixture) -> None:
+    """Test that documents that cannot be exported to PDF are closed."""
+    desktop = mocker.MagicMock()
+    doc = desktop.loadComponentFromURL.return_value
+    doc.supportsService.return_value = False
+
+    with pytest.raises(RuntimeError):
+        libreoffice.convert(desktop, "/tmp/input_file", "/tmp/input_file.pdf")
+    doc.storeToURL.assert_not_called()
+    doc.close.assert_called_once_with(True)
+
+
+def test_get_profile_args(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Test that LibreOffice runs with a copy of the profile of the container image."""
+    template = tmp_path / "template"
+    monkeypatch.setattr(libreoffice, "LIBREOFFICE_PROFILE_TEMPLATE", str(template))
+    profile = tmp_path / "profile"
+
+    # Without a profile in the image, LibreOffice creates one itself.
+    assert libreoffice.get_profile_args(str(profile)) == [
+        f"-env:UserInstallation=file://{profile}"
+    ]
+    assert not profile.exists()
+
+    (template / "user").mkdir(parents=True)
+    (template / "user" / "registrymodifications.xcu").write_text("registry")
+    assert libreoffice.get_profile_args(str(profile)) == [
+        f"-env:UserInstallation=file://{profile}"
+    ]
+    assert (profile / "user" / "registrymodifications.xcu").read_text() == "registry"
+
+
+def test_get_convert_to_arg() -> None:
+    assert libreoffice.get_convert_to_arg(None) == "pdf"
+    arg = libreoffice.get_convert_to_arg("calc_pdf_Export")
+    extension, filter_name, options = arg.split(":", 2)
+    assert (extension, filter_name) == ("pdf", "calc_pdf_Export")
+    assert json.loads(options) == {
+        "PageRange": {"type": "string", "value": f"1-{errors.MAX_PAGES + 1}"}
+    }
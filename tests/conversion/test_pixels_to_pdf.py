@@ -0,0 +1,222 @@
+import asyncio
+import multiprocessing
+import os
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+
+import fitz
+import pytest
+from pytest import MonkeyPatch
+from pytest_mock import MockerFixture
+
+from dangerzone.conversion import errors
+from dangerzone.conversion.common import DEPTH_GRAYSCALE
+from dangerzone.conversion.pixels_to_pdf import PixelsToPDF, SafePDFWriter
+
+
+def fake_ocr_page(
+    width: int,
+    height: int,
+    depth: int,
+    untrusted_pixels: bytes,
+    dpi: int,
+    ocr_lang: str,
+) -> bytes:
+    """Stand in for Tesseract, and tag the page with its gray level and worker."""
+    doc = fitz.open()
+    page = doc.new_page(width=width, height=height)
+    page.insert_text((5, 20), f"{untrusted_pixels[0]} {os.getpid()}")
+    return doc.tobytes()
+
+
+def env_ocr_page(
+    width: int,
+    height: int,
+    depth: int,
+    untrusted_pixels: bytes,
+    dpi: int,
+    ocr_lang: str,
+) -> bytes:
+    """Stand in for Tesseract, and tag the page with the thread limit of OpenMP."""
+    doc = fitz.open()
+    page = doc.new_page(width=width, height=height)
+    page.insert_text((5, 20), os.environ.get("OMP_THREAD_LIMIT", "none"))
+    return doc.tobytes()
+
+
+async def gray_pages(num_pages: int) -> AsyncIterator[Tuple[int, int, int, bytes]]:
+    for page in range(num_pages):
+        yield 100, 50, DEPTH_GRAYSCALE, bytes([page]) * 100 * 50
+
+
+async def text_pages(num_pages: int) -> AsyncIterator[Tuple[int, int, int, bytes]]:
+    """Yield pages that are not blank, and start with a pixel of their own."""
+    for page in range(num_pages):
+        yield 100, 50, DEPTH_GRAYSCALE, (bytes([page]) + bytes(range(100)) * 50)[:5000]
+
+
+def test_parallel_ocr(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Test that pages that are OCRed in parallel are inserted in page order."""
+    mocker.patch("dangerzone.conversion.pixels_to_pdf.ocr_page", fake_ocr_page)
+    safe_pdf_path = str(tmp_path / "safe.pdf")
+    converter = PixelsToPDF()
+    asyncio.run(
+        converter.convert_pages(
+            text_pages(20), 20, safe_pdf_path, ocr_lang="eng", ocr_workers=4
+        )
+    )
+
+    with fitz.open(safe_pdf_path) as safe_pdf:
+        tags = [page.get_text().split() for page in safe_pdf]
+    assert [int(level) for level, _ in tags] == list(range(20))
+    pids = {pid for _, pid in tags}
+    assert str(os.getpid()) not in pids
+    assert 1 < len(pids) <= 4
+    assert converter.percentage == 100
+
+
+def test_parallel_ocr_thread_limit(
+    mocker: MockerFixture, monkeypatch: MonkeyPatch, tmp_path: Path
+) -> None:
+    """Test that only the OCR workers limit their threads, even when they are spawned
+    instead of forked."""
+    monkeypatch.delenv("OMP_THREAD_LIMIT", raising=False)
+    mocker.patch("dangerzone.conversion.pixels_to_pdf.ocr_page", env_ocr_page)
+    safe_pdf_path = str(tmp_path / "safe.pdf")
+    converter = PixelsToPDF()
+    asyncio.run(
+        converter.convert_pages(
+            text_pages(4),
+            4,
+            safe_pdf_path,
+            ocr_lang="eng",
+            ocr_workers=2,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    )
+
+    with fitz.open(safe_pdf_path) as safe_pdf:
+        assert [page.get_text().strip() for page in safe_pdf] == ["1"] * 4
+    assert "OMP_THREAD_LIMIT" not in os.environ
+
+
+def test_parallel_ocr_page_count(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Test that pages beyond the announced page count are rejected."""
+    mocker.patch("dangerzone.conversion.pixels_to_pdf.ocr_page", fake_ocr_page)
+    converter = PixelsToPDF()
+    with pytest.raises(errors.MaxPagesException):
+        asyncio.run(
+            converter.convert_pages(
+                text_pages(5), 4, str(tmp_path / "safe.pdf"), "eng", ocr_workers=2
+            )
+        )
+
+
+def test_convert_pages(tmp_path: Path) -> None:
+    """Test that the pixels of each page end up on a page of the right size."""
+    safe_pdf_path = str(tmp_path / "safe.pdf")
+    converter = PixelsToPDF()
+    asyncio.run(converter.convert_pages(gray_pages(3), 3, safe_pdf_path, dpi=96))
+
+    with fitz.open(safe_pdf_path) as safe_pdf:
+        assert safe_pdf.page_count == 3
+        for level, page in enumerate(safe_pdf):
+            # 100x50 pixels at 96 DPI are 75x37.5 points.
+            assert page.rect == fitz.Rect(0, 0, 75, 37.5)
+            pixmap = page.get_pixmap(dpi=96, colorspace=fitz.csGRAY)
+            assert (pixmap.width, pixmap.height) == (100, 50)
+            assert pixmap.samples == bytes([level]) * 100 * 50
+
+
+def test_convert_pages_flush(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Test that the pages of long documents are written incrementally."""
+    safe_pdf_path = str(tmp_path / "safe.pdf")
+    flush_spy = mocker.spy(SafePDFWriter, "flush")
+    converter = PixelsToPDF()
+
+    async def tiny_pages() -> AsyncIterator[Tuple[int, int, int, bytes]]:
+        for page in range(1000):
+            yield 2, 1, DEPTH_GRAYSCALE, bytes([page % 256, page // 256])
+
+    asyncio.run(
+        converter.convert_pages(tiny_pages(), 1000, safe_pdf_path, flush_size=600)
+    )
+
+    assert flush_spy.call_count == 3
+    with fitz.open(safe_pdf_path) as safe_pdf:
+        assert safe_pdf.page_count == 1000
+        for page_num in [0, 299, 300, 555, 999]:
+            xref = safe_pdf[page_num].get_images()[0][0]
+            pixmap = fitz.Pixmap(safe_pdf, xref)
+            assert pixmap.samples == bytes([page_num % 256, page_num // 256])
+
+
+async def repeated_pages(
+    levels: List[Optional[int]],
+) -> AsyncIterator[Tuple[int, int, int, bytes]]:
+    """Yield text pages that start with the given levels, or blank pages for None."""
+    for level in levels:
+        if level is None:
+            yield 100, 50, DEPTH_GRAYSCALE, b"\xff" * 100 * 50
+        else:
+            yield 100, 50, DEPTH_GRAYSCALE, (bytes([level]) + bytes(range(100)) * 50)[
+                :5000
+            ]
+
+
+def test_deduplicate_pages(tmp_path: Path, capsys: pytest.CaptureFixture) -> None:
+    """Test that identical pages share their image."""
+    safe_pdf_path = str(tmp_path / "safe.pdf")
+    converter = PixelsToPDF()
+    asyncio.run(converter.convert_pages(repeated_pages([1, 2, 1, 1]), 4, safe_pdf_path))
+
+    with fitz.open(safe_pdf_path) as safe_pdf:
+        xrefs = [page.get_images()[0][0] for page in safe_pdf]
+    assert xrefs[0] == xrefs[2] == xrefs[3] != xrefs[1]
+    assert "Reused 2 duplicate pages" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("ocr_workers", [1, 3])
+def test_deduplicate_pages_ocr(
+    mocker: MockerFixture, tmp_path: Path, ocr_workers: int
+) -> None:
+    """Test that blank pages are not OCRed, and that duplicate pages are OCRed once."""
+    mocker.patch("dangerzone.conversion.pixels_to_pdf.ocr_page", fake_ocr_page)
+    safe_pdf_path = str(tmp_path / "safe.pdf")
+    levels = [1, None, 2, 1, None, 3, 1]
+    converter = PixelsToPDF()
+    asyncio.run(
+        converter.convert_pages(
+            repeated_pages(levels),
+            len(levels),
+            safe_pdf_path,
+            ocr_lang="eng",
+            ocr_workers=ocr_workers,
+        )
+    )
+
+    with fitz.open(safe_pdf_path) as safe_pdf:
+        texts = [page.get_text().split() for page in safe_pdf]
+        # Duplicate pages are copies of the first page, instead of being OCRed and
+        # inserted again, so they share its font.
+        fonts = [safe_pdf[page].get_fonts()[0][0] for page in (0, 3, 6)]
+    assert [int(text[0]) if text else None for text in texts] == levels
+    assert fonts[0] == fonts[1] == fonts[2]
+
+
+def test_wait_for_file_timeout(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Test that the pipelined stage does not wait forever for a page."""
+    mocker.patch("dangerzone.conversion.pixels_to_pdf.PIPELINE_POLL_INTERVAL", 0.01)
+    converter = PixelsToPDF()
+    converter.pipeline_exited_filename = str(tmp_path / "exited")
+
+    page = tmp_path / "page-1.rgb"
+    with pytest.raises(TimeoutError):
+        asyncio.run(converter.wait_for_file(str(page), timeout=0.05))
+
+    # The page may show up in the meantime, or never, if the previous stage exits.
+    page.touch()
+    asyncio.run(converter.wait_for_file(str(page), timeout=0.05))
+    (tmp_path / "exited").touch()
+    with pytest.raises(errors.InterruptedConversion):
+        asyncio.run(converter.wait_for_file(str(tmp_path / "page-2.rgb")))
@@ -9,12 +9,15 @@ from pytest import MonkeyPatch, fixture
 from pytest_mock import MockerFixture
 from pytestqt.qtbot import QtBot
 
+from dangerzone.conversion.common import PREVIEW_DPI, PREVIEW_PAGES
+from dangerzone.document import Document
 from dangerzone.gui import MainWindow
 from dangerzone.gui import main_window as main_window_module
 from dangerzone.gui import updater as updater_module
 from dangerzone.gui.logic import DangerzoneGui
-from dangerzone.gui.main_window import ContentWidget
+from dangerzone.gui.main_window import ContentWidget, DocumentWidget
 from dangerzone.gui.updater import UpdateReport, UpdaterThread
+from dangerzone.isolation_provider.dummy import Dummy
 from dangerzone.util import get_version
 
 from .. import sample_doc, sample_pdf
@@ -377,3 +380,39 @@ def test_change_document_button(
     ]
     assert len(docs) is 1
     assert docs[0] == str(tmp_sample_doc)
+
+
+def test_document_preview(
+    qtbot: QtBot,
+    mocker: MockerFixture,
+    sample_pdf: str,
+) -> None:
+    """Check that previewing a document converts its first pages, but not itself."""
+    mocker.patch("dangerzone.isolation_provider.dummy.time.sleep")
+    dummy = Dummy()
+    convert_spy = mocker.spy(dummy, "_convert")
+    dz = DangerzoneGui(mocker.MagicMock(), dummy)
+    open_pdf_viewer_mock = mocker.patch.object(dz, "open_pdf_viewer")
+    document = Document(sample_pdf)
+    widget = DocumentWidget(dz, document)
+    qtbot.addWidget(widget)
+
+    qtbot.mouseClick(widget.preview_button, QtCore.Qt.MouseButton.LeftButton)
+    assert not widget.preview_button.isEnabled()
+    qtbot.waitUntil(lambda: open_pdf_viewer_mock.called)
+    assert widget.preview_thread is not None
+    widget.preview_thread.wait()
+
+    preview, ocr_lang, dpi, _ = convert_spy.call_args.args
+    assert preview.input_filename == document.input_filename
+    assert preview.pages == f"1-{PREVIEW_PAGES}"
+    assert (ocr_lang, dpi) == (None, PREVIEW_DPI)
+    open_pdf_viewer_mock.assert_called_once_with(preview.output_filename)
+    assert document.is_unconverted()
+    assert widget.preview_button.isEnabled()
+
+    # The previews are removed once Dangerzone exits.
+    assert os.path.dirname(preview.output_filename) == dz.get_preview_dir()
+    assert dz.preview_dir is not None
+    dz.preview_dir.cleanup()
+    assert not os.path.exists(preview.output_filename)
@@ -1,12 +1,24 @@
+import io
 import itertools
 import json
-from typing import Any, Dict
+import os
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 import pytest
 from pytest_mock import MockerFixture
 
+from dangerzone.conversion import errors
+from dangerzone.conversion.common import DEPTH_RGB, deflate_pixels
 from dangerzone.document import Document
-from dangerzone.isolation_provider.container import Container
+from dangerzone.isolation_provider.base import SandboxLimits
+from dangerzone.isolation_provider.container import (
+    BatchSandbox,
+    Container,
+    ContainerStream,
+    get_container_name,
+)
 
 # XXX Fixtures used in abstract Test class need to be imported regardless
 from .. import pdf_11k_pages, sanitized_text, uncommon_text
@@ -93,3 +105,376 @@ class TestContainer(IsolationProviderTest):
                         continue
                     container.parse_progress(d, bad_json)
                     assert_invalid_json(sanitized_json)
+
+
+def test_parse_batch_progress(mocker: MockerFixture) -> None:
+    """Test that the `parse_batch_progress()` function routes each line to the right
+    document."""
+    container = Container(enable_timeouts=False)
+    parse_progress_mock = mocker.patch.object(container, "parse_progress")
+    log_error_mock = mocker.patch("dangerzone.isolation_provider.container.log.error")
+    on_document_done = mocker.MagicMock()
+    docs = [Document(), Document()]
+    for d in docs:
+        d.mark_as_converting()
+
+    def parse(line: Dict[str, Any]) -> None:
+        container.parse_batch_progress(docs, json.dumps(line), on_document_done)
+
+    # Test 1 - Check that progress lines are parsed for the right document.
+    status = json.dumps({"text": "text", "error": False, "percentage": 0})
+    parse({"document": 2, "status": status})
+    parse_progress_mock.assert_called_once_with(docs[1], status)
+
+    # Test 2 - Check that the error code of a document is reported.
+    parse({"document": 1, "error_code": 0})
+    on_document_done.assert_called_once_with(1, 0)
+
+    # Test 3 - Check that invalid document indices and field types are reported
+    # as errors, and are not routed to any document.
+    bad_lines: List[Dict[str, Any]] = [
+        {"document": 0, "error_code": 0},
+        {"document": 3, "error_code": 0},
+        {"document": True, "error_code": 0},
+        {"document": "1", "error_code": 0},
+        {"document": 1, "error_code": "0"},
+        {"document": 1, "status": 0},
+        {"document": 1},
+    ]
+    for bad_line in bad_lines:
+        log_error_mock.reset_mock()
+        parse(bad_line)
+        log_error_mock.assert_called_once()
+    parse_progress_mock.assert_called_once()
+    on_document_done.assert_called_once()
+
+    # Test 4 - Check that reports for documents that are no longer being converted
+    # are ignored.
+    docs[1].mark_as_safe()
+    parse({"document": 2, "error_code": 1})
+    on_document_done.assert_called_once()
+
+
+def test_take_from_pool(mocker: MockerFixture) -> None:
+    """Test that a warm sandbox is used only for conversions with the settings it
+    was started with, and only while it is alive."""
+    container = Container(enable_timeouts=False)
+    small = SandboxLimits(cpus=1, memory=1024, pids=512)
+    large = SandboxLimits(cpus=2, memory=2048, pids=512)
+
+    def sandbox(
+        ocr_lang: Optional[str],
+        dpi: int,
+        limits: Optional[SandboxLimits],
+        alive: bool,
+    ) -> BatchSandbox:
+        sandbox = BatchSandbox(1, ocr_lang, dpi, limits)
+        mocker.patch.object(sandbox, "is_alive", return_value=alive)
+        return sandbox
+
+    dead = sandbox(None, 150, None, False)
+    other_settings = sandbox("eng", 150, None, True)
+    warm = sandbox(None, 150, large, True)
+    container.pool = [dead, other_settings, warm]
+
+    assert container.take_from_pool(None, 96) is None
+    # A sandbox with limits cannot run a conversion that needs more resources.
+    assert container.take_from_pool(None, 150) is None
+    assert container.take_from_pool(None, 150, small) is warm
+    assert container.take_from_pool(None, 150, small) is None
+    assert container.pool == [dead, other_settings]
+
+    # Test that sandboxes are single-use.
+    assert container.take_from_pool("eng", 150, large) is other_settings
+    assert container.take_from_pool("eng", 150, large) is None
+
+    for s in [dead, other_settings, warm]:
+        s.close()
+
+
+def test_get_limit_args(mocker: MockerFixture) -> None:
+    """Test that resource limits are passed only for the cgroup controllers that
+    the container runtime can use."""
+    container = Container(enable_timeouts=False)
+    limits = SandboxLimits(cpus=2, memory=1024, pids=512)
+    assert container.get_limit_args(None) == []
+
+    container.cgroup_controllers = ["cpu", "memory", "pids"]
+    assert container.get_limit_args(limits) == [
+        "--cpus",
+        "2",
+        "--memory",
+        "1024",
+        "--memory-swap",
+        "1024",
+        "--pids-limit",
+        "512",
+    ]
+
+    container.cgroup_controllers = ["pids"]
+    assert container.get_limit_args(limits) == ["--pids-limit", "512"]
+
+    # The render workers of the first stage do not exceed the CPU limit.
+    mocker.patch.object(container, "get_cpu_count", return_value=8)
+    env = container.get_doc_to_pixels_env(150, limits)
+    assert env["RENDER_WORKERS"] == "2"
+    # Neither do the OCR workers of the second stage.
+    env = container.get_pixels_to_pdf_env("eng", 150, limits)
+    assert env["OCR_WORKERS"] == "2"
+
+
+@pytest.mark.parametrize("warm_libreoffice", [False, True])
+def test_start_batch_sandbox_warm_libreoffice(
+    mocker: MockerFixture, warm_libreoffice: bool
+) -> None:
+    """Test that only the first stage of a warm sandbox starts LibreOffice early."""
+    container = Container(enable_timeouts=False)
+    mocker.patch.object(
+        container,
+        "get_container_args",
+        side_effect=lambda command, extra_args=[]: command + extra_args,
+    )
+    start_spy = mocker.patch.object(container, "start_stream_process")
+
+    sandbox = container.start_batch_sandbox(
+        1, None, 150, warm_libreoffice=warm_libreoffice
+    )
+    pixels_to_pdf_args, doc_to_pixels_args = [
+        call.args[0] for call in start_spy.call_args_list
+    ]
+    assert ("WARM_LIBREOFFICE=1" in doc_to_pixels_args) == warm_libreoffice
+    assert "WARM_LIBREOFFICE=1" not in pixels_to_pdf_args
+    # The containers are named, so that they can be killed.
+    assert sandbox.doc_to_pixels_name in doc_to_pixels_args
+    assert sandbox.pixels_to_pdf_name in pixels_to_pdf_args
+    sandbox.close()
+
+
+def test_streaming_unsupported(mocker: MockerFixture) -> None:
+    """Test that the output of containers is not streamed where the pipes do not
+    support it."""
+    mocker.patch("platform.system", return_value="Windows")
+    container = Container(enable_timeouts=False, streaming=True)
+    assert not container.streaming
+
+    container.configure_pool(2)
+    assert container.pool_size == 0
+
+    # Batches fall back to converting one document at a time.
+    convert_mock = mocker.patch.object(container, "convert")
+    batch_mock = mocker.patch.object(container, "_convert_batch")
+    docs = [Document(), Document()]
+    container.convert_batch(docs, None)
+    assert convert_mock.call_count == 2
+    batch_mock.assert_not_called()
+
+
+def test_kill_container(mocker: MockerFixture) -> None:
+    """Test that containers are killed through the container runtime, and not only
+    through the process that started them."""
+    mocker.patch.object(Container, "get_runtime", return_value="podman")
+    run_mock = mocker.patch("subprocess.run")
+    sandbox = BatchSandbox(1, None, 150, None)
+    doc_to_pixels = sandbox.doc_to_pixels = mocker.MagicMock()
+    pixels_to_pdf = sandbox.pixels_to_pdf = mocker.MagicMock()
+
+    sandbox.kill()
+    assert [c.args[0] for c in run_mock.call_args_list] == [
+        ["podman", "kill", sandbox.doc_to_pixels_name],
+        ["podman", "kill", sandbox.pixels_to_pdf_name],
+    ]
+    doc_to_pixels.kill.assert_called_once()
+    pixels_to_pdf.kill.assert_called_once()
+    # The containers are killed once, so their exit codes are checked once.
+    for name in (sandbox.doc_to_pixels_name, sandbox.pixels_to_pdf_name):
+        assert Container.was_killed(name)
+        assert not Container.was_killed(name)
+    sandbox.tmp_dir.cleanup()
+
+
+@pytest.mark.parametrize("killed", [False, True])
+def test_relay_pages_killed(
+    mocker: MockerFixture, tmp_path: Path, killed: bool
+) -> None:
+    """Test that a container that exits like one that ran out of memory is reported as
+    such, unless the host has killed it."""
+    mocker.patch.object(Container, "get_runtime", return_value="podman")
+    mocker.patch("subprocess.run")
+    provider = Container(enable_timeouts=False)
+    document_path = tmp_path / "document.pdf"
+    document_path.write_bytes(b"document")
+    document = Document(str(document_path))
+
+    # The first container exits before it sends anything.
+    read_fd, write_fd = os.pipe()
+    os.close(write_fd)
+    doc_to_pixels = mocker.MagicMock()
+    doc_to_pixels.stdout = open(read_fd, "rb")
+    doc_to_pixels.wait.return_value = errors.OutOfMemoryException.error_code
+    if killed:
+        provider.kill_container(
+            get_container_name(document.id, "doc-to-pixels"), doc_to_pixels
+        )
+
+    expected = errors.InterruptedConversion if killed else errors.OutOfMemoryException
+    with pytest.raises(expected):
+        provider.relay_pages(document, doc_to_pixels, io.BytesIO(), 150)
+    doc_to_pixels.stdout.close()
+    assert not Container.was_killed(get_container_name(document.id, "doc-to-pixels"))
+
+
+def test_container_stream(mocker: MockerFixture) -> None:
+    """Test that the data of a stream is reassembled from its frames, and that the
+    progress reports and the log in between are handled separately."""
+
+    def frame(tag: bytes, payload: bytes) -> bytes:
+        return tag + len(payload).to_bytes(4, "big") + payload
+
+    def open_stream(data: bytes) -> ContainerStream:
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, data)
+        os.close(write_fd)
+        return ContainerStream(open(read_fd, "rb"), on_progress, timeout=10)
+
+    on_progress = mocker.MagicMock()
+    stream = open_stream(
+        frame(b"d", (3).to_bytes(2, "big") + b"ab")
+        + frame(b"p", b"progress")
+        + frame(b"d", b"cd")
+        + frame(b"l", b"log")
+        + frame(b"d", b"ef")
+    )
+    assert stream.read_int() == 3
+    buf = bytearray(3)
+    stream.readinto(memoryview(buf))
+    assert buf == b"abc"
+    on_progress.assert_called_once_with("progress")
+    rest = io.BytesIO()
+    stream.read_to_end(rest)
+    assert rest.getvalue() == b"def"
+    assert stream.untrusted_log == b"log"
+    stream.f.close()
+
+    # A stream that ends before its data is interrupted.
+    stream = open_stream(frame(b"d", b"a"))
+    with pytest.raises(errors.InterruptedConversion):
+        stream.read_int()
+    stream.f.close()
+
+    # Anything other than a frame is rejected.
+    stream = open_stream(b"x" + bytes(10))
+    with pytest.raises(errors.UnexpectedConversionError):
+        stream.read_int()
+    stream.f.close()
+
+    # Data that is not expected is rejected as well.
+    stream = open_stream(frame(b"d", b"a"))
+    with pytest.raises(errors.UnexpectedConversionError):
+        stream.read_to_end()
+    stream.f.close()
+
+
+def test_relay_page(mocker: MockerFixture) -> None:
+    """Test that the header of a page is checked and relayed as big-endian ints,
+    regardless of the default byte order of the host's Python."""
+    provider = Container(enable_timeouts=False)
+    pixels = deflate_pixels(bytes(3 * 2 * 3))
+    header = b"".join(n.to_bytes(2, "big") for n in (3, 2, DEPTH_RGB))
+    data = header + len(pixels).to_bytes(4, "big") + pixels
+
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"d" + len(data).to_bytes(4, "big") + data)
+    os.close(write_fd)
+    stream = ContainerStream(open(read_fd, "rb"), mocker.MagicMock(), timeout=10)
+    relayed = io.BytesIO()
+    provider.relay_page(stream, relayed)
+    assert relayed.getvalue() == data
+    stream.f.close()
+
+    # A page that is too wide is not relayed.
+    read_fd, write_fd = os.pipe()
+    data = (errors.MAX_PAGE_WIDTH + 1).to_bytes(2, "big") + data[2:]
+    os.write(write_fd, b"d" + len(data).to_bytes(4, "big") + data)
+    os.close(write_fd)
+    stream = ContainerStream(open(read_fd, "rb"), mocker.MagicMock(), timeout=10)
+    relayed = io.BytesIO()
+    with pytest.raises(errors.MaxPageWidthException):
+        provider.relay_page(stream, relayed)
+    assert relayed.getvalue() == b""
+    stream.f.close()
+
+
+def test_send_documents(tmp_path: Path) -> None:
+    """Test that the documents of a batch are sent after their big-endian sizes."""
+    provider = Container(enable_timeouts=False)
+    documents = []
+    for i, data in enumerate([b"first", b"second document"]):
+        path = tmp_path / f"doc-{i}.pdf"
+        path.write_bytes(data)
+        documents.append(Document(str(path)))
+
+    sent = io.BytesIO()
+    sent.close = lambda: None  # type: ignore [method-assign]
+    provider.send_documents(documents, sent)
+    assert sent.getvalue() == (
+        (5).to_bytes(8, "big") + b"first" + (15).to_bytes(8, "big") + b"second document"
+    )
+
+
+def test_relay_pages_timeouts(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Test that both streams of a conversion get the timeout for its pages, and that
+    a container that does not exit in time is killed."""
+    mocker.patch.object(Container, "get_runtime", return_value="podman")
+    run_mock = mocker.patch("subprocess.run")
+    provider = Container(enable_timeouts=True)
+    document_path = tmp_path / "document.pdf"
+    document_path.write_bytes(b"document")
+    document = Document(str(document_path))
+
+    pixels = bytes(3 * 2 * 3)
+    header = b"".join(n.to_bytes(2, "big") for n in (3, 2, DEPTH_RGB))
+    data = (1).to_bytes(2, "big") + header + len(pixels).to_bytes(4, "big") + pixels
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"d" + len(data).to_bytes(4, "big") + data)
+    os.close(write_fd)
+    doc_to_pixels = mocker.MagicMock()
+    doc_to_pixels.stdout = open(read_fd, "rb")
+    doc_to_pixels.wait.side_effect = [subprocess.TimeoutExpired("podman", 1), -9]
+    pixels_to_pdf_stream = mocker.MagicMock()
+
+    with pytest.raises(errors.UnexpectedConversionError):
+        provider.relay_pages(
+            document, doc_to_pixels, io.BytesIO(), 150, pixels_to_pdf_stream
+        )
+    doc_to_pixels.stdout.close()
+    pixels_to_pdf_stream.set_timeout.assert_called_once_with(
+        provider.get_stream_timeout(document, 1, 150)
+    )
+    assert run_mock.call_args.args[0] == [
+        "podman",
+        "kill",
+        get_container_name(document.id, "doc-to-pixels"),
+    ]
+    doc_to_pixels.kill.assert_called_once()
+
+
+def test_pixel_dir_label(mocker: MockerFixture, tmp_path: Path) -> None:
+    """Test that the pixels directory is shared between the containers only if they
+    run at the same time."""
+    provider = Container(enable_timeouts=False, pipeline=True, streaming=False)
+    provider.progress_callback = None
+    # The cached pages skip the first stage, so the stages do not run as a pipeline.
+    pixel_cache = provider.pixel_cache = mocker.MagicMock()
+    pixel_cache.get.return_value = 1
+    exec_mock = mocker.patch.object(provider, "exec_container", return_value=1)
+    mocker.patch(
+        "dangerzone.isolation_provider.container.get_tmp_dir",
+        return_value=str(tmp_path),
+    )
+    document_path = tmp_path / "document.pdf"
+    document_path.write_bytes(b"document")
+
+    assert not provider._convert(Document(str(document_path)), None)
+    exec_mock.assert_called_once()
+    pixels_to_pdf_args = exec_mock.call_args.args[2]
+    assert any(arg.endswith(":/tmp/dangerzone:Z") for arg in pixels_to_pdf_args)
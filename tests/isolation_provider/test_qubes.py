@@ -1,13 +1,19 @@
+import os
 import signal
 import subprocess
+import sys
 import time
+from pathlib import Path
+from typing import Any, List
 
 import pytest
 from pytest import MonkeyPatch
 from pytest_mock import MockerFixture
 
 from dangerzone.conversion import errors
+from dangerzone.conversion.pixels_to_pdf import PixelsToPDF
 from dangerzone.document import Document
+from dangerzone.isolation_provider import qubes
 from dangerzone.isolation_provider.base import IsolationProvider
 from dangerzone.isolation_provider.qubes import Qubes, running_on_qubes
 
@@ -17,6 +23,7 @@ from .. import (
     sample_bad_height,
     sample_bad_width,
     sample_doc,
+    sample_pdf,
     sanitized_text,
     uncommon_text,
 )
@@ -86,3 +93,197 @@ class TestQubes(IsolationProviderTest):
         with pytest.raises(errors.QubesQrexecFailed) as e:
             doc = Document(sample_doc)
             provider._convert(doc, ocr_lang=None)
+
+
+# A stand-in for `qrexec-client-vm`, which receives the document slowly, stores it, and
+# then sends a number of gray pages of 100x50 pixels, compressed if the host asks so.
+QREXEC_STAND_IN = """
+import sys, time, zlib
+dpi = int.from_bytes(sys.stdin.buffer.read(2), "big")
+compress = int.from_bytes(sys.stdin.buffer.read(2), "big")
+pages = sys.stdin.buffer.read(int.from_bytes(sys.stdin.buffer.read(2), "big"))
+with open(sys.argv[1], "wb") as f:
+    while chunk := sys.stdin.buffer.read(4096):
+        f.write(chunk)
+        time.sleep(0.001)
+n_pages = int(sys.argv[2])
+out = sys.stdout.buffer
+out.write(n_pages.to_bytes(2, "big"))
+for page in range(n_pages):
+    pixels = bytes([page * 50]) * 100 * 50
+    if compress:
+        pixels = zlib.compress(pixels)
+    if sys.argv[3] == "empty":
+        pixels = b""
+    for num in (100, 50, 8):
+        out.write(num.to_bytes(2, "big"))
+    out.write(len(pixels).to_bytes(4, "big") + pixels)
+out.flush()
+print(dpi, pages.decode() or "all", file=sys.stderr)
+"""
+
+
+def use_qrexec_stand_in(
+    provider: Qubes,
+    monkeypatch: MonkeyPatch,
+    received: Path,
+    n_pages: int,
+    pages: str = "full",
+) -> None:
+    def qrexec_subprocess() -> subprocess.Popen:
+        return subprocess.Popen(
+            [sys.executable, "-c", QREXEC_STAND_IN, str(received), str(n_pages), pages],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    monkeypatch.setattr(provider, "qrexec_subprocess", qrexec_subprocess)
+
+
+def test_stream_upload(
+    provider: Qubes,
+    mocker: MockerFixture,
+    monkeypatch: MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    """Test that the document is streamed to the disposable qube in chunks, with
+    progress reports, while the host waits for the page count."""
+    progress_callback = mocker.MagicMock()
+    provider.progress_callback = progress_callback
+    monkeypatch.setattr(qubes, "UPLOAD_CHUNK_SIZE", 4096)
+    document = tmp_path / "document.pdf"
+    document.write_bytes(os.urandom(1024 * 1024))
+    received = tmp_path / "received"
+    use_qrexec_stand_in(provider, monkeypatch, received, n_pages=0)
+
+    # Record how much of the document had been sent, once the host started waiting
+    # for the page count.
+    read_int = qubes.read_int
+    texts_on_read = []
+
+    def get_texts() -> List[str]:
+        return [c.args[1] for c in progress_callback.call_args_list]
+
+    def read_int_spy(*args: Any, **kwargs: Any) -> int:
+        texts_on_read.extend(get_texts())
+        return read_int(*args, **kwargs)
+
+    monkeypatch.setattr(qubes, "read_int", read_int_spy)
+
+    with pytest.raises(errors.MaxPagesException):
+        provider._convert(Document(str(document), pages="2-3"), ocr_lang=None, dpi=96)
+
+    assert received.read_bytes() == document.read_bytes()
+    assert provider.proc is not None
+    assert provider.proc.stderr is not None
+    assert provider.proc.stderr.read() == b"96 2-3\n"
+
+    # The progress of the upload is reported in steps, and the host waits for the page
+    # count while the upload is still in progress.
+    texts = get_texts()
+    assert texts[-1] == "Sending document to the disposable qube (100%)"
+    assert len(texts) == 10
+    assert texts[-1] not in texts_on_read
+
+
+@pytest.mark.parametrize("compress_pixels", [False, True])
+def test_page_handoff(
+    provider: Qubes,
+    compress_pixels: bool,
+    mocker: MockerFixture,
+    monkeypatch: MonkeyPatch,
+    sample_pdf: str,
+    tmp_path: Path,
+) -> None:
+    """Test that the pages are handed over to the PDF conversion in memory."""
+    import fitz
+
+    progress_callback = mocker.MagicMock()
+    provider.progress_callback = progress_callback
+    provider.compress_pixels = compress_pixels
+    use_qrexec_stand_in(provider, monkeypatch, tmp_path / "received", n_pages=3)
+    doc = Document(sample_pdf, str(tmp_path / "safe.pdf"))
+    read_pages_spy = mocker.spy(PixelsToPDF, "read_pages")
+    # Report the progress of the PDF conversion through the callback.
+    mocker.patch("dangerzone.conversion.common.running_on_qubes", return_value=True)
+
+    assert provider._convert(doc, ocr_lang=None, dpi=96)
+
+    with fitz.open(doc.output_filename) as safe_pdf:
+        assert safe_pdf.page_count == 3
+        # 100x50 pixels at 96 DPI are 75x37.5 points.
+        assert safe_pdf[0].rect.width == 75
+    # The pages have not been stored in files.
+    read_pages_spy.assert_not_called()
+
+    # The progress of the PDF conversion is held back until all the pages have been
+    # read.
+    texts = [c.args[1] for c in progress_callback.call_args_list]
+    pixels_done = texts.index("Converted document to pixels")
+    assert texts[pixels_done - 1] == "Converting page 3/3 to pixels"
+    assert "Converting page 3/3 from pixels to PDF" in texts[pixels_done:]
+    assert "Converting page 1/3 from pixels to PDF" not in texts
+
+
+@pytest.mark.parametrize("compress_pixels", [False, True])
+def test_empty_page(
+    provider: Qubes,
+    compress_pixels: bool,
+    mocker: MockerFixture,
+    monkeypatch: MonkeyPatch,
+    sample_pdf: str,
+    tmp_path: Path,
+) -> None:
+    """Test that pages without any data are rejected, before they are read."""
+    provider.progress_callback = mocker.MagicMock()
+    provider.compress_pixels = compress_pixels
+    use_qrexec_stand_in(provider, monkeypatch, tmp_path / "received", 1, "empty")
+    doc = Document(sample_pdf, str(tmp_path / "safe.pdf"))
+    with pytest.raises(errors.InvalidPixelData):
+        provider._convert(doc, ocr_lang=None, dpi=96)
+
+
+def test_upload_error(
+    provider: Qubes,
+    mocker: MockerFixture,
+    monkeypatch: MonkeyPatch,
+    sample_pdf: str,
+    tmp_path: Path,
+) -> None:
+    """Test that a failed upload stops the disposable qube, and that its error is
+    raised, instead of waiting for the page count."""
+    monkeypatch.setattr(qubes, "STARTUP_TIME_SECONDS", 0)
+    monkeypatch.setattr(qubes, "calculate_timeout", lambda *args: 10)
+    use_qrexec_stand_in(provider, monkeypatch, tmp_path / "received", n_pages=1)
+    mocker.patch.object(provider, "send_document", side_effect=RuntimeError("upload"))
+    with pytest.raises(RuntimeError, match="upload"):
+        provider._convert(Document(sample_pdf), ocr_lang=None)
+
+
+def test_page_count_timeout(
+    provider: Qubes,
+    mocker: MockerFixture,
+    monkeypatch: MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    """Test that the upload does not outlive a disposable qube that stops responding."""
+    provider.progress_callback = mocker.MagicMock()
+    monkeypatch.setattr(qubes, "STARTUP_TIME_SECONDS", 0)
+    monkeypatch.setattr(qubes, "calculate_timeout", lambda *args: 0.5)
+    # A disposable qube that never reads the document, which is larger than what the
+    # pipe can hold.
+    monkeypatch.setattr(
+        provider,
+        "qrexec_subprocess",
+        lambda: subprocess.Popen(
+            ["sleep", "30"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        ),
+    )
+    document = tmp_path / "document.pdf"
+    document.write_bytes(bytes(4 * 1024 * 1024))
+    uploader_spy = mocker.spy(qubes.threading, "Thread")
+
+    with pytest.raises(TimeoutError):
+        provider._convert(Document(str(document)), ocr_lang=None)
+    assert not uploader_spy.spy_return.is_alive()
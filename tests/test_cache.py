@@ -0,0 +1,143 @@
+import json
+import os
+from pathlib import Path
+
+from pytest import MonkeyPatch
+from pytest_mock import MockerFixture
+
+from dangerzone import util
+from dangerzone.cache import STATS_FILENAME, PixelCache, SafePDFCache
+from dangerzone.isolation_provider.dummy import Dummy
+from dangerzone.logic import DangerzoneCore
+
+from . import sample_doc, sample_pdf
+
+
+def test_cache_key(sample_pdf: str, sample_doc: str, tmp_path: Path) -> None:
+    cache = SafePDFCache(str(tmp_path))
+    key = cache.get_key(sample_pdf, ocr_lang="eng", dpi=150)
+    assert key == cache.get_key(sample_pdf, ocr_lang="eng", dpi=150)
+    assert key != cache.get_key(sample_doc, ocr_lang="eng", dpi=150)
+    assert key != cache.get_key(sample_pdf, ocr_lang=None, dpi=150)
+    assert key != cache.get_key(sample_pdf, ocr_lang="eng", dpi=300)
+
+
+def test_cache_get_put(tmp_path: Path) -> None:
+    cache = SafePDFCache(str(tmp_path / "cache"))
+    safe_pdf = tmp_path / "safe.pdf"
+    safe_pdf.write_bytes(b"safe")
+    output = tmp_path / "output.pdf"
+
+    assert not cache.get("key", str(output))
+    assert not output.exists()
+    cache.put("key", str(safe_pdf))
+    assert cache.get("key", str(output))
+    assert output.read_bytes() == b"safe"
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
+
+    # Errors while copying the safe PDF are treated as misses.
+    assert not cache.get("key", str(tmp_path))
+
+    # The statistics are kept across runs.
+    cache.save_stats()
+    cache = SafePDFCache(str(tmp_path / "cache"))
+    assert cache.stats == {"hits": 2, "misses": 1, "evictions": 0}
+
+
+def test_cache_eviction(tmp_path: Path) -> None:
+    cache = SafePDFCache(str(tmp_path / "cache"), max_size=25)
+    safe_pdf = tmp_path / "safe.pdf"
+    safe_pdf.write_bytes(b"x" * 10)
+    output = str(tmp_path / "output.pdf")
+
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, str(safe_pdf))
+        os.utime(cache.get_filename(key), (i, i))
+    # Use the oldest safe PDF, so that the other one is evicted.
+    assert cache.get("a", output)
+    cache.put("c", str(safe_pdf))
+    assert cache.get("a", output)
+    assert not cache.get("b", output)
+    assert cache.get("c", output)
+    assert cache.stats["evictions"] == 1
+
+    # Safe PDFs that are larger than the cache are not stored.
+    safe_pdf.write_bytes(b"x" * 30)
+    cache.put("d", str(safe_pdf))
+    assert not cache.get("d", output)
+
+
+def test_pixel_cache(tmp_path: Path) -> None:
+    cache = PixelCache(str(tmp_path / "cache"))
+    pixel_dir = tmp_path / "pixels"
+    pixel_dir.mkdir()
+    for page in (1, 2):
+        for extension in ("rgb", "width", "height", "depth"):
+            (pixel_dir / f"page-{page}.{extension}").write_text(f"{page}{extension}")
+    (pixel_dir / "captured_output.txt").write_text("log")
+
+    cache.put("key", str(pixel_dir))
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    assert cache.get("key", str(output_dir)) == 2
+    assert sorted(os.listdir(output_dir)) == sorted(
+        name for name in os.listdir(pixel_dir) if name.startswith("page-")
+    )
+    assert (output_dir / "page-2.depth").read_text() == "2depth"
+
+    # Pages with missing files are not cached.
+    (pixel_dir / "page-1.width").unlink()
+    cache.put("incomplete", str(pixel_dir))
+    assert cache.get("incomplete", str(output_dir)) is None
+
+
+def test_pixel_cache_symlink(tmp_path: Path) -> None:
+    """Test that the pages are not cached if the doc-to-pixels stage has replaced them
+    with symlinks to files of the host, or with FIFOs."""
+    cache = PixelCache(str(tmp_path / "cache"))
+    pixel_dir = tmp_path / "pixels"
+    pixel_dir.mkdir()
+    for extension in ("width", "height", "depth"):
+        (pixel_dir / f"page-1.{extension}").write_text("1")
+    secret = tmp_path / "id_rsa"
+    secret.write_text("secret")
+    (pixel_dir / "page-1.rgb").symlink_to(secret)
+
+    cache.put("key", str(pixel_dir))
+    assert cache.get("key", str(tmp_path)) is None
+    assert os.listdir(cache.path) == []
+
+    (pixel_dir / "page-1.rgb").unlink()
+    os.mkfifo(pixel_dir / "page-1.rgb")
+    cache.put("key", str(pixel_dir))
+    assert cache.get("key", str(tmp_path)) is None
+    assert os.listdir(cache.path) == []
+
+
+def test_convert_documents_cached(
+    sample_pdf: str, tmp_path: Path, monkeypatch: MonkeyPatch, mocker: MockerFixture
+) -> None:
+    """Test that documents that have been converted before skip the sandbox."""
+    monkeypatch.setattr(util, "get_config_dir", lambda: str(tmp_path / "config"))
+    mocker.patch("dangerzone.isolation_provider.dummy.time.sleep")
+    dummy = Dummy()
+    convert_spy = mocker.spy(dummy, "_convert")
+    dangerzone = DangerzoneCore(dummy)
+    dangerzone.enable_safe_pdf_cache()
+
+    outputs = [str(tmp_path / f"safe-{i}.pdf") for i in range(2)]
+    for output in outputs:
+        dangerzone.clear_documents()
+        dangerzone.add_document_from_filename(sample_pdf, output)
+        dangerzone.convert_documents(None)
+        assert dangerzone.get_safe_documents() == dangerzone.documents
+    assert convert_spy.call_count == 1
+    assert Path(outputs[0]).read_bytes() == Path(outputs[1]).read_bytes()
+
+    # A conversion with different settings misses the cache.
+    dangerzone.convert_document(dangerzone.documents[0], "eng")
+    assert convert_spy.call_count == 2
+
+    stats_filename = tmp_path / "config" / "safe-pdf-cache" / STATS_FILENAME
+    stats = json.loads(stats_filename.read_text())
+    assert stats == {"hits": 1, "misses": 2, "evictions": 0}
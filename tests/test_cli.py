@@ -20,6 +20,7 @@ from strip_ansi import strip_ansi
 from dangerzone.cli import cli_main, display_banner
 from dangerzone.document import ARCHIVE_SUBDIR, SAFE_EXTENSION
 from dangerzone.isolation_provider.qubes import is_qubes_native_conversion
+from dangerzone.logic import BATCH_MIN_DOCUMENTS
 
 from . import TestBase, for_each_doc, for_each_external_doc, sample_pdf
 
@@ -232,6 +233,28 @@ class TestCliConversion(TestCliBasic):
         result = self.run_cli([sample_pdf, "--ocr-lang", "eng"])
         result.assert_success()
 
+    @pytest.mark.parametrize("quality", ["fast", "standard", "archival"])
+    def test_quality(self, quality: str, sample_pdf: str) -> None:
+        result = self.run_cli([sample_pdf, "--quality", quality])
+        result.assert_success()
+
+    def test_dpi(self, sample_pdf: str) -> None:
+        result = self.run_cli([sample_pdf, "--dpi", "72"])
+        result.assert_success()
+
+    def test_invalid_dpi(self, sample_pdf: str) -> None:
+        result = self.run_cli([sample_pdf, "--dpi", "10000"])
+        result.assert_failure()
+
+    def test_pages(self, sample_pdf: str) -> None:
+        result = self.run_cli([sample_pdf, "--pages", "1"])
+        result.assert_success()
+
+    @pytest.mark.parametrize("pages", ["0", "3-1", "1,,2", "first"])
+    def test_invalid_pages(self, pages: str, sample_pdf: str) -> None:
+        result = self.run_cli([sample_pdf, "--pages", pages])
+        result.assert_failure()
+
     @pytest.mark.parametrize(
         "filename,",
         [
@@ -259,6 +282,18 @@ class TestCliConversion(TestCliBasic):
         result.assert_success()
         assert len(os.listdir(tmp_path)) == 2 * len(filenames)
 
+    def test_bulk_batch(self, tmp_path: Path, sample_pdf: str) -> None:
+        filenames = [f"{i}.pdf" for i in range(BATCH_MIN_DOCUMENTS)]
+        file_paths = []
+        for filename in filenames:
+            doc_path = str(tmp_path / filename)
+            shutil.copyfile(sample_pdf, doc_path)
+            file_paths.append(doc_path)
+
+        result = self.run_cli(file_paths)
+        result.assert_success()
+        assert len(os.listdir(tmp_path)) == 2 * len(filenames)
+
     def test_bulk_fail_on_output_filename(
         self, tmp_path: Path, sample_pdf: str
     ) -> None:
@@ -0,0 +1,191 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+import pytest
+from pytest_mock import MockerFixture
+
+from dangerzone import scheduler
+from dangerzone.conversion.errors import MaxInputSizeException
+from dangerzone.document import Document
+from dangerzone.isolation_provider.base import SandboxLimits
+from dangerzone.isolation_provider.dummy import Dummy
+from dangerzone.logic import DangerzoneCore
+from dangerzone.scheduler import (
+    MEMORY_PER_LIBREOFFICE,
+    SANDBOX_PIDS_LIMIT,
+    ConversionCost,
+    ResourceBudget,
+    count_pdf_pages,
+    estimate_cost,
+    get_sandbox_limits,
+    split_batches,
+)
+
+from . import sample_doc, sample_pdf, test_docs
+
+GiB = 1024**3
+
+
+def test_count_pdf_pages(sample_pdf: str, tmp_path: Path) -> None:
+    assert count_pdf_pages(sample_pdf) == 4
+
+    # Page objects that span two chunks must be counted once.
+    pdf = tmp_path / "pages.pdf"
+    pdf.write_bytes(b"x" * (1024 * 1024 - 5) + b"/Type /Page /Type/Pages /Type/Page")
+    assert count_pdf_pages(str(pdf)) == 2
+
+    pdf.write_bytes(b"no pages here")
+    assert count_pdf_pages(str(pdf)) is None
+
+
+def test_estimate_cost(sample_pdf: str, sample_doc: str) -> None:
+    pdf_cost = estimate_cost(Document(sample_pdf), cpu_count=4)
+    doc_cost = estimate_cost(Document(sample_doc), cpu_count=4)
+    assert pdf_cost.cpus == doc_cost.cpus == 1
+    assert doc_cost.memory > pdf_cost.memory + MEMORY_PER_LIBREOFFICE
+
+    # Higher resolutions need more memory for the pixels of the pages.
+    assert estimate_cost(Document(sample_pdf), dpi=300).memory > pdf_cost.memory
+
+
+def test_estimate_cost_single_cpu(sample_pdf: str, mocker: MockerFixture) -> None:
+    """Test that the pages of a document are not counted, if the conversion can get
+    only one CPU anyway."""
+    count_spy = mocker.spy(scheduler, "count_pdf_pages")
+    assert estimate_cost(Document(sample_pdf)).cpus == 1
+    count_spy.assert_not_called()
+    estimate_cost(Document(sample_pdf), cpu_count=4)
+    count_spy.assert_called_once()
+
+
+def test_warm_up(sample_pdf: str, mocker: MockerFixture) -> None:
+    """Test that the cost of a document is estimated for a warm-up only if the
+    isolation provider keeps warm sandboxes."""
+    dummy = Dummy()
+    estimate_spy = mocker.spy(scheduler, "estimate_cost")
+    warm_up_spy = mocker.spy(dummy, "warm_up")
+    dangerzone = DangerzoneCore(dummy)
+    dangerzone.warm_up(None, 150, Document(sample_pdf))
+    estimate_spy.assert_not_called()
+    warm_up_spy.assert_not_called()
+
+    mocker.patch.object(dummy, "has_warm_sandboxes", return_value=True)
+    dangerzone.warm_up(None, 150, Document(sample_pdf))
+    estimate_spy.assert_called_once()
+    warm_up_spy.assert_called_once()
+
+
+def test_resource_budget_admission() -> None:
+    budget = ResourceBudget(cpus=4, memory=1000, max_jobs=3)
+    small = ConversionCost(cpus=1, memory=100)
+    assert budget.max_parallel(small) == 3
+    assert budget.max_parallel(ConversionCost(cpus=1, memory=400)) == 2
+
+    with budget.reserve(small), budget.reserve(small):
+        assert budget.fits(small)
+        assert not budget.fits(ConversionCost(cpus=3, memory=100))
+        assert not budget.fits(ConversionCost(cpus=1, memory=900))
+        with budget.reserve(small):
+            # The maximum number of jobs has been reached.
+            assert not budget.fits(small)
+    assert budget.free_cpus == 4
+    assert budget.free_memory == 1000
+
+    # A conversion that exceeds the budget still runs, on its own.
+    huge = ConversionCost(cpus=8, memory=2000)
+    assert budget.fits(huge)
+    with budget.reserve(huge):
+        assert not budget.fits(small)
+
+
+def test_resource_budget_order() -> None:
+    """Test that conversions are admitted in the order they ask for resources, so
+    that a large one is not starved by smaller ones."""
+    budget = ResourceBudget(cpus=2, memory=None, max_jobs=2)
+    small = ConversionCost(cpus=1, memory=0)
+    large = ConversionCost(cpus=2, memory=0)
+    admitted: List[str] = []
+
+    def convert(name: str, cost: ConversionCost) -> None:
+        with budget.reserve(cost):
+            admitted.append(name)
+            time.sleep(0.05)
+
+    threads = []
+    for name, cost in [("small1", small), ("large", large), ("small2", small)]:
+        thread = threading.Thread(target=convert, args=(name, cost))
+        thread.start()
+        threads.append(thread)
+        # Make sure that the threads ask for resources in order.
+        while budget.next_ticket < len(threads):
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join()
+
+    assert admitted == ["small1", "large", "small2"]
+
+
+@pytest.mark.parametrize("n_batches", [1, 2, 3, 10])
+def test_split_batches(n_batches: int) -> None:
+    documents = [Document(str(doc)) for doc in test_docs]
+    batches = split_batches(documents, n_batches)
+    assert len(batches) == min(n_batches, len(documents))
+    batched = [d for batch in batches for d in batch]
+    assert len(batched) == len(documents)
+    assert set(batched) == set(documents)
+    sizes = [len(batch) for batch in batches]
+    assert max(sizes) - min(sizes) <= 1
+
+
+def test_get_sandbox_limits() -> None:
+    budget = ResourceBudget(cpus=4, memory=6 * GiB, max_jobs=9)
+
+    # The memory limit is the smallest size class with enough headroom.
+    limits = get_sandbox_limits(ConversionCost(cpus=1, memory=GiB // 4), budget)
+    assert limits == SandboxLimits(cpus=1, memory=GiB, pids=SANDBOX_PIDS_LIMIT)
+    limits = get_sandbox_limits(ConversionCost(cpus=2, memory=GiB), budget)
+    assert limits == SandboxLimits(cpus=2, memory=2 * GiB, pids=SANDBOX_PIDS_LIMIT)
+
+    # The limits do not exceed the capacity of the host.
+    limits = get_sandbox_limits(ConversionCost(cpus=8, memory=3 * GiB), budget)
+    assert limits == SandboxLimits(cpus=4, memory=6 * GiB, pids=SANDBOX_PIDS_LIMIT)
+
+    # Unless the host has less memory than the smallest size class.
+    small_budget = ResourceBudget(cpus=1, memory=GiB // 2, max_jobs=1)
+    limits = get_sandbox_limits(ConversionCost(cpus=1, memory=GiB), small_budget)
+    assert limits.memory == GiB
+
+    # Without a budget, only the size class counts.
+    limits = get_sandbox_limits(ConversionCost(cpus=8, memory=3 * GiB))
+    assert limits == SandboxLimits(cpus=8, memory=8 * GiB, pids=SANDBOX_PIDS_LIMIT)
+
+
+def test_sandbox_limits_covers() -> None:
+    limits = SandboxLimits(cpus=2, memory=GiB, pids=SANDBOX_PIDS_LIMIT)
+    assert limits.covers(SandboxLimits(cpus=1, memory=GiB, pids=SANDBOX_PIDS_LIMIT))
+    assert not limits.covers(SandboxLimits(cpus=4, memory=GiB, pids=1))
+    assert not limits.covers(SandboxLimits(cpus=1, memory=2 * GiB, pids=1))
+    # Limited sandboxes cannot run conversions that need unlimited resources.
+    assert not limits.covers(None)
+    assert SandboxLimits().covers(limits)
+
+
+def test_reject_oversized(
+    sample_pdf: str, tmp_path: Path, mocker: MockerFixture
+) -> None:
+    """Test that documents that are too large fail before a sandbox starts for them."""
+    mocker.patch("dangerzone.isolation_provider.dummy.time.sleep")
+    mocker.patch("dangerzone.logic.MAX_INPUT_SIZE", os.path.getsize(sample_pdf) - 1)
+    dummy = Dummy()
+    convert_spy = mocker.spy(dummy, "_convert")
+    callback = mocker.MagicMock()
+    dangerzone = DangerzoneCore(dummy)
+    dangerzone.add_document_from_filename(sample_pdf, str(tmp_path / "safe.pdf"))
+
+    dangerzone.convert_documents(None, callback)
+    assert dangerzone.get_failed_documents() == dangerzone.documents
+    convert_spy.assert_not_called()
+    callback.assert_called_once_with(True, str(MaxInputSizeException()), 0)
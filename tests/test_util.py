@@ -117,3 +117,41 @@ def test_nonblocking_read(mocker: MockerFixture) -> None:
     os.write(w, buf)
     os.close(w)
     assert util.nonblocking_read(r, size, timeout) == buf
+
+
+@pytest.mark.skipif(
+    platform.system() == "Windows", reason="Cannot test non-blocking read on Windows"
+)
+def test_nonblocking_readinto() -> None:
+    """Test that the nonblocking_readinto() function fills the buffer in place."""
+    timeout = 1
+    r, w = os.pipe()
+    os.set_blocking(r, False)
+
+    with pytest.raises(ValueError, match="Expected a positive size value"):
+        util.nonblocking_readinto(r, bytearray(), timeout)
+
+    # Check that partial reads are retried, and land at the right offset.
+    buf = bytearray(9)
+    os.write(w, b"12345")
+
+    def write_rest() -> None:
+        time.sleep(0.3)
+        os.write(w, b"67890")
+
+    threading.Thread(target=write_rest).start()
+    assert util.nonblocking_readinto(r, buf, timeout) == 9
+    assert buf == b"123456789"
+
+    # Check that a slice of a larger buffer can be filled, and that timeouts work.
+    buf = bytearray(b"xxxx")
+    with pytest.raises(TimeoutError):
+        util.nonblocking_readinto(r, memoryview(buf)[1:3], 0.1)
+    assert buf == b"x0xx"
+
+    # Check that EOF is detected.
+    os.write(w, b"Bye!")
+    os.close(w)
+    assert util.nonblocking_readinto(r, buf, timeout) == 4
+    assert buf == b"Bye!"
+    assert util.nonblocking_readinto(r, buf, timeout) == 0